@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline stand-ins for mygene.info and the NDEx server used by benchmarks
+"""
+
+import time
+
+
+class FakeMyGeneInfo(object):
+    """
+    Answers mygene.info queries from a dict of gene name to type_of_gene
+    """
+    def __init__(self, type_of_gene, latency=0):
+        """
+        :param type_of_gene: dict of gene name to mygene type_of_gene, or
+                             None when mygene.info has no hit for the gene
+        :param latency: seconds each query sleeps to mimic a round trip
+        """
+        self._type_of_gene = type_of_gene
+        self._latency = latency
+        self.queries = 0
+
+    def query(self, q, fields=None, **kwargs):
+        self.queries += 1
+        if self._latency:
+            time.sleep(self._latency)
+        type_of_gene = self._type_of_gene.get(q)
+        if type_of_gene is None:
+            return {'total': 0, 'hits': []}
+        return {'total': 1, 'hits': [{'_id': q, 'type_of_gene': type_of_gene}]}
+
+
+class FakeNdex(object):
+    """
+    Accepts uploads like Ndex2 does, reading and discarding the stream
+    """
+    CHUNK_SIZE = 1048576
+
+    def __init__(self):
+        self.bytes_received = 0
+        self.uploads = 0
+
+    def _receive(self, cx_stream):
+        self.uploads += 1
+        while True:
+            chunk = cx_stream.read(FakeNdex.CHUNK_SIZE)
+            if not chunk:
+                break
+            self.bytes_received += len(chunk)
+
+    def save_cx_stream_as_new_network(self, cx_stream, visibility=None):
+        self._receive(cx_stream)
+        return 'http://localhost/v2/network/00000000-0000-0000-0000-000000000000'
+
+    def update_cx_network(self, cx_stream, network_id):
+        self._receive(cx_stream)
+        return ''
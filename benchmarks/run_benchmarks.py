@@ -0,0 +1,450 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks the stages of the loader on synthetic GeneHancer data with
+mygene.info and NDEx stubbed out, and stores the results as JSON so that
+later changes can be compared against them.
+
+Usage::
+
+    python -m benchmarks.run_benchmarks --enhancers 50000
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/<old>.json
+"""
+
+import argparse
+from contextlib import contextmanager
+import csv
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from ndexgenehancerloader import ndexloadgenehancer
+from ndexgenehancerloader.ndexloadgenehancer import NDExGeneHancerLoader
+from ndexgenehancerloader.store import EdgeColumns
+import ndexgenehancerloader
+
+from benchmarks.fakes import FakeMyGeneInfo, FakeNdex
+from benchmarks.synthetic import SyntheticGeneHancer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+"""
+Default directory benchmark results are stored in
+"""
+
+INPUT_NAME = 'genehancer.tsv'
+PROFILE = 'benchmark'
+
+
+def _parse_arguments(desc, args):
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--enhancers', type=int, default=20000,
+                        help='Number of synthetic enhancers (default 20000)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Seed of the synthetic data (default 1)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Times each benchmark is run; the fastest run '
+                             'is reported (default 3)')
+    parser.add_argument('--mygenelatency', type=float, default=0,
+                        help='Seconds every stubbed mygene.info query takes '
+                             '(default 0)')
+    parser.add_argument('--only', default=None,
+                        help='Comma separated names of benchmarks to run '
+                             '(default all)')
+    parser.add_argument('--output', default=None,
+                        help='File to store results in (default '
+                             'benchmarks/results/<time>-<commit>.json)')
+    parser.add_argument('--compare', default=None,
+                        help='Results file of an earlier run to compare with')
+    return parser.parse_args(args)
+
+
+@contextmanager
+def _quiet():
+    """
+    Discards what the loader prints, which would otherwise swamp the output
+    """
+    with open(os.devnull, 'w') as devnull:
+        old_stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = old_stdout
+
+
+@contextmanager
+def _stub_mygene(type_of_gene, latency):
+    fake = FakeMyGeneInfo(type_of_gene, latency=latency)
+    original = ndexloadgenehancer.mg
+    ndexloadgenehancer.mg = fake
+    try:
+        yield fake
+    finally:
+        ndexloadgenehancer.mg = original
+
+
+class BenchmarkContext(object):
+    """
+    Synthetic input shared by all benchmarks of a run
+    """
+    def __init__(self, theargs):
+        self.args = theargs
+        self.work_dir = tempfile.mkdtemp(prefix='genehancer_benchmark_')
+        self.input_dir = os.path.join(self.work_dir, 'input')
+        os.mkdir(self.input_dir)
+        self.input_file = os.path.join(self.input_dir, INPUT_NAME)
+
+        self.data = SyntheticGeneHancer(theargs.enhancers, seed=theargs.seed)
+        self.counts = self.data.write(self.input_file)
+        self.input_bytes = os.path.getsize(self.input_file)
+
+        self.empty_gene_types_file = os.path.join(self.work_dir, 'empty_genetypes.json')
+        with open(self.empty_gene_types_file, 'w') as f:
+            json.dump({}, f)
+
+        self.conf_file = os.path.join(self.work_dir, 'conf')
+        with open(self.conf_file, 'w') as f:
+            f.write('[' + PROFILE + ']\n')
+            f.write('user = benchmark\n')
+            f.write('password = benchmark\n')
+            f.write('server = localhost\n')
+
+        self.gene_types = None
+        self.result_tsv = None
+        self.store_dir = None
+
+    def new_loader(self, datadir, extra_args=None):
+        """
+        Creates a loader with the command line a user would pass, using
+        gene types that are all unknown, so every gene is typed
+        """
+        args = ['--datadir', datadir,
+                '--conf', self.conf_file,
+                '--profile', PROFILE,
+                '--genetypes', self.empty_gene_types_file,
+                '--noverify']
+        if extra_args:
+            args.extend(extra_args)
+        theargs = ndexloadgenehancer._parse_arguments('benchmark', args)
+        loader = NDExGeneHancerLoader(theargs)
+        loader._ndex = FakeNdex()
+        return loader
+
+    def new_data_dir(self):
+        data_dir = tempfile.mkdtemp(dir=self.work_dir)
+        shutil.copy(self.input_file, data_dir)
+        return data_dir
+
+    def cleanup(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def bench_import_help(context):
+    """
+    Cold start of ``ndexloadgenehancer.py --help`` in a new interpreter
+    """
+    start = time.perf_counter()
+    subprocess.check_call(
+        [sys.executable, '-m', 'ndexgenehancerloader.ndexloadgenehancer', '--help'],
+        cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start, 1
+
+
+def bench_spawn_worker(context):
+    """
+    Cold start of a spawned pool worker that imports the loader module
+    """
+    start = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        pool.apply(ndexloadgenehancer._get_default_data_dir_name)
+    return time.perf_counter() - start, 1
+
+
+def bench_reformat(context):
+    """
+    _reformat_input_file with every gene type already known
+    """
+    data_dir = context.new_data_dir()
+    loader = context.new_loader(data_dir)
+    loader._delimiter = '\t'
+    loader._gene_types = dict(context.gene_types)
+    loader._internal_gene_types = {}
+    start = time.perf_counter()
+    with _quiet():
+        result = loader._reformat_input_file(
+            os.path.join(data_dir, INPUT_NAME), 'genehancer', INPUT_NAME)
+    elapsed = time.perf_counter() - start
+    context.result_tsv = result
+    return elapsed, context.counts['edges']
+
+
+def bench_reformat_store(context):
+    """
+    _reformat_input_file reading the columnar edge store (--store) that an
+    earlier run left, instead of the input file
+    """
+    if context.store_dir is None:
+        context.store_dir = context.new_data_dir()
+        loader = context.new_loader(context.store_dir, ['--store'])
+        loader._delimiter = '\t'
+        loader._gene_types = dict(context.gene_types)
+        with _quiet():
+            loader._reformat_input_file(
+                os.path.join(context.store_dir, INPUT_NAME), 'genehancer', INPUT_NAME)
+    loader = context.new_loader(context.store_dir, ['--store'])
+    loader._delimiter = '\t'
+    loader._gene_types = {}
+    start = time.perf_counter()
+    with _quiet():
+        loader._reformat_input_file(None, 'genehancer', INPUT_NAME)
+    elapsed = time.perf_counter() - start
+    return elapsed, context.counts['edges']
+
+
+def bench_gene_type(context):
+    """
+    _get_gene_type on every edge's gene, starting from an empty cache, with
+    mygene.info stubbed
+    """
+    loader = context.new_loader(context.input_dir)
+    loader._gene_types = {}
+    loader._internal_gene_types = {}
+    loader._update_gene_types = False
+    genes = []
+    for row in context.data.rows():
+        for attribute in row[8].split(';'):
+            if attribute.startswith('connected_gene='):
+                genes.append(attribute.split('=')[1])
+    with _stub_mygene(context.data.type_of_gene, context.args.mygenelatency):
+        start = time.perf_counter()
+        for gene in genes:
+            loader._get_gene_type(gene)
+        elapsed = time.perf_counter() - start
+    context.gene_types = loader._internal_gene_types
+    return elapsed, len(genes)
+
+
+def bench_generate_cx(context):
+    """
+    _generate_nice_cx_from_tsv on the output of the reformat benchmark
+    """
+    loader = context.new_loader(os.path.dirname(context.result_tsv))
+    with _quiet():
+        loader._get_network_attributes()
+        loader._get_style_network()
+        start = time.perf_counter()
+        loader._generate_nice_cx_from_tsv(context.result_tsv, 'genehancer')
+        elapsed = time.perf_counter() - start
+    return elapsed, context.counts['edges']
+
+
+def _get_traced_size(build):
+    """
+    :return: tuple of what build() returns and the bytes it still holds
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def bench_edge_memory(context):
+    """
+    Memory needed to hold every edge of the reformatted file: as rows of
+    strings (what csv gives) and in EdgeColumns. The time is that of
+    filling EdgeColumns from the rows.
+    """
+    with open(context.result_tsv, 'r') as f:
+        reader = csv.reader(f, delimiter='\t')
+        next(reader)
+        rows, rows_size = _get_traced_size(lambda: list(reader))
+
+    def build_columns():
+        edges = EdgeColumns()
+        for row in rows:
+            edges.append(row[0], row[2], int(float(row[3])),
+                         int(float(row[4])), float(row[5]), row[7], row[8],
+                         float(row[10]), row[12])
+        return edges
+    start = time.perf_counter()
+    build_columns()
+    elapsed = time.perf_counter() - start
+    _, columns_size = _get_traced_size(build_columns)
+
+    num_edges = len(rows)
+    return elapsed, num_edges, {
+        'bytes_per_edge_rows': rows_size / num_edges,
+        'bytes_per_edge_columns': columns_size / num_edges
+    }
+
+
+def bench_run(context):
+    """
+    run() end to end against a fake NDEx, typing genes with mygene.info
+    stubbed
+    """
+    data_dir = context.new_data_dir()
+    loader = context.new_loader(data_dir)
+    with _stub_mygene(context.data.type_of_gene, context.args.mygenelatency):
+        with _quiet():
+            start = time.perf_counter()
+            return_value = loader.run()
+            elapsed = time.perf_counter() - start
+    if return_value != 0:
+        raise Exception('run() returned ' + str(return_value))
+    return elapsed, context.counts['edges']
+
+
+BENCHMARKS = [
+    ('import_help', bench_import_help),
+    ('spawn_worker', bench_spawn_worker),
+    ('gene_type', bench_gene_type),
+    ('reformat', bench_reformat),
+    ('reformat_store', bench_reformat_store),
+    ('generate_cx', bench_generate_cx),
+    ('edge_memory', bench_edge_memory),
+    ('run', bench_run)
+]
+"""
+Benchmarks in the order they run
+"""
+
+DEPENDENCIES = {
+    'reformat': 'gene_type',
+    'reformat_store': 'gene_type',
+    'generate_cx': 'reformat',
+    'edge_memory': 'reformat'
+}
+"""
+Benchmarks that reuse what another benchmark made (gene types, the
+reformatted file)
+"""
+
+# A benchmark returns (seconds, items), or (seconds, items, dict of other
+# measurements) which are stored with its results
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(theargs):
+    """
+    Runs the benchmarks selected by theargs
+    :return: dict of results
+    """
+    context = BenchmarkContext(theargs)
+    if theargs.only is None:
+        selected = [name for name, _ in BENCHMARKS]
+    else:
+        selected = theargs.only.split(',')
+    needed = set()
+    for name in selected:
+        while name in DEPENDENCIES:
+            name = DEPENDENCIES[name]
+            needed.add(name)
+    results = {}
+    try:
+        for name, benchmark in BENCHMARKS:
+            if name not in selected:
+                if name in needed:
+                    benchmark(context)
+                continue
+            times = []
+            for _ in range(theargs.repeat):
+                result = benchmark(context)
+                elapsed, items = result[:2]
+                times.append(elapsed)
+            results[name] = {
+                'times': times,
+                'min': min(times),
+                'median': statistics.median(times),
+                'items': items,
+                'items_per_second': items / min(times) if min(times) > 0 else None
+            }
+            print('{:<14} min {:8.3f}s  median {:8.3f}s  {:12.0f} items/s'.format(
+                name, min(times), statistics.median(times),
+                results[name]['items_per_second'] or 0))
+            if len(result) > 2:
+                results[name].update(result[2])
+                for key, value in sorted(result[2].items()):
+                    print('{:<14} {} {:.1f}'.format('', key, value))
+    finally:
+        context.cleanup()
+    return {
+        'version': ndexgenehancerloader.__version__,
+        'commit': _get_commit(),
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'enhancers': theargs.enhancers,
+            'seed': theargs.seed,
+            'repeat': theargs.repeat,
+            'mygenelatency': theargs.mygenelatency
+        },
+        'data': dict(context.counts, bytes=context.input_bytes),
+        'benchmarks': results
+    }
+
+
+def compare(old, new):
+    """
+    Prints how the median of every benchmark changed between two results
+    """
+    if old.get('parameters') != new.get('parameters'):
+        print('Warning: results were made with different parameters')
+    print('{:<14} {:>10} {:>10} {:>8}'.format('benchmark', 'old', 'new', 'ratio'))
+    for name, result in new['benchmarks'].items():
+        old_result = old.get('benchmarks', {}).get(name)
+        if old_result is None:
+            continue
+        print('{:<14} {:>9.3f}s {:>9.3f}s {:>7.2f}x'.format(
+            name, old_result['median'], result['median'],
+            old_result['median'] / result['median'] if result['median'] else 0))
+
+
+def main(args):
+    theargs = _parse_arguments(__doc__, args[1:])
+    results = run_benchmarks(theargs)
+
+    output = theargs.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, '{}-{}.json'.format(
+            datetime.now().strftime('%Y%m%d-%H%M%S'), results['commit'] or 'unknown'))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print('Results written to ' + output)
+
+    if theargs.compare is not None:
+        with open(theargs.compare, 'r') as f:
+            compare(json.load(f), results)
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""
+Seeded generator of synthetic GeneHancer data.
+
+The data mimics a GeneHancer release: enhancers are spread over the
+chromosomes in proportion to their (hg38) size, each enhancer is linked to
+a geometric-like number of nearby genes, and gene names are drawn from the
+families the loader treats specially (protein coding symbols, LINC, LOC,
+GC*, miRNAs, piRNAs and Ensembl IDs).
+"""
+
+import bisect
+import csv
+import random
+
+CHROMOSOME_SIZES = [
+    ('chr1', 248956422),
+    ('chr2', 242193529),
+    ('chr3', 198295559),
+    ('chr4', 190214555),
+    ('chr5', 181538259),
+    ('chr6', 170805979),
+    ('chr7', 159345973),
+    ('chr8', 145138636),
+    ('chr9', 138394717),
+    ('chr10', 133797422),
+    ('chr11', 135086622),
+    ('chr12', 133275309),
+    ('chr13', 114364328),
+    ('chr14', 107043718),
+    ('chr15', 101991189),
+    ('chr16', 90338345),
+    ('chr17', 83257441),
+    ('chr18', 80373285),
+    ('chr19', 58617616),
+    ('chr20', 64444167),
+    ('chr21', 46709983),
+    ('chr22', 50818468),
+    ('chrX', 156040895),
+    ('chrY', 57227415)
+]
+"""
+hg38 chromosome names and lengths
+"""
+
+HEADER = [
+    '#chrom',
+    'source',
+    'feature name',
+    'start',
+    'end',
+    'score',
+    'strand',
+    'frame',
+    'attributes'
+]
+"""
+Header of a GeneHancer GFF-style export
+"""
+
+GENE_FAMILIES = [
+    ('protein', 0.52, 'protein-coding'),
+    ('linc', 0.07, 'ncRNA'),
+    ('loc', 0.07, 'ncRNA'),
+    ('gc', 0.13, None),
+    ('mir', 0.04, 'miRNA'),
+    ('pir', 0.07, None),
+    ('ensg', 0.05, 'pseudo'),
+    ('unknown', 0.05, None)
+]
+"""
+Gene name families as (family, weight, mygene type_of_gene). A type of
+None means mygene.info has no hit for the gene.
+"""
+
+GENES_PER_ENHANCER = 4.2
+"""
+Mean number of genes connected to an enhancer
+"""
+
+MAX_GENES_PER_ENHANCER = 60
+
+GENES_PER_ENHANCER_RATIO = 0.35
+"""
+Number of distinct genes relative to the number of enhancers
+"""
+
+PROMOTER_FRACTION = 0.2
+"""
+Fraction of elements that are Promoter/Enhancer rather than Enhancer
+"""
+
+NEIGHBOURHOOD = 25
+"""
+Standard deviation, in genes, of how far from an enhancer its genes are
+"""
+
+_LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+class SyntheticGeneHancer(object):
+    """
+    Generates a reproducible synthetic GeneHancer data set
+    """
+    def __init__(self, num_enhancers, seed=0):
+        """
+        :param num_enhancers: number of enhancer rows to generate
+        :param seed: random seed; the same seed always gives the same data
+        """
+        self.num_enhancers = num_enhancers
+        self.seed = seed
+        self.type_of_gene = {}
+        """
+        mygene.info type_of_gene of each generated gene (None if unknown)
+        """
+        self._random = random.Random(seed)
+        self._genes = {}
+        self._generate_genes()
+
+    def _generate_genes(self):
+        genome_size = sum(size for _, size in CHROMOSOME_SIZES)
+        num_genes = max(1, int(self.num_enhancers * GENES_PER_ENHANCER_RATIO))
+        used = set()
+        for chrom, size in CHROMOSOME_SIZES:
+            count = max(1, int(round(num_genes * size / genome_size)))
+            positions = sorted(self._random.randrange(size) for _ in range(count))
+            names = []
+            for _ in positions:
+                name, type_of_gene = self._gene_name(chrom)
+                while name in used:
+                    name, type_of_gene = self._gene_name(chrom)
+                used.add(name)
+                self.type_of_gene[name] = type_of_gene
+                names.append(name)
+            self._genes[chrom] = (positions, names)
+
+    def _gene_name(self, chrom):
+        roll = self._random.random()
+        for family, weight, type_of_gene in GENE_FAMILIES:
+            if roll < weight:
+                break
+            roll -= weight
+        r = self._random
+        if family == 'protein':
+            name = (''.join(r.choice(_LETTERS) for _ in range(r.randint(3, 5))) +
+                    str(r.randint(1, 99)))
+        elif family == 'linc':
+            name = 'LINC%05d' % r.randint(1, 99999)
+        elif family == 'loc':
+            name = 'LOC%d' % r.randint(100000000, 109999999)
+        elif family == 'gc':
+            name = 'GC%s%s%06d' % (_chromosome_code(chrom)[-2:],
+                                   r.choice('MP'),
+                                   r.randint(1, 999999))
+        elif family == 'mir':
+            if r.random() < 0.5:
+                name = 'MIR%d' % r.randint(1, 9999)
+            else:
+                name = 'hsa-miR-%d-%d' % (r.randint(1, 9999), r.randint(1, 5))
+        elif family == 'pir':
+            name = 'piR-%d-%d' % (r.randint(30000, 60000), r.randint(1, 999))
+        elif family == 'ensg':
+            name = 'ENSG%011d' % r.randint(1, 99999999999)
+        else:
+            name = (''.join(r.choice(_LETTERS) for _ in range(6)) +
+                    '-' + str(r.randint(1, 9)))
+        return name, type_of_gene
+
+    def _enhancer_counts(self):
+        genome_size = sum(size for _, size in CHROMOSOME_SIZES)
+        counts = []
+        remaining = self.num_enhancers
+        for i, (chrom, size) in enumerate(CHROMOSOME_SIZES):
+            if i == len(CHROMOSOME_SIZES) - 1:
+                count = remaining
+            else:
+                count = min(remaining, int(round(self.num_enhancers * size / genome_size)))
+            remaining -= count
+            counts.append((chrom, size, count))
+        return counts
+
+    def _num_genes(self, r):
+        num = 1 + int(r.expovariate(1.0 / (GENES_PER_ENHANCER - 1)))
+        return min(num, MAX_GENES_PER_ENHANCER)
+
+    def rows(self):
+        """
+        Generates the data rows (without header), sorted by chromosome and
+        start location. Every call yields the same rows.
+        :return: iterator of rows, each a list of 9 strings
+        """
+        r = random.Random('rows-' + str(self.seed))
+        for chrom, size, count in self._enhancer_counts():
+            positions, names = self._genes[chrom]
+            last_kb = -1
+            for start in sorted(r.randrange(size) for _ in range(count)):
+                length = min(int(r.lognormvariate(6.5, 0.8)) + 50, 20000)
+                # IDs encode the start in kb; bump to keep them unique
+                kb = max(start // 1000, last_kb + 1)
+                last_kb = kb
+                enhancer_id = 'GH%sJ%06d' % (_chromosome_code(chrom), kb)
+
+                attributes = ['genehancer_id=' + enhancer_id]
+                nearest = bisect.bisect_left(positions, start)
+                chosen = set()
+                for _ in range(min(self._num_genes(r), len(names))):
+                    index = int(round(nearest + r.gauss(0, NEIGHBOURHOOD)))
+                    index = min(max(index, 0), len(names) - 1)
+                    if index in chosen:
+                        continue
+                    chosen.add(index)
+                    score = min(round(r.lognormvariate(0, 1.6), 2), 700)
+                    attributes.append('connected_gene=' + names[index])
+                    attributes.append('score=' + str(max(score, 0.01)))
+                attributes_string = ';'.join(attributes)
+                if r.random() < 0.5:
+                    attributes_string += ';'
+
+                if r.random() < PROMOTER_FRACTION:
+                    feature_name = 'Promoter/Enhancer'
+                else:
+                    feature_name = 'Enhancer'
+                confidence = round(min(r.lognormvariate(-0.4, 0.6), 2.5), 2)
+
+                yield [
+                    chrom,
+                    'GeneHancer',
+                    feature_name,
+                    str(start),
+                    str(start + length),
+                    str(max(confidence, 0.01)),
+                    '.',
+                    '.',
+                    attributes_string
+                ]
+
+    def write(self, file_path, delimiter='\t', header=True):
+        """
+        Writes the data set to file_path
+        :return: dict with the number of enhancers, edges and genes written
+        """
+        enhancers = 0
+        edges = 0
+        genes = set()
+        with open(file_path, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter=delimiter)
+            if header:
+                writer.writerow(HEADER)
+            for row in self.rows():
+                writer.writerow(row)
+                enhancers += 1
+                for attribute in row[8].split(';'):
+                    if attribute.startswith('connected_gene='):
+                        edges += 1
+                        genes.add(attribute.split('=')[1])
+        return {'enhancers': enhancers, 'edges': edges, 'genes': len(genes)}
+
+
+def _chromosome_code(chrom):
+    """
+    Gets the chromosome part of a GeneHancer ID (eg. '01', '0X')
+    """
+    name = chrom[3:]
+    if name.isdigit():
+        return '%02d' % int(name)
+    return '0' + name
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""Writers of the network in formats other than CX."""
+
+import csv
+import importlib
+from xml.sax.saxutils import escape, quoteattr
+
+EXPORT_SUFFIXES = {
+    'graphml': '.graphml',
+    'sif': '.sif',
+    'edges': '.edges.tsv',
+    'parquet': '.edges.parquet',
+    'nodes': '.nodes.tsv'
+}
+"""
+Formats --export writes the network in, by the suffix of their file
+"""
+
+EXPORT_TYPES = {
+    'double': ('double', 'float64'),
+    'float': ('double', 'float64'),
+    'long': ('long', 'int64'),
+    'integer': ('long', 'int64'),
+    'boolean': ('boolean', 'bool_')
+}
+"""
+GraphML attr.type and pyarrow type of CX data types; other data types are
+exported as strings
+"""
+
+
+def get_plan_attributes(node_or_edge_plan):
+    """
+    Gets the attributes a node or edge plan of a load plan makes
+    :return: list of (attribute name, data type) tuples
+    """
+    attributes = []
+    for column in node_or_edge_plan.get('property_columns', []):
+        if isinstance(column, dict):
+            name = column.get('attribute_name') or column.get('column_name')
+            if column.get('data_type'):
+                data_type = column['data_type']
+            elif column.get('delimiter'):
+                data_type = 'list_of_string'
+            else:
+                data_type = 'string'
+        else:
+            name, _, data_type = column.partition('::')
+            data_type = data_type or 'string'
+        attributes.append((name, data_type))
+    return attributes
+
+
+def _get_export_value(value):
+    """
+    Gets an attribute value as a string, joining lists with commas
+    """
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ','.join(str(item) for item in value)
+    return str(value)
+
+
+class Exporter(object):
+    """
+    Writes the nodes and edges of a network, a batch at a time, in one
+    format. Nodes and edges are dicts as StreamTSVLoader buffers them: nodes
+    have an id, name (n), represents (r) and attributes (attr), edges an
+    id, source (s), target (t), interaction (i) and attributes (attr).
+    """
+    REQUIRES = []
+    """
+    Optional modules the format needs
+    """
+
+    def __init__(self, file_path, node_attributes, edge_attributes):
+        """
+        :param node_attributes: (name, data type) of node attributes
+        :param edge_attributes: (name, data type) of edge attributes
+        """
+        self.file_path = file_path
+        self._node_attributes = node_attributes
+        self._edge_attributes = edge_attributes
+
+    def write_batch(self, nodes, edges):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class TextExporter(Exporter):
+    """
+    Exporter writing a text file
+    """
+    def __init__(self, file_path, node_attributes, edge_attributes):
+        super(TextExporter, self).__init__(file_path, node_attributes,
+                                           edge_attributes)
+        self._file = open(file_path, 'w', encoding='utf-8', newline='')
+
+    def close(self):
+        self._file.close()
+
+
+class SIFExporter(TextExporter):
+    """
+    Writes edges as the tab separated source, interaction and target node
+    names of the Simple Interaction Format
+    """
+    def __init__(self, file_path, node_attributes, edge_attributes):
+        super(SIFExporter, self).__init__(file_path, node_attributes,
+                                          edge_attributes)
+        self._names = {}
+
+    def write_batch(self, nodes, edges):
+        for node in nodes:
+            self._names[node['id']] = node.get('n')
+        for edge in edges:
+            self._file.write('{}\t{}\t{}\n'.format(
+                self._names[edge['s']], edge.get('i'), self._names[edge['t']]))
+
+
+class EdgeTableExporter(TextExporter):
+    """
+    Writes a tab separated edge list with the source and target node names
+    and represents, the interaction and the edge attributes
+    """
+    COLUMNS = ['source', 'source_represents', 'interaction', 'target',
+               'target_represents']
+
+    def __init__(self, file_path, node_attributes, edge_attributes):
+        super(EdgeTableExporter, self).__init__(file_path, node_attributes,
+                                                edge_attributes)
+        self._nodes = {}
+        self._writer = csv.writer(self._file, delimiter='\t')
+        self._writer.writerow(self.COLUMNS +
+                              [name for name, _ in edge_attributes])
+
+    def write_batch(self, nodes, edges):
+        for node in nodes:
+            self._nodes[node['id']] = (node.get('n'), node.get('r'))
+        for edge in edges:
+            source_name, source_rep = self._nodes[edge['s']]
+            target_name, target_rep = self._nodes[edge['t']]
+            attributes = edge.get('attr') or {}
+            self._writer.writerow(
+                [source_name, source_rep, edge.get('i'), target_name,
+                 target_rep] +
+                [_get_export_value(attributes.get(name, {}).get('v'))
+                 for name, _ in self._edge_attributes])
+
+
+class NodeTableExporter(TextExporter):
+    """
+    Writes a tab separated table of the node IDs, names, represents and
+    attributes
+    """
+    COLUMNS = ['id', 'name', 'represents']
+
+    def __init__(self, file_path, node_attributes, edge_attributes):
+        super(NodeTableExporter, self).__init__(file_path, node_attributes,
+                                                edge_attributes)
+        self._writer = csv.writer(self._file, delimiter='\t')
+        self._writer.writerow(self.COLUMNS +
+                              [name for name, _ in node_attributes])
+
+    def write_batch(self, nodes, edges):
+        for node in nodes:
+            attributes = node.get('attr') or {}
+            self._writer.writerow(
+                [node['id'], node.get('n'), node.get('r')] +
+                [_get_export_value(attributes.get(name, {}).get('v'))
+                 for name, _ in self._node_attributes])
+
+
+class GraphMLExporter(TextExporter):
+    """
+    Writes a directed GraphML graph. GraphML lets nodes and edges be
+    declared in any order, so they are written as they come.
+    """
+    def __init__(self, file_path, node_attributes, edge_attributes):
+        super(GraphMLExporter, self).__init__(file_path, node_attributes,
+                                              edge_attributes)
+        self._node_keys = [('name', 'string'), ('represents', 'string')] + \
+            list(node_attributes)
+        self._edge_keys = [('interaction', 'string')] + list(edge_attributes)
+        self._file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+        for prefix, domain, keys in [('n', 'node', self._node_keys),
+                                     ('e', 'edge', self._edge_keys)]:
+            for i, (name, data_type) in enumerate(keys):
+                graphml_type = EXPORT_TYPES.get(data_type, ('string',))[0]
+                self._file.write(
+                    '  <key id="{}{}" for="{}" attr.name={} '
+                    'attr.type="{}"/>\n'.format(prefix, i, domain,
+                                                quoteattr(name),
+                                                graphml_type))
+        self._file.write('  <graph id="G" edgedefault="directed">\n')
+
+    def _write_data(self, prefix, keys, values):
+        for i, value in enumerate(values):
+            if value is None or value == '':
+                continue
+            if keys[i][1] == 'boolean':
+                value = str(value).lower()
+            self._file.write('      <data key="{}{}">{}</data>\n'.format(
+                prefix, i, escape(_get_export_value(value))))
+
+    def write_batch(self, nodes, edges):
+        for node in nodes:
+            attributes = node.get('attr') or {}
+            self._file.write('    <node id="n{}">\n'.format(node['id']))
+            self._write_data('n', self._node_keys,
+                             [node.get('n'), node.get('r')] + [
+                                 attributes.get(name, {}).get('v')
+                                 for name, _ in self._node_keys[2:]])
+            self._file.write('    </node>\n')
+        for edge in edges:
+            attributes = edge.get('attr') or {}
+            self._file.write(
+                '    <edge id="e{}" source="n{}" target="n{}">\n'.format(
+                    edge['id'], edge['s'], edge['t']))
+            self._write_data('e', self._edge_keys, [edge.get('i')] + [
+                attributes.get(name, {}).get('v')
+                for name, _ in self._edge_keys[1:]])
+            self._file.write('    </edge>\n')
+
+    def close(self):
+        self._file.write('  </graph>\n</graphml>\n')
+        super(GraphMLExporter, self).close()
+
+
+class ParquetEdgeExporter(Exporter):
+    """
+    Writes the columns of EdgeTableExporter to a Parquet file, one row
+    group per batch. Needs pyarrow.
+    """
+    REQUIRES = ['pyarrow']
+
+    def __init__(self, file_path, node_attributes, edge_attributes):
+        super(ParquetEdgeExporter, self).__init__(file_path, node_attributes,
+                                                  edge_attributes)
+        import pyarrow
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        fields = [(name, pyarrow.string())
+                  for name in EdgeTableExporter.COLUMNS]
+        for name, data_type in edge_attributes:
+            arrow_type = EXPORT_TYPES.get(data_type, (None, 'string'))[1]
+            fields.append((name, getattr(pyarrow, arrow_type)()))
+        self._schema = pyarrow.schema(fields)
+        self._writer = pyarrow.parquet.ParquetWriter(file_path, self._schema)
+        self._nodes = {}
+
+    def write_batch(self, nodes, edges):
+        for node in nodes:
+            self._nodes[node['id']] = (node.get('n'), node.get('r'))
+        if not edges:
+            return
+        columns = [[] for _ in self._schema.names]
+        for edge in edges:
+            source_name, source_rep = self._nodes[edge['s']]
+            target_name, target_rep = self._nodes[edge['t']]
+            attributes = edge.get('attr') or {}
+            values = [source_name, source_rep, edge.get('i'), target_name,
+                      target_rep]
+            for name, data_type in self._edge_attributes:
+                value = attributes.get(name, {}).get('v')
+                if data_type not in EXPORT_TYPES and value is not None:
+                    value = _get_export_value(value)
+                values.append(value)
+            for column, value in zip(columns, values):
+                column.append(value)
+        self._writer.write_table(self._pyarrow.Table.from_arrays(
+            [self._pyarrow.array(column, type=field.type)
+             for column, field in zip(columns, self._schema)],
+            schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+EXPORTERS = {
+    'graphml': GraphMLExporter,
+    'sif': SIFExporter,
+    'edges': EdgeTableExporter,
+    'parquet': ParquetEdgeExporter,
+    'nodes': NodeTableExporter
+}
+"""
+Exporter of each of the EXPORT_SUFFIXES formats
+"""
+
+
+def get_missing_export_modules(export_format):
+    """
+    Gets the optional modules needed by export_format that cannot be
+    imported
+    """
+    missing = []
+    for module_name in EXPORTERS[export_format].REQUIRES:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            missing.append(module_name)
+    return missing
+
+
+class NetworkExport(object):
+    """
+    Fans the batches of nodes and edges of a network out to the exporters
+    of several formats
+    """
+    def __init__(self, load_plan, file_path_prefix, formats):
+        """
+        :param load_plan: load plan the network is made with, as a dict
+        :param file_path_prefix: path the EXPORT_SUFFIXES are appended to
+        :param formats: formats to write, keys of EXPORTERS
+        """
+        node_attributes = []
+        for node_plan in ['source_plan', 'target_plan']:
+            for attribute in get_plan_attributes(load_plan.get(node_plan, {})):
+                if attribute[0] not in [name for name, _ in node_attributes]:
+                    node_attributes.append(attribute)
+        edge_attributes = get_plan_attributes(load_plan.get('edge_plan', {}))
+        self.exporters = []
+        try:
+            for export_format in formats:
+                self.exporters.append(EXPORTERS[export_format](
+                    file_path_prefix + EXPORT_SUFFIXES[export_format],
+                    node_attributes, edge_attributes))
+        except Exception:
+            self.close()
+            raise
+        self.edges = 0
+
+    def write_batch(self, nodes, edges):
+        self.edges += len(edges)
+        for exporter in self.exporters:
+            exporter.write_batch(nodes, edges)
+
+    def close(self):
+        """
+        Closes the exporters
+        :return: paths of the files written
+        """
+        for exporter in self.exporters:
+            exporter.close()
+        return [exporter.file_path for exporter in self.exporters]
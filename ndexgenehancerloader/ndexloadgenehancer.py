@@ -1,29 +1,55 @@
 #! /usr/bin/env python
 
 import argparse
-from copy import deepcopy
+import bz2
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import copy
 import csv
 from datetime import datetime
+import functools
+import gzip
+import hashlib
+import heapq
 import json
+import io
 import logging
-from logging import config
+import logging.config
+import lzma
 import os
+import random
 import re
+import shutil
 import sys
-import traceback
+import tempfile
+import time
+import zlib
 
-import mygene
-import pandas as pd
-import xlrd
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the gene types cache is written
+    # atomically but without locking
+    fcntl = None
 
-import ndex2
-from ndex2.client import Ndex2
-from ndexutil.tsv.streamtsvloader import StreamTSVLoader
+# mygene, ndex2, xlrd, openpyxl, pyarrow, requests and the ndexutil tsv
+# loader are imported
+# where they are used so that --help and processes that never reach those
+# stages do not pay for importing them (or need them installed)
 from ndexutil.config import NDExUtilConfig
 import ndexgenehancerloader
+from ndexgenehancerloader.exporters import (EXPORT_SUFFIXES, NetworkExport,
+                                            get_missing_export_modules)
+from ndexgenehancerloader.profiling import (PROFILE_TOP, RunMetrics,
+                                            StageProfiler)
+from ndexgenehancerloader.store import EdgeStore, EnhancerIndex, format_float32
 
 logger = logging.getLogger(__name__)
-mg = mygene.MyGeneInfo()
+
+mg = None
+"""
+mygene.info client, created by _get_mygene_client() on first use
+"""
 
 LOG_FORMAT = "%(asctime)-15s %(levelname)s %(relativeCreated)dms " \
              "%(filename)s::%(funcName)s():%(lineno)d %(message)s"
@@ -50,6 +76,17 @@ GENE_TYPES = 'genetypes.json'
 Default name of gene type file
 """
 
+CACHE_DIR = 'ndexgenehancerloader'
+"""
+Name of the directory, in the user cache directory, that holds the gene
+types learned by all runs
+"""
+
+LOCK_SUFFIX = '.lock'
+"""
+Suffix of the lock file held while the gene types cache is updated
+"""
+
 NETWORK_ATTRIBUTES = 'networkattributes.json'
 """
 Default network attributes file name
@@ -65,13 +102,170 @@ UUID = 'uuid'
 Profile element for network UUIDs
 """
 
+UPLOAD_RETRIES = 3
+"""
+Default number of times a failed upload is retried
+"""
+
+UPLOAD_BACKOFF = 2.0
+"""
+Default base delay in seconds between upload retries
+"""
+
+VERIFY_TIMEOUT = 600
+"""
+Seconds to wait for NDEx to finish processing an uploaded network
+"""
+
+CX_TAIL_SIZE = 65536
+"""
+Number of bytes read from the end of a CX file to find its post-metadata
+"""
+
+SNIFF_SIZE = 65536
+"""
+Bytes read from the start of an input file, after decompression, to
+detect its format
+"""
+
+COMPRESSIONS = [
+    (b'\x1f\x8b', gzip.open, '.gz'),
+    (b'BZh', bz2.open, '.bz2'),
+    (b'\xfd7zXZ\x00', lzma.open, '.xz')
+]
+"""
+Compressed input files as (magic bytes, opener, file name suffix)
+"""
+
+READER_ENTRY_POINTS = 'ndexgenehancerloader.readers'
+"""
+Entry point group through which other packages add InputReaders
+"""
+
+GZIP_LEVEL = 6
+"""
+Compression level used for gzipped CX files and uploads
+"""
+
+GZIP_CHUNK_SIZE = 1048576
+"""
+Number of bytes compressed at a time when gzipping an upload
+"""
+
 RESULT_PREFIX = '_result_'
 INTERMEDIARY_PREFIX = '_intermediary_'
 GENE_TYPES_PREFIX = '_genetypes_'
+QUARANTINE_PREFIX = '_quarantine_'
+DIFF_PREFIX = '_diff_'
 """
 Prefixes
 """
 
+INDEX_SUFFIX = '.index.json'
+"""
+Suffix of the enhancer interval index written next to a reformatted file
+"""
+
+REGION_SUFFIX = '_region'
+"""
+Suffix of the reformatted file holding only the enhancers in --region and
+--bed regions
+"""
+
+STORE_SUFFIX = '.store'
+"""
+Suffix of the columnar edge store directory kept with --store
+"""
+
+MERGE_NAME = INTERMEDIARY_PREFIX + 'merged'
+"""
+Name of the file that --merge combines the input files into
+"""
+
+AGGREGATIONS = ['max', 'mean', 'first']
+"""
+Ways --merge can combine the scores of an enhancer-gene pair found more
+than once
+"""
+
+PARTITION_SIZE = 67108864
+"""
+Bytes of input per partition when edges are partitioned by enhancer. Each
+partition is held in memory on its own.
+"""
+
+SORT_CHUNK_ROWS = 262144
+"""
+Rows of a network file sorted in memory at a time when its edges are put
+in order of their source and target nodes. Larger files are sorted in runs
+that are merged.
+"""
+
+SORTED_SUFFIX = '_sorted'
+"""
+Suffix of the network file with its edges in order of their source and
+target nodes, from which the CX is written
+"""
+
+SCRATCH_PREFIX = 'ndexgenehancerloader-'
+"""
+Prefix of the directory a run makes in --scratchdir for its intermediate
+files
+"""
+
+SCRATCH_SPACE_FACTOR = 10
+"""
+Free space, as a multiple of the input size, a load needs for its
+intermediate files: the reformatted file is about 2.5 and the CX about 4.5
+times the size of the input, with room left for converted workbooks and
+merge partitions
+"""
+
+COMPRESSED_INPUT_RATIO = 4
+"""
+Size of the contents of compressed input files, as a multiple of their
+size, assumed when estimating the space needed for intermediate files
+"""
+
+PROGRESS_INTERVAL = 10
+"""
+Minimum seconds between progress messages of a pass over an input file
+"""
+
+PROGRESS_CHECK_ROWS = 1000
+"""
+Rows between looks at the clock to decide whether progress is logged
+"""
+
+SAMPLE_SEED = 0
+"""
+Seed of the random numbers --sample and --samplefraction draw, so that
+the same input always gives the same preview network
+"""
+
+WATCH_INTERVAL = 10
+"""
+Default seconds between polls of the data directory in --watch mode
+"""
+
+WATCH_SETTLE_TIME = 30
+"""
+Default seconds the size and modification time of a new file must stay
+the same before --watch mode loads it
+"""
+
+WATCH_STATE_FILE = '.ndexgenehancerloader_watch.json'
+"""
+File in the data directory recording the files --watch mode has loaded
+"""
+
+UPLOAD_STATE_FILE = '.ndexgenehancerloader_uploads.json'
+"""
+File in the data directory recording the fingerprint of the network last
+uploaded to each account, so that an unchanged network is not uploaded
+again
+"""
+
 DEFAULT_HEADER = [
     'chrom',
     'source',
@@ -100,12 +294,90 @@ OUTPUT_HEADER = [
     "GeneGeneType"
 ]
 
+DIFF_HEADER = OUTPUT_HEADER + ['ChangeType', 'PreviousGeneEnhancerScore']
+"""
+Columns of the reformatted file of a --diff network
+"""
+
+CHANGE_TYPES = ['added', 'removed', 'rescored']
+"""
+Values of the ChangeType edge attribute of a --diff network
+"""
+
+CHANGE_TYPE_STYLE = {
+    'EDGE_STROKE_UNSELECTED_PAINT': ['#2CA02C', '#D62728', '#1F77B4'],
+    'EDGE_UNSELECTED_PAINT': ['#2CA02C', '#D62728', '#1F77B4'],
+    'EDGE_LINE_TYPE': ['SOLID', 'EQUAL_DASH', 'SOLID']
+}
+"""
+Edge visual properties of a --diff network mapped from ChangeType, with a
+value for each of CHANGE_TYPES
+"""
+
+LAYOUT_WIDTH = 20000.0
+"""
+Width of the cartesianLayout; the largest enhancer start location in the
+network is placed at the right edge
+"""
+
+LAYOUT_ROW_HEIGHT = 600.0
+"""
+Vertical distance between the rows of enhancers of consecutive chromosomes
+"""
+
+LAYOUT_GENE_OFFSET = 250.0
+"""
+Distance genes are placed above the centroid of their enhancers
+"""
+
+LAYOUT_JITTER = 200
+"""
+Height of the band, derived from the node ID, nodes are spread over so
+that nodes at close positions do not hide each other
+"""
+
+STAGE_XL_CONVERSION = 'xl_conversion'
+STAGE_VALIDATION = 'validation'
+STAGE_MERGE = 'merge'
+STAGE_DIFF = 'diff'
+STAGE_REFORMAT = 'reformat'
+STAGE_GENE_TYPING = 'gene_typing'
+STAGE_CX_GENERATION = 'cx_generation'
+STAGE_EXPORT = 'export'
+STAGE_UPLOAD = 'upload'
+"""
+Stage names used in the metrics report
+"""
+
 P_GENECARDS = 'p-genecards:'
 EN_GENECARDS = 'en-genecards:'
 """
 Namespace constants
 """
 
+ENHANCER_ID_PATTERN = '^GH([0-9]{2}|MT|0X|0Y)[A-Z][0-9]+'
+"""
+Pattern of GeneHancer enhancer IDs; other names are taken for genes
+"""
+
+REP_CACHE_SIZE = 262144
+"""
+Number of node names whose represents are memoized. A GeneHancer release
+has about this many distinct enhancers and genes, so most names are
+classified once.
+"""
+
+TYPE_OF_GENE_CACHE_SIZE = 1024
+"""
+Number of mygene.info type_of_gene values whose gene types are memoized;
+mygene.info uses a few dozen
+"""
+
+QUARANTINE_HEADER = ['line', 'problems']
+"""
+Columns that precede the input columns of rows in a quarantine file
+"""
+
 ENHANCER = 'enhancer'
 GENE = 'gene'
 """
@@ -136,6 +408,60 @@ TYPE_OF_GENE_TO_GENE_TYPE_MAP = {
     ]
 }
 
+_ENHANCER_ID_REGEX = re.compile(ENHANCER_ID_PATTERN)
+
+_TYPE_OF_GENE_REGEXES = [
+    (key, re.compile(regex))
+    for key, regexes in TYPE_OF_GENE_TO_GENE_TYPE_MAP.items()
+    for regex in regexes]
+
+
+@functools.lru_cache(maxsize=REP_CACHE_SIZE)
+def _get_node_rep(node_id):
+    """
+    Gets the represents of a node, in the en-genecards namespace for
+    enhancers and the p-genecards namespace for genes
+    """
+    if _ENHANCER_ID_REGEX.match(node_id):
+        return EN_GENECARDS + node_id
+    return P_GENECARDS + node_id
+
+
+@functools.lru_cache(maxsize=TYPE_OF_GENE_CACHE_SIZE)
+def _map_type_of_gene(original_gene_type):
+    """
+    Maps a mygene.info type_of_gene to a key of
+    TYPE_OF_GENE_TO_GENE_TYPE_MAP, or None if it matches none
+    """
+    for key, regex in _TYPE_OF_GENE_REGEXES:
+        if regex.match(original_gene_type):
+            return key
+    return None
+
+
+_MEMOIZED = {
+    'rep': _get_node_rep,
+    'type_of_gene': _map_type_of_gene
+}
+"""
+Memoized functions by the name their counters are reported under
+"""
+
+
+def get_cache_stats():
+    """
+    Gets the hits, misses, size and maximum size of the memoized
+    classification functions since the process started
+    :return: dict of name in _MEMOIZED to dict of counters
+    """
+    stats = {}
+    for name, function in _MEMOIZED.items():
+        info = function.cache_info()
+        stats[name] = {'hits': info.hits, 'misses': info.misses,
+                       'size': info.currsize, 'maxsize': info.maxsize}
+    return stats
+
+
 def get_package_dir():
     """
     Gets directory where package is installed
@@ -143,45 +469,152 @@ def get_package_dir():
     """
     return os.path.dirname(ndexgenehancerloader.__file__)
 
+
+def _get_mygene_client():
+    """
+    Gets the mygene.info client, creating it the first time it is needed
+    """
+    global mg
+    if mg is None:
+        import mygene
+        mg = mygene.MyGeneInfo()
+    return mg
+
+
 def _get_default_data_dir_name():
     """
     Gets default data directory
     """
     return _get_path(DATA_DIR)
 
+
 def _get_default_load_plan_name():
     """
     Gets load plan stored with this package
     """
     return _get_path(os.path.join(get_package_dir(), LOAD_PLAN))
 
+
 def _get_default_style_file_name():
     """
     Gets style network name
     """
     return _get_path(os.path.join(get_package_dir(), STYLE_FILE))
 
+
 def _get_default_network_attributes_name():
     """
     Gets network attributes file name
     """
     return _get_path(os.path.join(get_package_dir(), NETWORK_ATTRIBUTES))
 
+
 def _get_default_configuration_name():
     """
     Gets default configuration file
     """
     return _get_path(os.path.join('~/', NDExUtilConfig.CONFIG_FILE))
 
+
 def _get_default_profile_name():
     return PROFILE
 
+
+def _get_cache_dir():
+    """
+    Gets the directory of this package in the user cache directory
+    ($XDG_CACHE_HOME, or ~/.cache if that is not set)
+    """
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join('~', '.cache'))
+    return _get_path(os.path.join(cache_home, CACHE_DIR))
+
+
 def _get_default_gene_types_name():
+    """
+    Gets the gene types file shared by all runs, in the user cache directory
+    """
+    return os.path.join(_get_cache_dir(), GENE_TYPES)
+
+
+def _get_packaged_gene_types_name():
+    """
+    Gets the gene types file stored with this package, which seeds the
+    shared gene types file
+    """
     return _get_path(os.path.join(get_package_dir(), GENE_TYPES))
 
+
+def _read_gene_types_file(file_path):
+    """
+    Reads a gene types file. The shared gene types file falls back to the
+    one stored with this package until a run has written it.
+    """
+    if (not os.path.exists(file_path) and
+            file_path == _get_default_gene_types_name()):
+        file_path = _get_packaged_gene_types_name()
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+@contextmanager
+def _locked(file_path):
+    """
+    Holds an exclusive lock on file_path (through a LOCK_SUFFIX file next
+    to it) for the body of the with statement
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path + LOCK_SUFFIX, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _write_json_atomically(file_path, obj):
+    """
+    Writes obj as JSON to a temporary file next to file_path and renames it
+    over file_path, so readers never see a partially written file
+    """
+    directory, file_name = os.path.split(file_path)
+    temp_file = tempfile.NamedTemporaryFile('w', dir=directory,
+                                            prefix='.' + file_name,
+                                            suffix='.tmp', delete=False)
+    try:
+        with temp_file:
+            json.dump(obj, temp_file, indent=4)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_file.name, file_path)
+    except BaseException:
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+        raise
+
+
 def _get_path(file):
     return os.path.realpath(os.path.expanduser(file))
 
+
+def _parse_targets(targets):
+    """
+    Parses --targets values of the form PROFILE or PROFILE:UUID
+    :return: list of dicts with the profile and update UUID (or None) of
+             every target, or None if targets is None
+    """
+    if targets is None:
+        return None
+    parsed = []
+    for target in targets:
+        profile, _, update_uuid = target.partition(':')
+        parsed.append({'profile': profile,
+                       'update_uuid': update_uuid or None})
+    return parsed
+
+
 def _parse_arguments(desc, args):
     """
     Parses command line arguments
@@ -193,7 +626,7 @@ def _parse_arguments(desc, args):
     parser = argparse.ArgumentParser(description=desc,
                                      formatter_class=helpFormatter)
     parser.add_argument(
-        '--datadir', 
+        '--datadir',
         default=_get_default_data_dir_name(),
         help='Directory that GeneHancer data is found and processed in '
              '(default ' + DATA_DIR + ')'
@@ -202,8 +635,8 @@ def _parse_arguments(desc, args):
         '--updateuuid',
         '--update',
         default=None,
-        help='The UUID of the network that is going to be updated. None of the '
-             'network\'s properties or style will be affected unless the '
+        help='The UUID of the network that is going to be updated. None of '
+             'the network\'s properties or style will be affected unless the '
              '--version, --stylefile, or --styleprofile options are used.'
     )
     parser.add_argument(
@@ -212,31 +645,43 @@ def _parse_arguments(desc, args):
         help='Version number of the new network'
     )
     parser.add_argument(
-        '--loadplan', 
+        '--loadplan',
         default=_get_default_load_plan_name(),
         help='Load plan file that should be used (default ' + LOAD_PLAN + ')'
     )
     parser.add_argument(
-        '--stylefile', 
+        '--stylefile',
         default=None,
         help='Name of template network file whose style should be used '
              '(default ' + STYLE_FILE + ')'
     )
     parser.add_argument(
-        '--conf', 
+        '--conf',
         default=_get_default_configuration_name(),
-        help='Configuration file to load (default ~/' 
+        help='Configuration file to load (default ~/'
              + NDExUtilConfig.CONFIG_FILE + ')')
     parser.add_argument(
-        '--profile', 
+        '--profile',
         default=_get_default_profile_name(),
-        help='Profile in configuration file to use to load NDEx credentials ' 
+        help='Profile in configuration file to use to load NDEx credentials '
              'which means configuration under [XXX] will be used '
              '(default ndexgenehancerloader)')
+    parser.add_argument(
+        '--targets',
+        nargs='+',
+        default=None,
+        metavar='PROFILE[:UUID]',
+        help='Profiles in configuration file of the NDEx accounts to upload '
+             'the network to, each optionally followed by a colon and the '
+             'UUID of the network to update there. The network is generated '
+             'once and uploaded to all targets at the same time. Replaces '
+             '--profile and --updateuuid; the first target is used wherever '
+             'those are')
     parser.add_argument(
         '--styleprofile',
         default=None,
-        help='Profile in configuration file to use to load template network for'
+        help='Profile in configuration file to use to load template '
+             'network for'
              'style. The following format should be used:'
              '[<value in --styleprofile>]'
              'user = <NDEx username>'
@@ -244,53 +689,289 @@ def _parse_arguments(desc, args):
              'server = <NDEx server>'
              'uuid = <UUID of template network>'
              ''
-             'If --styleprofile and --stylefile are both used, --stylefile will'
+             'If --styleprofile and --stylefile are both used, --stylefile '
+             'will'
              ' take precedence')
     parser.add_argument(
         '--genetypes',
         default=None,
-        help='Json file that will be used to determine the types of genes.'
-             '(default ' + GENE_TYPES + ')'
+        help='Json file that will be used to determine the types of genes. '
+             'By default, gene types are read from and learned gene types '
+             'added to a file shared by all runs, ' + GENE_TYPES +
+             ' in the ' + CACHE_DIR + ' directory of the user cache '
+             'directory ($XDG_CACHE_HOME or ~/.cache), which starts as a '
+             'copy of the ' + GENE_TYPES + ' of this package'
     )
     parser.add_argument(
         '--networkattributes',
         default=None,
-        help='Json file containing the network\'s attributes. (default ' + 
+        help='Json file containing the network\'s attributes. (default ' +
              NETWORK_ATTRIBUTES + ')'
     )
     parser.add_argument(
         '--delimiter',
         default=None,
-        help='Delimiter of the data file. (Default: \'comma\' for .csv files, \'tab\' otherwise)'
+        help='Delimiter of the data file. (Default: sniffed from the '
+             'start of each file)'
     )
     parser.add_argument(
-        '--logconf', 
+        '--logconf',
         default=None,
         help='Path to python logging configuration file in this format: '
-             'https://docs.python.org/3/library/logging.config.html#logging-config-fileformat'
-             '. Setting this overrides -v parameter which uses default logger. '
-             '(default None)')
+             'https://docs.python.org/3/library/logging.config.html'
+             '#logging-config-fileformat'
+             '. Setting this overrides -v parameter which uses default '
+             'logger. (default None)')
     parser.add_argument(
-        '--verbose', 
-        '-v', 
-        action='count', 
+        '--verbose',
+        '-v',
+        action='count',
         default=0,
-        help='Increases verbosity of logger to standard error for log messages '
-        'in this module and in ' + TSV2NICECXMODULE + '. Messages are output '
-        'at these python logging levels -v = ERROR, -vv = WARNING, -vvv = INFO, '
-        '-vvvv = DEBUG, -vvvvv = NOTSET (default no logging)')
+        help='Increases verbosity of logger to standard error for log '
+        'messages in this module and in ' + TSV2NICECXMODULE + '. Messages '
+        'are output at these python logging levels -v = ERROR, -vv = '
+        'WARNING, -vvv = INFO, -vvvv = DEBUG, -vvvvv = NOTSET (default no '
+        'logging)')
     parser.add_argument(
-        '--noheader', 
-        action='store_true', 
+        '--noheader',
+        action='store_true',
         default=False,
         help='If set, assumes there is no header in the data file and uses a '
-             'default set of headers')
+             'default set of headers. (Default: a header is detected by '
+             'whether the first row holds a numeric start location)')
     parser.add_argument(
-        '--nocleanup', 
-        action='store_true', 
+        '--minscore',
+        type=float,
+        default=None,
+        help='If set, gene-enhancer associations with a GeneEnhancerScore '
+             'below this value are left out of the network')
+    parser.add_argument(
+        '--minconfidence',
+        type=float,
+        default=None,
+        help='If set, enhancers with an EnhancerConfidenceScore below this '
+             'value are left out of the network')
+    parser.add_argument(
+        '--topgenes',
+        type=int,
+        default=None,
+        help='If set, only the associations with the highest '
+             'GeneEnhancerScore are kept for each enhancer, this many at most')
+    parser.add_argument(
+        '--topenhancers',
+        type=int,
+        default=None,
+        help='If set, only the associations with the highest '
+             'GeneEnhancerScore are kept for each gene, this many at most. '
+             'Needs an extra pass over the input file')
+    sample = parser.add_mutually_exclusive_group()
+    sample.add_argument(
+        '--sample',
+        type=int,
+        default=None,
+        help='If set, a preview network is loaded with only this many '
+             'enhancers, with all their genes. Enhancers are sampled at '
+             'random within each chromosome and enhancer type, in '
+             'proportion to the number of enhancers of each')
+    sample.add_argument(
+        '--samplefraction',
+        type=float,
+        default=None,
+        help='Like --sample, but loads this fraction (0 to 1) of the '
+             'enhancers of each chromosome and enhancer type')
+    parser.add_argument(
+        '--region',
+        action='append',
+        default=None,
+        help='If set, only enhancers overlapping this region, given as '
+             'chromosome:start-end (1-based, inclusive), are loaded. Can be '
+             'given more than once')
+    parser.add_argument(
+        '--bed',
+        default=None,
+        help='If set, only enhancers overlapping the regions in this BED '
+             'file are loaded')
+    parser.add_argument(
+        '--diff',
+        nargs=2,
+        default=None,
+        metavar=('OLD', 'NEW'),
+        help='Loads a network of the differences between two GeneHancer '
+             'files (paths, or names of files in the data directory) '
+             'instead of the files in the data directory: the '
+             'enhancer-gene edges that were added, removed or re-scored in '
+             'NEW, with a ChangeType edge attribute. Counts are written to ' +
+             DIFF_PREFIX + '<NEW>_vs_<OLD>.json in the data directory')
+    parser.add_argument(
+        '--merge',
+        action='store_true',
+        default=False,
+        help='If set, combines all input files in the data directory into '
+             'one network. An enhancer-gene pair found more than once '
+             'becomes one edge, scored as set by --aggregate; enhancers '
+             'keep the location, confidence score and type they have where '
+             'they are first found')
+    parser.add_argument(
+        '--aggregate',
+        choices=AGGREGATIONS,
+        default=AGGREGATIONS[0],
+        help='How --merge scores an enhancer-gene pair found more than '
+             'once: the highest score, the mean score or the score in the '
+             'first file (in alphabetical order) (default ' +
+             AGGREGATIONS[0] + ')')
+    parser.add_argument(
+        '--store',
+        action='store_true',
+        default=False,
+        help='If set, the reformatted edges are kept in a columnar store in '
+             'the data directory (' + RESULT_PREFIX + '*' + STORE_SUFFIX +
+             '), '
+             'and later runs with --store on the same input build their '
+             'network from it instead of parsing and typing the input again')
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        default=False,
+        help='If set, keeps running and loads every file that lands in or '
+             'changes in the data directory, keeping gene types, style, '
+             'network attributes and the NDEx connection loaded between '
+             'files. Stop with Ctrl-C')
+    parser.add_argument(
+        '--watchinterval',
+        type=float,
+        default=WATCH_INTERVAL,
+        help='Seconds between polls of the data directory in --watch mode '
+             '(default ' + str(WATCH_INTERVAL) + ')')
+    parser.add_argument(
+        '--settletime',
+        type=float,
+        default=WATCH_SETTLE_TIME,
+        help='Seconds the size and modification time of a file must stay '
+             'the same before --watch mode loads it (default ' +
+             str(WATCH_SETTLE_TIME) + ')')
+    parser.add_argument(
+        '--validate',
+        action='store_true',
+        default=False,
+        help='If set, checks every row of an input file before loading it '
+             'and lists the rows that are not valid GeneHancer rows, by line '
+             'number. The file is not loaded if any row is invalid, unless '
+             '--quarantine is set')
+    parser.add_argument(
+        '--quarantine',
+        action='store_true',
+        default=False,
+        help='If set, rows of an input file that are not valid GeneHancer '
+             'rows are left out of the network and written, with their line '
+             'numbers and problems, to ' + QUARANTINE_PREFIX +
+             '<file name>.tsv in the data directory, instead of stopping '
+             'the load')
+    parser.add_argument(
+        '--nocleanup',
+        action='store_true',
         default=False,
         help='If set, intermediary files generated in the data directory will '
              'not be removed')
+    parser.add_argument(
+        '--cxfile',
+        default=None,
+        help='Previously generated CX file to upload. If set, the data '
+             'directory is not processed and only the upload is performed')
+    parser.add_argument(
+        '--uploadretries',
+        type=int,
+        default=UPLOAD_RETRIES,
+        help='Number of times a failed upload is retried. Saving a new '
+             'network is only retried if NDEx could not be connected to or '
+             'answered 429, as it may have saved the network before failing '
+             '(default ' + str(UPLOAD_RETRIES) + ')')
+    parser.add_argument(
+        '--uploadbackoff',
+        type=float,
+        default=UPLOAD_BACKOFF,
+        help='Base delay in seconds between upload retries. The delay doubles '
+             'after every failed attempt and is randomized (default ' +
+             str(UPLOAD_BACKOFF) + ')')
+    parser.add_argument(
+        '--gzipupload',
+        action='store_true',
+        default=False,
+        help='If set, the CX network is gzip compressed on the fly while it '
+             'is uploaded and sent with Content-Encoding: gzip. NDEx 1.x '
+             'servers are sent the network uncompressed')
+    parser.add_argument(
+        '--nolayout',
+        action='store_true',
+        default=False,
+        help='If set, the network is written without a cartesianLayout '
+             'aspect. By default enhancers are laid out in one row per '
+             'chromosome, by start location, with every gene above the '
+             'centroid of its enhancers')
+    parser.add_argument(
+        '--scratchdir',
+        default=None,
+        help='Directory the intermediate files of a run (converted '
+             'workbooks, reformatted files, partitions and the CX) are '
+             'written to. A '
+             'directory made for the run there is removed when the run '
+             'ends. With --nocleanup the intermediate files are kept in the '
+             'data directory instead. (Default: the system temporary '
+             'directory)')
+    parser.add_argument(
+        '--export',
+        nargs='+',
+        default=None,
+        choices=sorted(EXPORT_SUFFIXES),
+        help='Formats to also write the network in, in the same pass that '
+             'writes the CX: graphml, sif, edges (tab separated edge list), '
+             'parquet (edge list; needs pyarrow) and nodes (tab separated '
+             'node table). The files are written to the data directory as '
+             + RESULT_PREFIX + '<name> with the suffix of their format and '
+             'are kept after the upload. A format whose module is not '
+             'installed is left out with a warning')
+    parser.add_argument(
+        '--gzipcx',
+        action='store_true',
+        default=False,
+        help='If set, the CX network is written gzip compressed (' +
+             RESULT_PREFIX + '*.cx.gz). It is kept in the data directory '
+             'with --nocleanup')
+    parser.add_argument(
+        '--metricsout',
+        default=None,
+        help='If set, a JSON report with the wall time, CPU time, rows in, '
+             'edges out and bytes written of every stage is written to this '
+             'file at the end of the run')
+    parser.add_argument(
+        '--profilecpu',
+        default=None,
+        help='If set, every stage is profiled with cProfile. Stats for the '
+             'whole run are written to this file, stats for each stage to '
+             '<file>.<stage> and the ' + str(PROFILE_TOP) + ' hottest '
+             'functions of each stage to <file>.txt')
+    parser.add_argument(
+        '--profilemem',
+        default=None,
+        help='If set, memory allocations are traced with tracemalloc. A '
+             'snapshot at the end of the run is written to this file, one '
+             'at the end of each stage to <file>.<stage> and the peak '
+             'memory and ' + str(PROFILE_TOP) + ' largest allocation sites '
+             'of each stage to <file>.txt')
+    parser.add_argument(
+        '--noverify',
+        action='store_true',
+        default=False,
+        help='If set, the node and edge counts of the uploaded network are '
+             'not checked against the CX file')
+    parser.add_argument(
+        '--skipunchanged',
+        action='store_true',
+        default=False,
+        help='If set, the SHA-256 fingerprint of every network uploaded is '
+             'recorded in ' + UPLOAD_STATE_FILE + ' in the data directory, '
+             'and a network with the same fingerprint as the network last '
+             'uploaded to the same account (and --updateuuid network) is not '
+             'uploaded again')
 
     return parser.parse_args(args)
 
@@ -307,7 +988,7 @@ def _setup_logging(args):
     """
 
     if args.logconf is None:
-        level = (50 - (10 * args.verbose))        
+        level = (50 - (10 * args.verbose))
         logging.basicConfig(format=LOG_FORMAT, level=level)
         logging.getLogger(TSV2NICECXMODULE).setLevel(level)
         logger.setLevel(level)
@@ -316,36 +997,1045 @@ def _setup_logging(args):
     logging.config.fileConfig(args.logconf, disable_existing_loggers=False)
 
 
-class NDExGeneHancerLoader(object):
+def _open_cx_file(file_path, mode):
     """
-    Class to load content
+    Opens a CX file, transparently handling gzip compressed (.gz) files
+    :param file_path: path to CX file
+    :param mode: mode to open file in, such as 'rb' or 'wt'
+    :return: file object
     """
-    def __init__(self, args):
-        """
-        :param args:
-        """
-        self._data_directory = _get_path(args.datadir)
-        self._conf_file = args.conf
-        self._load_plan_file = args.loadplan
-        self._style_file = args.stylefile
-        self._network_attributes_file = args.networkattributes
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, mode, compresslevel=GZIP_LEVEL)
+    return open(file_path, mode)
+
+
+def _iter_gzip(stream, stats):
+    """
+    Reads stream to the end, yielding it gzip compressed one chunk at a time
+    :param stream: object with a read(size) method returning bytes
+    :param stats: dict whose 'raw' and 'compressed' byte counts are updated
+    :return: generator of compressed chunks
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    while True:
+        chunk = stream.read(GZIP_CHUNK_SIZE)
+        if not chunk:
+            break
+        stats['raw'] += len(chunk)
+        compressed = compressor.compress(chunk)
+        if compressed:
+            stats['compressed'] += len(compressed)
+            yield compressed
+    compressed = compressor.flush()
+    stats['compressed'] += len(compressed)
+    yield compressed
+
+
+def _get_uncompressed_size(file_path):
+    """
+    Gets the size of a file's contents, decompressing it if it is gzipped
+    :param file_path: path to file
+    :return: size in bytes
+    """
+    if not file_path.endswith('.gz'):
+        return os.path.getsize(file_path)
+    size = 0
+    with gzip.open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(GZIP_CHUNK_SIZE), b''):
+            size += len(chunk)
+    return size
+
+
+def _get_cx_fingerprint(file_path):
+    """
+    Gets the SHA-256 digest of a CX file's contents, decompressing it if
+    it is gzipped, reading it one chunk at a time
+    :param file_path: path to CX file
+    :return: digest as a hex string
+    """
+    digest = hashlib.sha256()
+    with _open_cx_file(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(GZIP_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_connect_error(error):
+    """
+    Tells whether a requests error happened while connecting (connection
+    refused or connect timeout), before anything was sent to the server
+    """
+    import requests
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    # requests wraps the urllib3 error, which wraps the socket error
+    causes = [error]
+    seen = set()
+    while causes:
+        cause = causes.pop()
+        if id(cause) in seen:
+            continue
+        seen.add(id(cause))
+        if (isinstance(cause, ConnectionRefusedError) or
+                type(cause).__name__ == 'NewConnectionError'):
+            return True
+        causes.extend(arg for arg in cause.args
+                      if isinstance(arg, BaseException))
+        for nested in [getattr(cause, 'reason', None), cause.__cause__,
+                       cause.__context__]:
+            if isinstance(nested, BaseException):
+                causes.append(nested)
+    return False
+
+
+@contextmanager
+def _scratch_directory(parent=None):
+    """
+    Makes a directory for intermediate files in parent, the system
+    temporary directory by default, and removes it with everything in it
+    when the with statement ends
+    :return: context manager giving the path of the directory
+    """
+    path = tempfile.mkdtemp(prefix=SCRATCH_PREFIX, dir=parent)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class _TempFiles(object):
+    """
+    Intermediate files of a load, removed when the with statement ends,
+    whether or not the load succeeded, unless they are to be kept
+    """
+    def __init__(self, keep=False):
+        self.keep = keep
+        self._paths = []
+
+    def add(self, path):
+        """
+        Adds a file to remove
+        :return: path
+        """
+        if path is not None:
+            self._paths.append(path)
+        return path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if not self.keep:
+            for path in self._paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return False
+
+
+def _estimate_input_size(file_path):
+    """
+    Estimates the size of the contents of an input file, which is larger
+    than the file if it is compressed
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        magic = f.read(8)
+    if any(magic.startswith(prefix) for prefix, _, _ in COMPRESSIONS):
+        return size * COMPRESSED_INPUT_RATIO
+    return size
+
+
+@contextmanager
+def _open_input_file(file_path):
+    """
+    Opens an input file for reading bytes, decompressing it if it is gzip,
+    bzip2 or xz compressed
+    :return: context manager giving a tuple of (file on disk, decompressed
+             stream); the tell() of the file on disk is how much of it has
+             been read
+    """
+    raw = open(file_path, 'rb')
+    try:
+        magic = raw.read(8)
+        raw.seek(0)
+        stream = raw
+        for prefix, opener, _ in COMPRESSIONS:
+            if magic.startswith(prefix):
+                stream = opener(raw, 'rb')
+                break
+        try:
+            yield raw, stream
+        finally:
+            stream.close()
+    finally:
+        raw.close()
+
+
+def _is_header_row(row):
+    """
+    Tells a header from a GeneHancer row, whose start location, in the
+    fourth column, is a number
+    """
+    if row and row[0].startswith('#'):
+        return True
+    try:
+        float(row[3])
+        return False
+    except (IndexError, ValueError):
+        return True
+
+
+class InputReader(object):
+    """
+    Reads input files of one format as rows of strings. A reader is asked
+    whether it can read a file by sniff(), then reads it with read().
+    Readers are added with register_input_reader(), or by other packages
+    through the READER_ENTRY_POINTS entry point group with an InputReader
+    subclass or instance.
+    """
+    name = None
+
+    def sniff(self, file_name, head):
+        """
+        Checks whether a file is in the format of this reader
+        :param file_name: name of the file
+        :param head: first SNIFF_SIZE bytes of the file, decompressed
+        :return: dict of options to pass to read(), or None if this reader
+                 cannot read the file
+        """
+        raise NotImplementedError
+
+    def read(self, stream, options):
+        """
+        Reads all rows of a file, including the header if it has one
+        :param stream: decompressed binary stream of the file
+        :param options: dict returned by sniff()
+        :return: iterator of rows, each a list of strings
+        """
+        raise NotImplementedError
+
+
+class DelimitedReader(InputReader):
+    """
+    Reads GeneHancer GFF/TSV exports and other delimiter separated text
+    files. The delimiter is the first of DELIMITERS found the same number
+    of times on every line of the sniffed head.
+    """
+    name = 'delimited'
+    DELIMITERS = ['\t', ',', ';', '|']
+
+    def sniff(self, file_name, head):
+        if b'\x00' in head:
+            return None
+        try:
+            text = head.decode('utf-8-sig')
+        except UnicodeDecodeError as e:
+            # The head may end in the middle of a character
+            text = head[:e.start].decode('utf-8-sig', errors='ignore')
+        lines = text.splitlines()
+        if len(head) >= SNIFF_SIZE and len(lines) > 1:
+            lines = lines[:-1]
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return {'delimiter': '\t'}
+        for delimiter in self.DELIMITERS:
+            counts = set(line.count(delimiter) for line in lines)
+            if len(counts) == 1 and 0 not in counts:
+                return {'delimiter': delimiter}
+        return {'delimiter': max(self.DELIMITERS, key=lines[0].count)}
+
+    def read(self, stream, options):
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        for row in csv.reader(text, delimiter=options['delimiter']):
+            yield row
+
+
+class ExcelReader(InputReader):
+    """
+    Reads the first sheet of an Excel workbook, xlsx with openpyxl and xls
+    with xlrd
+    """
+    name = 'excel'
+    XLSX_MAGIC = b'PK\x03\x04'
+    XLS_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+    def sniff(self, file_name, head):
+        if head.startswith(self.XLSX_MAGIC) and b'xl/' in head:
+            return {'xlsx': True}
+        if head.startswith(self.XLS_MAGIC):
+            return {'xlsx': False}
+        return None
+
+    def read(self, stream, options):
+        if options['xlsx']:
+            import openpyxl
+            workbook = openpyxl.load_workbook(io.BytesIO(stream.read()),
+                                              read_only=True, data_only=True)
+            try:
+                rows = workbook.worksheets[0].iter_rows(values_only=True)
+                for values in rows:
+                    yield ['' if value is None else str(value)
+                           for value in values]
+            finally:
+                workbook.close()
+            return
+        import xlrd
+        sheet = xlrd.open_workbook(
+            file_contents=stream.read()).sheet_by_index(0)
+        for row_num in range(sheet.nrows):
+            yield [str(value) for value in sheet.row_values(row_num)]
+
+
+class ArrowReader(InputReader):
+    """
+    Reads Parquet and Arrow IPC (Feather version 2) files with pyarrow. The
+    column names are read as the header.
+    """
+    name = 'arrow'
+    PARQUET_MAGIC = b'PAR1'
+    ARROW_MAGIC = b'ARROW1'
+
+    def sniff(self, file_name, head):
+        if head.startswith(self.PARQUET_MAGIC):
+            return {'parquet': True}
+        if head.startswith(self.ARROW_MAGIC):
+            return {'parquet': False}
+        return None
+
+    def read(self, stream, options):
+        if options['parquet']:
+            import pyarrow.parquet
+            table_file = pyarrow.parquet.ParquetFile(stream)
+            names = table_file.schema_arrow.names
+            batches = table_file.iter_batches()
+        else:
+            import pyarrow.ipc
+            table_file = pyarrow.ipc.open_file(stream)
+            names = table_file.schema.names
+            batches = (table_file.get_batch(i)
+                       for i in range(table_file.num_record_batches))
+        yield list(names)
+        for batch in batches:
+            columns = [column.to_pylist() for column in batch.columns]
+            for values in zip(*columns):
+                yield ['' if value is None else str(value) for value in values]
+
+
+_input_readers = []
+_input_reader_plugins_loaded = False
+
+
+def register_input_reader(reader):
+    """
+    Adds an InputReader. Readers added later are asked first, so they can
+    take over files the built in readers would read.
+    :param reader: InputReader subclass or instance
+    """
+    if isinstance(reader, type):
+        reader = reader()
+    _input_readers.insert(0, reader)
+
+
+def _load_input_reader_plugins():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return
+    try:
+        plugins = entry_points(group=READER_ENTRY_POINTS)
+    except TypeError:
+        # Python before 3.10
+        plugins = entry_points().get(READER_ENTRY_POINTS, [])
+    for plugin in plugins:
+        try:
+            register_input_reader(plugin.load())
+        except Exception as e:
+            logger.warning('Unable to load input reader ' + plugin.name +
+                           ': ' + str(e))
+
+
+def get_input_readers():
+    """
+    Gets the InputReaders in the order they are asked to read a file,
+    loading the READER_ENTRY_POINTS plugins the first time
+    """
+    global _input_reader_plugins_loaded
+    if not _input_reader_plugins_loaded:
+        _input_reader_plugins_loaded = True
+        _load_input_reader_plugins()
+    return list(_input_readers)
+
+
+register_input_reader(DelimitedReader)
+register_input_reader(ExcelReader)
+register_input_reader(ArrowReader)
+
+
+class _SizedReader(object):
+    """
+    Wraps a binary stream whose length cannot be taken from the file system,
+    such as a gzip file, so that requests and MultipartEncoder can tell how
+    many bytes are left to read
+    """
+    def __init__(self, stream, size):
+        self._stream = stream
+        self.len = size
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.len -= len(data)
+        return data
+
+
+class _RowValidator(object):
+    """
+    Checks rows of an input file against the GeneHancer format: the number
+    of columns, numeric coordinates and scores, and the grammar of the
+    attributes column (genehancer_id=<enhancer ID> followed by
+    connected_gene=<gene>;score=<score> pairs)
+    """
+    def __init__(self, header):
+        """
+        :param header: column names of the input file
+        :raises ValueError: if a column the loader reads is missing
+        """
+        chrom_column = 'chrom' if 'chrom' in header else '#chrom'
+        required = [chrom_column, 'feature name', 'start', 'end', 'score',
+                    'attributes']
+        missing = [column for column in required if column not in header]
+        if missing:
+            raise ValueError('Missing column(s) ' + ', '.join(missing))
+        self._num_columns = len(header)
+        self._chrom = header.index(chrom_column)
+        self._start = header.index('start')
+        self._end = header.index('end')
+        self._score = header.index('score')
+        self._attributes = header.index('attributes')
+        self._enhancer_id = re.compile(ENHANCER_ID_PATTERN)
+
+    def check(self, row):
+        """
+        :return: list of the problems of row, empty if there are none
+        """
+        if len(row) != self._num_columns:
+            return ['{} columns instead of {}'.format(len(row),
+                                                      self._num_columns)]
+        problems = []
+        if not row[self._chrom]:
+            problems.append('empty chromosome')
+        start = self._get_location(row[self._start], 'start', problems)
+        end = self._get_location(row[self._end], 'end', problems)
+        if start is not None and end is not None and start > end:
+            problems.append('start {} is after end {}'.format(start, end))
+        self._check_score(row[self._score], 'score', problems)
+
+        attributes = row[self._attributes].split(';')
+        if len(attributes) > 1 and attributes[-1] == '':
+            attributes.pop()
+        key, _, enhancer_id = attributes[0].partition('=')
+        if key != 'genehancer_id':
+            problems.append('attributes do not start with genehancer_id=')
+        elif not self._enhancer_id.match(enhancer_id):
+            problems.append('invalid enhancer ID "{}"'.format(enhancer_id))
+        if len(attributes) % 2 == 0:
+            problems.append('connected_gene without score')
+        for j in range(1, len(attributes) - 1, 2):
+            key, _, gene = attributes[j].partition('=')
+            if key != 'connected_gene' or not gene:
+                problems.append('invalid gene "{}"'.format(attributes[j]))
+            key, separator, score = attributes[j+1].partition('=')
+            if key != 'score' or not separator:
+                problems.append('invalid score "{}"'.format(attributes[j+1]))
+            else:
+                self._check_score(score, 'score of ' + gene, problems)
+        return problems
+
+    def _get_location(self, value, name, problems):
+        try:
+            location = float(value)
+        except ValueError:
+            location = None
+        if location is None or not location.is_integer() or location < 0:
+            problems.append('{} "{}" is not a location'.format(name, value))
+            return None
+        return location
+
+    def _check_score(self, value, name, problems):
+        try:
+            float(value)
+        except ValueError:
+            problems.append('{} "{}" is not a number'.format(name, value))
+
+
+class _Quarantine(object):
+    """
+    Writes rows that fail validation, with their line numbers and
+    problems, to a tab separated file that is created on the first row
+    """
+    def __init__(self, file_path, header):
+        self.file_path = file_path
+        self.count = 0
+        self._header = header
+        self._file = None
+        self._writer = None
+
+    def add(self, line_number, problems, row):
+        if self._file is None:
+            self._file = open(self.file_path, 'w', encoding='utf-8',
+                              newline='')
+            self._writer = csv.writer(self._file, delimiter='\t')
+            self._writer.writerow(QUARANTINE_HEADER + list(self._header))
+        self._writer.writerow([line_number, '; '.join(problems)] + row)
+        self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _EdgePartitions(object):
+    """
+    Spreads rows over partition files by a hash of their key, so that all
+    rows with the same key can be processed together one partition at a
+    time, in bounded memory. Rows keep the order they were added in.
+    """
+    def __init__(self, directory, count):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.count = count
+        self._files = [open(self._get_path(i), 'w', encoding='utf-8',
+                            newline='')
+                       for i in range(count)]
+        self._writers = [csv.writer(f, delimiter='\t') for f in self._files]
+
+    def _get_path(self, i):
+        return os.path.join(self.directory, 'partition-{:05d}.tsv'.format(i))
+
+    def add(self, key, row):
+        i = zlib.crc32(key.encode('utf-8')) % self.count
+        self._writers[i].writerow(row)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+    def read(self, i):
+        """
+        Reads the rows of partition i; close() first
+        """
+        with open(self._get_path(i), 'r', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f, delimiter='\t'):
+                yield row
+
+    def remove(self):
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _iter_tsv_records(tsv_file):
+    """
+    Reads the records of a tab separated file written by csv.writer
+    :param tsv_file: file opened with newline=''
+    :return: generator of (text, fields) of every record. The text is more
+             than one line if a quoted field has line breaks.
+    """
+    lines = iter(tsv_file)
+    for text in lines:
+        if '"' in text:
+            # Quotes are doubled inside quoted fields, so an odd number of
+            # them means a quoted field goes on on the next line
+            while text.count('"') % 2:
+                next_line = next(lines, '')
+                if not next_line:
+                    break
+                text += next_line
+            fields = next(csv.reader(io.StringIO(text), delimiter='\t'))
+        else:
+            fields = text.rstrip('\r\n').split('\t')
+        if not text.endswith('\n'):
+            text += '\n'
+        yield text, fields
+
+
+def _sort_tsv_records(tsv_file, key, directory=None,
+                      chunk_rows=SORT_CHUNK_ROWS):
+    """
+    Sorts the records of a tab separated file by key, then by their text,
+    in bounded memory. Runs of chunk_rows records are sorted in memory and,
+    if there is more than one, written to temporary files in directory and
+    merged. Records are written back as they were read, not re-quoted.
+    :param tsv_file: file opened with encoding='utf-8' and newline='',
+                     after its header
+    :param key: function of the fields of a record
+    :return: generator of the text of the sorted records
+    """
+    def keyed(f):
+        for text, fields in _iter_tsv_records(f):
+            yield key(fields), text
+
+    runs = []
+    try:
+        chunk = []
+        for record in keyed(tsv_file):
+            chunk.append(record)
+            if len(chunk) >= chunk_rows:
+                chunk.sort()
+                run = tempfile.TemporaryFile('w+', dir=directory,
+                                             encoding='utf-8', newline='')
+                runs.append(run)
+                run.writelines(text for _, text in chunk)
+                chunk = []
+        chunk.sort()
+        if runs:
+            for run in runs:
+                run.seek(0)
+            records = heapq.merge(*[keyed(run) for run in runs], iter(chunk))
+        else:
+            records = chunk
+        for _, text in records:
+            yield text
+    finally:
+        for run in runs:
+            run.close()
+
+
+class _StratifiedSample(object):
+    """
+    Random sample of items, stratified by a key, taken in one pass. Every
+    item gets a random priority and each stratum keeps, as a reservoir, the
+    items with the lowest priorities. With a size, the size is shared out
+    over the strata in proportion to their number of items once all items
+    are added; with a fraction, that fraction of every stratum is kept.
+    """
+    def __init__(self, size=None, fraction=None, seed=SAMPLE_SEED):
+        self._size = size
+        self._fraction = fraction
+        # With a fraction, items are only kept while their priority is
+        # below twice the fraction; far more than any stratum needs
+        self._threshold = None if fraction is None else 2 * fraction
+        self._random = random.Random(seed)
+        self._reservoirs = {}
+        """
+        stratum to list of (-priority, index, item); a heap when size is set
+        """
+        self._counts = {}
+        self.count = 0
+
+    def add(self, stratum, item):
+        priority = self._random.random()
+        entry = (-priority, self.count, item)
+        self.count += 1
+        self._counts[stratum] = self._counts.get(stratum, 0) + 1
+        reservoir = self._reservoirs.setdefault(stratum, [])
+        if self._size is not None:
+            if len(reservoir) < self._size:
+                heapq.heappush(reservoir, entry)
+            elif reservoir and entry > reservoir[0]:
+                heapq.heapreplace(reservoir, entry)
+        elif priority < self._threshold:
+            reservoir.append(entry)
+
+    def _get_stratum_sizes(self):
+        if self._fraction is not None:
+            return {stratum: int(round(count * self._fraction))
+                    for stratum, count in self._counts.items()}
+        size = min(self._size, self.count)
+        shares = {stratum: size * count / self.count
+                  for stratum, count in self._counts.items()}
+        sizes = {stratum: int(share) for stratum, share in shares.items()}
+        # Largest remainders first; ties broken by stratum for determinism
+        remaining = sorted(shares, key=lambda s: (sizes[s] - shares[s], s))
+        for stratum in remaining[:size - sum(sizes.values())]:
+            sizes[stratum] += 1
+        return sizes
+
+    def get(self):
+        """
+        Gets the sampled items, in the order they were added
+        """
+        if self.count == 0:
+            return []
+        sizes = self._get_stratum_sizes()
+        kept = []
+        for stratum, reservoir in self._reservoirs.items():
+            kept.extend(sorted(reservoir, reverse=True)[:sizes[stratum]])
+        return [item for _, _, item in sorted(kept, key=lambda e: e[1])]
+
+
+class _CountingWriter(object):
+    """
+    Wraps a text stream, counting the characters written to it, or the
+    bytes if encoding is set
+    """
+    def __init__(self, stream, encoding=None):
+        self._stream = stream
+        self._encoding = encoding
+        self.count = 0
+
+    def write(self, data):
+        if self._encoding is None or data.isascii():
+            self.count += len(data)
+        else:
+            self.count += len(data.encode(self._encoding))
+        return self._stream.write(data)
+
+    def flush(self):
+        self._stream.flush()
+
+
+class _DigestWriter(io.RawIOBase):
+    """
+    Binary stream that computes the SHA-256 digest of the bytes written
+    through it to another stream
+    """
+    def __init__(self, stream):
+        super(_DigestWriter, self).__init__()
+        self._stream = stream
+        self._digest = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._digest.update(data)
+        self._stream.write(data)
+        return len(data)
+
+    def flush(self):
+        self._stream.flush()
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+def _chromosome_sort_key(chromosome):
+    """
+    Orders chromosomes as 1 to 22, X, Y, M and then any other name
+    """
+    name = chromosome
+    if chromosome.lower().startswith('chr'):
+        name = chromosome[3:]
+    if name.isdigit():
+        return 0, int(name), ''
+    name = name.upper()
+    if name in ('X', 'Y', 'M', 'MT'):
+        return 1, 'XYM'.index(name[0]), ''
+    return 2, 0, name
+
+
+def _layout_jitter(node_id):
+    return (zlib.crc32(str(node_id).encode('utf-8')) % LAYOUT_JITTER -
+            LAYOUT_JITTER / 2)
+
+
+class _ChromosomeLayout(object):
+    """
+    Places enhancers in one row per chromosome, from left to right by start
+    location, and every gene above the centroid of its enhancers. Filled one
+    edge at a time while the CX is written; the same edges always give the
+    same layout.
+    """
+    def __init__(self):
+        self._enhancers = {}
+        """
+        enhancer node ID to (chromosome, start location)
+        """
+        self._genes = {}
+        """
+        gene node ID to {chromosome: [sum of enhancer starts, enhancer count]}
+        """
+        self._max_start = 0
+
+    def add(self, enhancer_id, gene_id, chromosome, start):
+        """
+        Adds an edge; edges without a chromosome or start location are not
+        used for the layout
+        """
+        try:
+            start = int(start)
+        except (TypeError, ValueError):
+            return
+        if not chromosome:
+            return
+        if enhancer_id not in self._enhancers:
+            self._enhancers[enhancer_id] = (chromosome, start)
+            if start > self._max_start:
+                self._max_start = start
+        sums = self._genes.setdefault(gene_id, {}).setdefault(chromosome,
+                                                              [0, 0])
+        sums[0] += start
+        sums[1] += 1
+
+    def __len__(self):
+        return len(self._enhancers) + len(
+            [i for i in self._genes if i not in self._enhancers])
+
+    def get_aspect(self):
+        """
+        Gets the cartesianLayout aspect elements, ordered by node ID
+        """
+        chromosomes = sorted(set(c for c, _ in self._enhancers.values()),
+                             key=_chromosome_sort_key)
+        rows = {c: i * LAYOUT_ROW_HEIGHT for i, c in enumerate(chromosomes)}
+        scale = LAYOUT_WIDTH / max(self._max_start, 1)
+        positions = {}
+        for node_id, (chromosome, start) in self._enhancers.items():
+            positions[node_id] = (start * scale,
+                                  rows[chromosome] + _layout_jitter(node_id))
+        for node_id, sums in self._genes.items():
+            if node_id in positions:
+                continue
+            count = sum(n for _, n in sums.values())
+            x = sum(total for total, _ in sums.values()) * scale / count
+            y = sum(rows[c] * n for c, (_, n) in sums.items()) / count
+            positions[node_id] = (
+                x, y - LAYOUT_GENE_OFFSET + _layout_jitter(node_id))
+        return [{'node': node_id, 'x': round(x, 2), 'y': round(y, 2)}
+                for node_id, (x, y) in sorted(positions.items())]
+
+
+class _LayoutCXWriter(object):
+    """
+    Wraps a CXStreamWriter, writing a cartesianLayout aspect just before the
+    post-metadata
+    """
+    def __init__(self, cx_writer, layout, batch_size):
+        self._cx_writer = cx_writer
+        self._layout = layout
+        self._batch_size = batch_size
+
+    def write_pre_metadata(self, metadata):
+        self._cx_writer.write_pre_metadata(metadata)
+
+    def write_aspect_fragment(self, fragment):
+        self._cx_writer.write_aspect_fragment(fragment)
+
+    def write_post_metadata(self, metadata):
+        elements = self._layout.get_aspect()
+        if elements:
+            for i in range(0, len(elements), self._batch_size):
+                self._cx_writer.write_aspect_fragment(
+                    {'cartesianLayout': elements[i:i + self._batch_size]})
+            metadata = metadata + [{'name': 'cartesianLayout',
+                                    'version': '1.0',
+                                    'consistencyGroup': 1,
+                                    'elementCount': len(elements)}]
+        self._cx_writer.write_post_metadata(metadata)
+
+
+def _get_layout_tsv_loader_class():
+    """
+    Gets a StreamTSVLoader that also writes the layout of the network
+    """
+    from ndexutil.tsv.streamtsvloader import StreamTSVLoader
+
+    class LayoutStreamTSVLoader(StreamTSVLoader):
+        """
+        StreamTSVLoader that lays enhancers out by chromosome and start
+        location while it writes the edges, in the same pass
+        """
+        def __init__(self, load_plan, style_template):
+            super(LayoutStreamTSVLoader, self).__init__(load_plan,
+                                                        style_template)
+            self.layout = _ChromosomeLayout()
+            self._cx_writer = None
+
+        @property
+        def cxWriter(self):
+            return self._cx_writer
+
+        @cxWriter.setter
+        def cxWriter(self, cx_writer):
+            # write_cx_network sets the writer; wrap it so the layout is
+            # written once all edges have been seen
+            self._cx_writer = _LayoutCXWriter(cx_writer, self.layout,
+                                              self.batchsize)
+
+        def _create_edge(self, src_node_id, tgt_node_id, row):
+            self.layout.add(src_node_id, tgt_node_id,
+                            row.get('Chromosome'), row.get('StartLocation'))
+            super(LayoutStreamTSVLoader, self)._create_edge(
+                src_node_id, tgt_node_id, row)
+
+    return LayoutStreamTSVLoader
+
+
+def _get_export_tsv_loader_class(base_class):
+    """
+    Gets a subclass of the StreamTSVLoader base_class that also hands every
+    batch of nodes and edges it writes to a NetworkExport
+    """
+    class ExportStreamTSVLoader(base_class):
+        """
+        StreamTSVLoader that writes the network in other formats while it
+        writes the CX, in the same pass
+        """
+        def __init__(self, load_plan, style_template):
+            super(ExportStreamTSVLoader, self).__init__(load_plan,
+                                                        style_template)
+            self.export = None
+
+        def _print_batch(self):
+            # The CX writer adds the edge IDs to the attributes, so the
+            # batch is exported first
+            if self.export is not None:
+                self.export.write_batch(self.newNodes, self.newEdges)
+            super(ExportStreamTSVLoader, self)._print_batch()
+
+    return ExportStreamTSVLoader
+
+
+def _get_canonical_tsv_loader_class(base_class):
+    """
+    Gets a subclass of the StreamTSVLoader base_class that writes network,
+    node and edge attributes in order of their names
+    """
+    class CanonicalStreamTSVLoader(base_class):
+        """
+        StreamTSVLoader that writes the attributes in the same order
+        whatever order the load plan and the network attributes list them
+        in
+        """
+        def write_cx_network(self, tsv_file, output_file,
+                             network_attributes=None, **kwargs):
+            if isinstance(network_attributes, list):
+                network_attributes = sorted(
+                    network_attributes, key=lambda attribute: attribute['n'])
+            super(CanonicalStreamTSVLoader, self).write_cx_network(
+                tsv_file, output_file, network_attributes, **kwargs)
+
+        def _create_attr_obj(self, node_or_edge_plan, row):
+            attr = super(CanonicalStreamTSVLoader, self)._create_attr_obj(
+                node_or_edge_plan, row)
+            if not attr:
+                return attr
+            return {name: attr[name] for name in sorted(attr)}
+
+    return CanonicalStreamTSVLoader
+
+
+def _format_duration(seconds):
+    """
+    Formats seconds as H:MM:SS
+    """
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+class _Progress(object):
+    """
+    Logs the progress of a pass over an input file, at most every interval
+    seconds: rows and edges per second and, when position is set, how much
+    of the file has been read and the estimated time left
+    """
+    def __init__(self, name, total_bytes=None, interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.total_bytes = total_bytes
+        self.position = None
+        """
+        Callable returning the number of bytes of the file read so far
+        """
+        self._interval = interval
+        self._start = time.perf_counter()
+        self._last = self._start
+        self._next_check = PROGRESS_CHECK_ROWS
+
+    def update(self, rows, edges=0):
+        """
+        Logs progress if interval seconds have passed since the last time.
+        Cheap enough to call for every row.
+        """
+        if rows < self._next_check:
+            return
+        self._next_check = rows + PROGRESS_CHECK_ROWS
+        now = time.perf_counter()
+        if now - self._last < self._interval:
+            return
+        self._last = now
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(self.get_message(rows, edges, now))
+
+    def get_message(self, rows, edges=0, now=None):
+        if now is None:
+            now = time.perf_counter()
+        elapsed = max(now - self._start, 1e-9)
+        message = ('{}: {} rows ({:.0f} rows/s), {} edges ({:.0f} '
+                   'edges/s)'.format(self.name, rows, rows / elapsed, edges,
+                                     edges / elapsed))
+        if self.position is not None and self.total_bytes:
+            done = min(self.position() / self.total_bytes, 1.0)
+            message += ', {:.1f}% of bytes read'.format(100 * done)
+            if done > 0:
+                message += ', ETA ' + _format_duration(
+                    elapsed * (1 - done) / done)
+        return message
+
+
+class NDExGeneHancerLoader(object):
+    """
+    Class to load content
+    """
+    def __init__(self, args):
+        """
+        :param args:
+        """
+        self._data_directory = _get_path(args.datadir)
+        self._conf_file = args.conf
+        self._load_plan_file = args.loadplan
+        self._style_file = args.stylefile
+        self._network_attributes_file = args.networkattributes
         self._no_header = args.noheader
         self._no_cleanup = args.nocleanup
+        self._min_score = args.minscore
+        self._min_confidence = args.minconfidence
+        self._top_genes = args.topgenes
+        self._top_enhancers = args.topenhancers
+        self._sample = args.sample
+        self._sample_fraction = args.samplefraction
+        self._store = args.store
+        self._validate = args.validate
+        self._quarantine = args.quarantine
+        self._watch = args.watch
+        self._watch_interval = args.watchinterval
+        if self._watch_interval is None:
+            self._watch_interval = WATCH_INTERVAL
+        self._settle_time = args.settletime
+        if self._settle_time is None:
+            self._settle_time = WATCH_SETTLE_TIME
+        self._region_args = args.region
+        self._bed_file = args.bed
+        self._regions = None
+        self._merge = args.merge
+        self._aggregate = args.aggregate
+        if self._aggregate is None:
+            self._aggregate = AGGREGATIONS[0]
+        self._merged_files = None
+        self._diff_files = args.diff
+        self._diff_summary = None
 
         self._gene_types_file = args.genetypes
         self._update_gene_types = False
         if self._gene_types_file is None:
             self._update_gene_types = True
             self._gene_types_file = _get_default_gene_types_name()
-        
+
         self._internal_gene_types = None
 
         self._delimiter = args.delimiter
+        self._input_formats = {}
         self._version = args.versionnumber
-        
+
         self._style_network = None
         self._gene_types = None
         self._network_attributes = None
+        self._prefetched = {}
 
         self._profile = args.profile
         self._user = None
@@ -362,6 +2052,50 @@ class NDExGeneHancerLoader(object):
 
         self._update_uuid = args.updateuuid
 
+        self._targets = _parse_targets(args.targets)
+        if self._targets is not None:
+            self._profile = self._targets[0]['profile']
+            self._update_uuid = self._targets[0]['update_uuid']
+
+        self._cx_file = args.cxfile
+        self._upload_retries = args.uploadretries
+        if self._upload_retries is None:
+            self._upload_retries = UPLOAD_RETRIES
+        self._upload_backoff = args.uploadbackoff
+        if self._upload_backoff is None:
+            self._upload_backoff = UPLOAD_BACKOFF
+        self._no_verify = args.noverify
+        self._skip_unchanged = args.skipunchanged
+        self._cx_fingerprints = {}
+        self._upload_skipped = False
+        self._gzip_upload = args.gzipupload
+        self._gzip_cx = args.gzipcx
+        self._no_layout = args.nolayout
+        self._export = args.export
+        self._scratch_dir = args.scratchdir
+        self._scratch_path = None
+        self._transfer_stats = None
+
+        self._metrics_file = args.metricsout
+        self._metrics = RunMetrics(get_cache_stats)
+        self._profiler = None
+        if args.profilecpu is not None or args.profilemem is not None:
+            self._profiler = StageProfiler(cpu_file=args.profilecpu,
+                                           mem_file=args.profilemem)
+
+    @contextmanager
+    def _stage(self, stage_name):
+        """
+        Times stage_name for the metrics report and profiles it if
+        --profilecpu or --profilemem is set
+        """
+        with self._metrics.stage(stage_name):
+            if self._profiler is None:
+                yield
+            else:
+                with self._profiler.stage(stage_name):
+                    yield
+
     def _parse_config(self):
         """
         Parses config
@@ -373,314 +2107,1104 @@ class NDExGeneHancerLoader(object):
             self._user = con.get(self._profile, NDExUtilConfig.USER)
             self._pass = con.get(self._profile, NDExUtilConfig.PASSWORD)
             self._server = con.get(self._profile, NDExUtilConfig.SERVER)
+            if self._targets is not None:
+                for target in self._targets:
+                    target['user'] = con.get(target['profile'],
+                                             NDExUtilConfig.USER)
+                    target['pass'] = con.get(target['profile'],
+                                             NDExUtilConfig.PASSWORD)
+                    target['server'] = con.get(target['profile'],
+                                               NDExUtilConfig.SERVER)
         except Exception as e:
-            print(e)
+            logger.error(str(e))
             raise
         if self._style_file is None and self._style_profile is not None:
             self._parse_style_config()
 
     def _parse_style_config(self):
         try:
-            ncon = NDExUtilConfig(conf_file=os.path.expanduser(self._conf_file))
+            ncon = NDExUtilConfig(
+                conf_file=os.path.expanduser(self._conf_file))
             con = ncon.get_config()
             self._style_uuid = con.get(self._style_profile, UUID)
         except Exception as e:
             self._style_profile = None
-            print(e)
-            print("Error while parsing configuration file for style. "
-                  "Default style template network (style.cx) will be used instead")
+            logger.warning(str(e) + "\nError while parsing configuration file "
+                           "for style. Default style template network "
+                           "(style.cx) will be used instead")
             return
         try:
-            self._style_server = con.get(self._style_profile, NDExUtilConfig.SERVER)
+            self._style_server = con.get(self._style_profile,
+                                         NDExUtilConfig.SERVER)
         except Exception as e:
-            print(e)
+            logger.warning(str(e))
         try:
-            self._style_user = con.get(self._style_profile, NDExUtilConfig.USER)
+            self._style_user = con.get(self._style_profile,
+                                       NDExUtilConfig.USER)
         except Exception as e:
-            print(e)
+            logger.warning(str(e))
         try:
-            self._style_pass = con.get(self._style_profile, NDExUtilConfig.PASSWORD)
+            self._style_pass = con.get(self._style_profile,
+                                       NDExUtilConfig.PASSWORD)
         except Exception as e:
-            print(e)
-    
-    def _find_delimiter(self, file_name):
-        if self._delimiter is None:
-            if file_name.split('.')[-1] == 'csv':
-                self._delimiter = ','
+            logger.warning(str(e))
+
+    def _check_export_formats(self):
+        """
+        Leaves out the --export formats whose optional modules are not
+        installed, with a warning, so that the load does not fail once the
+        network has been made
+        """
+        if self._export is None:
+            return
+        export_formats = []
+        for export_format in self._export:
+            missing = get_missing_export_modules(export_format)
+            if missing:
+                logger.warning('Not exporting {}: {} is not installed'.format(
+                    export_format, ', '.join(missing)))
             else:
-                self._delimiter = '\t'
+                export_formats.append(export_format)
+        self._export = export_formats or None
 
     def _get_file_path(self, file_name):
         return _get_path(os.path.join(self._data_directory, file_name))
 
+    def _get_scratch_path(self, file_name):
+        """
+        Gets the path of an intermediate file, in the scratch directory of
+        the run if there is one, otherwise in the data directory
+        """
+        if self._scratch_path is None:
+            return self._get_file_path(file_name)
+        return os.path.join(self._scratch_path, file_name)
+
+    @contextmanager
+    def _scratch(self):
+        """
+        Makes the scratch directory of the run, unless intermediate files
+        are kept, for the body of the with statement
+        """
+        if self._no_cleanup:
+            yield
+            return
+        with _scratch_directory(self._scratch_dir) as path:
+            self._scratch_path = path
+            try:
+                yield
+            finally:
+                self._scratch_path = None
+
+    def _check_scratch_space(self, file_paths):
+        """
+        Checks that there is about SCRATCH_SPACE_FACTOR times the size of
+        the input files free where the intermediate files are written
+        :return: True if there is, otherwise False
+        """
+        needed = SCRATCH_SPACE_FACTOR * sum(_estimate_input_size(file_path)
+                                            for file_path in file_paths)
+        directory = self._scratch_path or self._data_directory
+        free = shutil.disk_usage(directory).free
+        if free < needed:
+            logger.error('Not enough free space in {}: the intermediate '
+                         'files need about {} MB, {} MB are free. Use '
+                         '--scratchdir to write them '
+                         'elsewhere'.format(directory, needed // 1048576,
+                                            free // 1048576))
+            return False
+        return True
+
     def _get_gene_types(self):
         try:
-            with open(self._gene_types_file, 'rb') as gt:
-                self._gene_types = json.load(gt)
+            self._gene_types = _read_gene_types_file(self._gene_types_file)
         except Exception as e:
-            print(e)
-            print("Error while loading gene types. "
-                  "Default gene types will be used instead.")
+            logger.warning(str(e) + "\nError while loading gene types. "
+                           "Default gene types will be used instead.")
             self._gene_types_file = _get_default_gene_types_name()
-            with open(self._gene_types_file, 'r') as gt:
-                self._update_gene_types = True
-                self._gene_types = json.load(gt)
+            self._update_gene_types = True
+            self._gene_types = _read_gene_types_file(self._gene_types_file)
+
+    def _prefetch_network_metadata(self):
+        """
+        Starts fetching the network attributes and the style network, which
+        may have to come from NDEx, in background threads, so that they are
+        fetched while the input is reformatted. _get_network_attributes and
+        _get_style_network wait for them and set them on the loader. The
+        fetches only return what they fetched, and each has its own NDEx
+        client, so the threads share no state with the rest of the loader.
+        """
+        executor = ThreadPoolExecutor(max_workers=2)
+        if self._network_attributes is None:
+            self._prefetched['network_attributes'] = executor.submit(
+                self._prefetch_network_attributes)
+        if self._style_network is None:
+            self._prefetched['style_network'] = executor.submit(
+                self._fetch_style_network)
+        executor.shutdown(wait=False)
+
+    def _wait_for_prefetch(self, name):
+        """
+        Waits for a fetch started by _prefetch_network_metadata
+        :return: what was fetched, or None if it was not prefetched or the
+                 fetch failed
+        """
+        future = self._prefetched.pop(name, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(str(e) + "\nError while fetching the {} in the "
+                           "background. They will be fetched again.".format(
+                               name.replace('_', ' ')))
+            return None
+
+    def _prefetch_network_attributes(self):
+        """
+        Fetches the network attributes as _fetch_network_attributes does,
+        with a new NDEx client if they come from the network being updated
+        """
+        ndex = None
+        if (self._network_attributes_file is None and
+                self._update_uuid is not None):
+            ndex = self._create_ndex_client()
+        return self._fetch_network_attributes(ndex)
 
     def _get_network_attributes(self):
-        if self._network_attributes_file is not None:
-            self._get_network_attributes_from_file()
-        elif self._update_uuid is not None:
-            self._get_network_attributes_from_uuid()
-        else:
-            self._network_attributes_file = _get_default_network_attributes_name()
-            self._get_network_attributes_from_file()
+        fetched = self._wait_for_prefetch('network_attributes')
+        if fetched is None:
+            fetched = self._fetch_network_attributes()
+        self._network_attributes, network_attributes_file = fetched
+        if network_attributes_file is not None:
+            self._network_attributes_file = network_attributes_file
 
         if self._version is not None:
-            found = False
+            self._set_network_attribute('version', self._version)
+        if self._min_score is not None:
+            self._set_network_attribute('minimumGeneEnhancerScore',
+                                        self._min_score, 'double')
+        if self._min_confidence is not None:
+            self._set_network_attribute('minimumEnhancerConfidenceScore',
+                                        self._min_confidence, 'double')
+        if self._top_genes is not None:
+            self._set_network_attribute('topGenesPerEnhancer',
+                                        self._top_genes, 'integer')
+        if self._top_enhancers is not None:
+            self._set_network_attribute('topEnhancersPerGene',
+                                        self._top_enhancers, 'integer')
+        if self._sample is not None or self._sample_fraction is not None:
             for attribute in self._network_attributes:
-                if attribute['n'] == 'version':
-                    found = True
-                    attribute['v'] = self._version
-                    break
-            if not found:
-                version = {
-                    "n": "version",
-                    "v": self._version
-                }
-                self._network_attributes.append(version)
+                if attribute['n'] == 'name':
+                    attribute['v'] = '{} (sample)'.format(attribute['v'])
+            if self._sample is not None:
+                self._set_network_attribute('sampleSize', self._sample,
+                                            'integer')
+            else:
+                self._set_network_attribute('sampleFraction',
+                                            self._sample_fraction, 'double')
+        if self._regions is not None:
+            self._set_network_attribute(
+                'genomicRegions',
+                ['{}:{}-{}'.format(*region) for region in self._regions],
+                'list_of_string')
+        if self._diff_summary is not None:
+            for attribute in self._network_attributes:
+                if attribute['n'] == 'name':
+                    attribute['v'] = '{} (changes from {} to {})'.format(
+                        attribute['v'],
+                        self._diff_summary['old'],
+                        self._diff_summary['new'])
+            self._set_network_attribute('oldRelease',
+                                        self._diff_summary['old'])
+            self._set_network_attribute('newRelease',
+                                        self._diff_summary['new'])
+            for change_type in CHANGE_TYPES + ['unchanged']:
+                self._set_network_attribute(change_type + 'Edges',
+                                            self._diff_summary[change_type],
+                                            'integer')
+        if self._merged_files is not None:
+            self._set_network_attribute('mergedFiles', self._merged_files,
+                                        'list_of_string')
+            self._set_network_attribute('mergedScoreAggregation',
+                                        self._aggregate)
+
+    def _set_network_attribute(self, name, value, data_type=None):
+        """
+        Sets the value of network attribute name, adding the attribute if
+        it is not there yet
+        """
+        for attribute in self._network_attributes:
+            if attribute['n'] == name:
+                attribute['v'] = value
+                if data_type is not None:
+                    attribute['d'] = data_type
+                return
+        attribute = {
+            "n": name,
+            "v": value
+        }
+        if data_type is not None:
+            attribute['d'] = data_type
+        self._network_attributes.append(attribute)
 
-    def _get_network_attributes_from_file(self):
+    def _fetch_network_attributes(self, ndex=None):
+        """
+        Gets the network attributes, from --networkattributes, the network
+        being updated or the default network attributes file, without the
+        attributes set by the options of this run. Sets nothing on the
+        loader, so that it can run in a background thread.
+        :param ndex: NDEx client to get the network being updated with,
+                     instead of the client of the loader
+        :return: list of network attributes and the network attributes file
+                 they were read from (None if they came from NDEx)
+        """
+        if self._network_attributes_file is not None:
+            return (self._get_network_attributes_from_file(
+                        self._network_attributes_file),
+                    self._network_attributes_file)
+        if self._update_uuid is not None:
+            return self._get_network_attributes_from_uuid(ndex), None
+        network_attributes_file = _get_default_network_attributes_name()
+        return (self._get_network_attributes_from_file(
+                    network_attributes_file),
+                network_attributes_file)
+
+    def _get_network_attributes_from_file(self, file_path=None):
         try:
-            with open(self._network_attributes_file, 'r') as na:
+            with open(file_path or self._network_attributes_file, 'r') as na:
                 attributes_object = json.load(na)
-                self._network_attributes = attributes_object['attributes']
+                return attributes_object['attributes']
         except Exception as e:
-            print(e)
-            print("Error while loading network attributes. "
-                  "Default network attributes will be used instead.")
+            logger.warning(str(e) + "\nError while loading network "
+                           "attributes. Default network attributes will be "
+                           "used instead.")
             with open(_get_default_network_attributes_name(), 'r') as na:
                 attributes_object = json.load(na)
-                self._network_attributes = attributes_object['attributes']
+                return attributes_object['attributes']
 
-    def _get_network_attributes_from_uuid(self):
-        response = self._ndex.get_network_as_cx_stream(self._update_uuid)
-        network = ndex2.create_nice_cx_from_raw_cx(response.json())
+    def _get_network_attributes_from_uuid(self, ndex=None):
+        import ndex2
+        try:
+            response = (ndex or self._ndex).get_network_as_cx_stream(
+                self._update_uuid)
+            network = ndex2.create_nice_cx_from_raw_cx(response.json())
+        except Exception as e:
+            logger.warning(str(e) + "\nError while loading network "
+                           "attributes from NDEx. Default network attributes "
+                           "will be used instead.")
+            return self._get_network_attributes_from_file(
+                _get_default_network_attributes_name())
         names = network.get_network_attribute_names()
         network_attributes = []
         for name in names:
             network_attributes.append(network.get_network_attribute(name))
-        self._network_attributes = network_attributes
+        return network_attributes
 
-    def _get_style_network(self):
+    def _fetch_style_network(self):
+        """
+        Loads the style network from --stylefile, the --styleprofile
+        network, the network being updated or the default style file. Sets
+        nothing on the loader, so that it can run in a background thread.
+        :return: the style network and a dict of the style settings of the
+                 loader (such as _style_file) it was loaded with
+        """
         if self._style_file is not None:
-            self._get_style_network_from_file()
-        elif self._style_profile is not None:
-            self._get_style_network_from_uuid()
+            return self._read_style_network_file(self._style_file), {}
+        if self._style_profile is not None:
+            style = {}
         elif self._update_uuid is not None:
-            self._style_server = self._server
-            self._style_user = self._user
-            self._style_pass = self._pass
-            self._style_uuid = self._update_uuid
-            self._get_style_network_from_uuid()
+            style = {'_style_server': self._server,
+                     '_style_user': self._user,
+                     '_style_pass': self._pass,
+                     '_style_uuid': self._update_uuid}
         else:
-            self._style_file = _get_default_style_file_name()
-            self._get_style_network_from_file()
+            style_file = _get_default_style_file_name()
+            return (self._read_style_network_file(style_file),
+                    {'_style_file': style_file})
+
+        style_network = self._read_style_network_from_server(
+            style.get('_style_server', self._style_server),
+            style.get('_style_user', self._style_user),
+            style.get('_style_pass', self._style_pass),
+            style.get('_style_uuid', self._style_uuid))
+        if style_network is None:
+            style['_style_file'] = _get_default_style_file_name()
+            style_network = self._read_style_network_file(style['_style_file'])
+        return style_network, style
+
+    def _get_style_network(self):
+        fetched = self._wait_for_prefetch('style_network')
+        if fetched is None:
+            fetched = self._fetch_style_network()
+        style_network, style = fetched
+        for name, value in style.items():
+            setattr(self, name, value)
+        self._style_network = style_network
 
     def _get_style_network_from_file(self):
+        self._style_network = self._read_style_network_file(self._style_file)
+
+    def _get_style_network_from_uuid(self):
+        style_network = self._read_style_network_from_server(
+            self._style_server, self._style_user, self._style_pass,
+            self._style_uuid)
+        if style_network is None:
+            self._style_file = _get_default_style_file_name()
+            style_network = self._read_style_network_file(self._style_file)
+        self._style_network = style_network
+
+    def _read_style_network_file(self, style_file):
+        """
+        Reads a style network from a file, or the default style file if it
+        cannot be read
+        :return: the style network, or None if neither can be read
+        """
+        import ndex2
         try:
-            self._style_network = ndex2.create_nice_cx_from_file(self._style_file)
+            return ndex2.create_nice_cx_from_file(style_file)
         except Exception as e:
-            print(e)
-            print("Error while loading style network from file. "
-                  "Default style network will be used instead.")
+            logger.warning(str(e) + "\nError while loading style network from "
+                           "file. Default style network will be used instead.")
             try:
-                self._style_network = ndex2.create_nice_cx_from_file(
+                return ndex2.create_nice_cx_from_file(
                     _get_default_style_file_name())
             except Exception as e:
-                print(e)
-                print("Error while loading default style network from file. "
-                      "No style will be applied.")
-        
-    def _get_style_network_from_uuid(self):
+                logger.error(str(e) + "\nError while loading default style "
+                             "network from file. No style will be applied.")
+        return None
+
+    def _read_style_network_from_server(self, server, user, password, uuid):
+        """
+        Reads a style network from NDEx, with the credentials of the loader
+        for the server, user and password that are None
+        :return: the style network, or None if it cannot be read
+        """
+        import ndex2
         try:
-            self._style_network = ndex2.create_nice_cx_from_server(
-                self._style_server if self._style_server is not None else self._server,
-                username = self._style_user if self._style_user is not None else self._user,
-                password = self._style_pass if self._style_pass is not None else self._pass,
-                uuid = self._style_uuid
+            return ndex2.create_nice_cx_from_server(
+                server if server is not None else self._server,
+                username=user if user is not None else self._user,
+                password=password if password is not None else self._pass,
+                uuid=uuid
             )
         except Exception as e:
-            print(e)
-            print("Error while loading style network from NDEx. "
-                  "Default style will be used instead.")
-            self._style_file = _get_default_style_file_name()
-            self._get_style_network_from_file()
+            logger.warning(str(e) + "\nError while loading style network from "
+                           "NDEx. Default style will be used instead.")
+        return None
+
+    def _get_original_name(self, file_name):
+        for _, _, suffix in COMPRESSIONS:
+            if file_name.endswith(suffix):
+                file_name = file_name[:-len(suffix)]
+                break
+        reverse_string = file_name[::-1]
+        try:
+            new_string = reverse_string.split(".", 1)[1]
+            return new_string[::-1]
+        except IndexError:
+            return file_name
+
+    def _get_default_header(self):
+        return DEFAULT_HEADER
+
+    def _get_output_header(self):
+        return OUTPUT_HEADER
+
+    def _data_directory_exists(self):
+        return os.path.exists(self._data_directory)
+
+    def _file_is_xl(self, file_path):
+        """
+        Tells whether an input file is an Excel workbook, by its contents
+        """
+        return self._get_input_format(file_path)[0].name == ExcelReader.name
+
+    def _convert_from_xl_to_tsv(self, file_path, original_name):
+        """
+        Writes the first sheet of a workbook to a tab separated file, so
+        that the workbook is parsed once rather than on every pass
+        """
+        reader, options = self._get_input_format(file_path)
+        new_csv_file_path = self._get_scratch_path(
+            INTERMEDIARY_PREFIX + original_name + ".tsv")
+        rows_in = 0
+        with _open_input_file(file_path) as (_, stream):
+            with open(new_csv_file_path, 'w', encoding='utf-8',
+                      newline='') as new_csv_file:
+                wr = csv.writer(new_csv_file, quoting=csv.QUOTE_ALL,
+                                delimiter='\t')
+                for row in reader.read(stream, options):
+                    wr.writerow(row)
+                    rows_in += 1
+
+        self._metrics.add(STAGE_XL_CONVERSION,
+                          rows_in=rows_in,
+                          bytes_written=os.path.getsize(new_csv_file_path))
+        return new_csv_file_path
+
+    def _create_ndex_connection(self):
+        """
+        creates connection to ndex
+        """
+        if self._ndex is None:
+            self._ndex = self._create_ndex_client()
+        return self._ndex
+
+    def _create_ndex_client(self):
+        """
+        Creates a new NDEx client, with its own session, for the account
+        of the loader
+        """
+        from ndex2.client import Ndex2
+        return Ndex2(host=self._server,
+                     username=self._user,
+                     password=self._pass)
+
+    def _reformat_input_file(self, csv_file_path, original_name, file_name):
+        if self._gene_types is None:
+            self._get_gene_types()
+        if not self._update_gene_types and self._internal_gene_types is None:
+            self._internal_gene_types = {}
+        rows_in = 0
+        edges_in = 0
+        edges_out = 0
+        store = None
+        store_writer = None
+        quarantine = None
+        sampling = (self._sample is not None or
+                    self._sample_fraction is not None)
+        progress = _Progress(file_name)
+        try:
+            if self._quarantine and csv_file_path is not None:
+                quarantine = _Quarantine(
+                    self._get_file_path(
+                        QUARANTINE_PREFIX + original_name + '.tsv'),
+                    self._get_input_header(csv_file_path))
+            if self._store:
+                store = self._get_reusable_store(original_name, file_name)
+                if store is None and sampling:
+                    logger.warning('Edges are not stored when the network '
+                                   'is sampled')
+                elif store is None:
+                    store_writer = EdgeStore(
+                        self._get_store_path(original_name),
+                        source=self._get_index_source(file_name))
+                else:
+                    logger.info('Reading edges from ' + store.store_path)
+                    if self._internal_gene_types is None:
+                        self._internal_gene_types = {}
+                    self._internal_gene_types.update(
+                        self._get_store_gene_types(store))
+
+            top_edges = None
+            if self._top_enhancers is not None:
+                top_edges = self._get_top_enhancer_edges(
+                    self._iter_enhancers(store, csv_file_path))
+            result_tsv_file_path = self._get_scratch_path(
+                RESULT_PREFIX + original_name + ".tsv")
+            index = EnhancerIndex(source=self._get_index_source(file_name))
+
+            with open(result_tsv_file_path, 'w', encoding='utf-8',
+                      newline='') as write_file:
+                counting_file = _CountingWriter(write_file, encoding='utf-8')
+                writer = csv.writer(counting_file, delimiter='\t')
+                writer.writerow(self._get_output_header())
+
+                enhancers = self._iter_enhancers(store, csv_file_path,
+                                                 progress, quarantine)
+                if sampling:
+                    enhancers = self._sample_enhancers(enhancers, file_name,
+                                                       progress)
+                for (enhancer_id, enhancer_chrom, enhancer_start, enhancer_end,
+                     enhancer_confidence_score, enhancer_enhancer_type,
+                     all_genes) in enhancers:
+                    rows_in += 1
+                    edges_in += len(all_genes)
+                    if not sampling:
+                        progress.update(rows_in, edges_out)
+                    genes = self._prune_genes(enhancer_confidence_score,
+                                              all_genes)
+                    if top_edges is not None:
+                        genes = [gene for gene in genes
+                                 if (enhancer_id, gene[0]) in top_edges]
+                    if not genes:
+                        continue
+                    enhancer_rep = self._get_rep(enhancer_id)
+                    enhancer_offset = counting_file.count
+
+                    for gene_name, gene_enhancer_score in genes:
+                        gene_rep = self._get_rep(gene_name)
+                        gene_gene_type = self._get_gene_type(gene_name)
+                        edges_out += 1
+                        writer.writerow([
+                            enhancer_id,
+                            enhancer_rep,
+                            enhancer_chrom,
+                            enhancer_start,
+                            enhancer_end,
+                            enhancer_confidence_score,
+                            ENHANCER,
+                            enhancer_enhancer_type,
+                            gene_name,
+                            gene_rep,
+                            gene_enhancer_score,
+                            GENE,
+                            gene_gene_type
+                        ])
+                        if store_writer is not None:
+                            try:
+                                store_writer.append(
+                                    enhancer_id,
+                                    enhancer_chrom,
+                                    int(float(enhancer_start)),
+                                    int(float(enhancer_end)),
+                                    float(enhancer_confidence_score),
+                                    enhancer_enhancer_type,
+                                    gene_name,
+                                    float(gene_enhancer_score),
+                                    gene_gene_type)
+                            except ValueError as e:
+                                logger.warning('Edges will not be stored: ' +
+                                               str(e))
+                                store_writer = None
+                    try:
+                        index.add(enhancer_chrom,
+                                  int(float(enhancer_start)),
+                                  int(float(enhancer_end)),
+                                  enhancer_offset,
+                                  counting_file.count - enhancer_offset)
+                    except ValueError:
+                        pass
+            index.tsv_size = os.path.getsize(result_tsv_file_path)
+            index.write(result_tsv_file_path + INDEX_SUFFIX)
+            if store_writer is not None:
+                store_writer.save()
+            if edges_out < edges_in:
+                logger.info('Pruned {} of {} edges of {}'.format(
+                    edges_in - edges_out, edges_in, file_name))
+            if quarantine is not None and quarantine.count > 0:
+                logger.warning('Left {} invalid rows of {} out of the '
+                               'network; they are in {}'.format(
+                                   quarantine.count, file_name,
+                                   quarantine.file_path))
+            self._metrics.add(STAGE_REFORMAT,
+                              rows_in=rows_in,
+                              edges_out=edges_out,
+                              bytes_written=os.path.getsize(
+                                  result_tsv_file_path))
+            self._metrics.add(STAGE_GENE_TYPING, rows_in=edges_out)
+            return result_tsv_file_path
+        except Exception:
+            logger.exception('Unable to reformat ' + file_name)
+        finally:
+            if store is not None:
+                store.close()
+            if quarantine is not None:
+                quarantine.close()
+
+    def _sample_enhancers(self, enhancers, file_name, progress=None):
+        """
+        Takes a --sample or --samplefraction sample of enhancers, stratified
+        by chromosome and enhancer type, reading them once
+        :param enhancers: iterator of enhancer tuples as from
+                          _iter_enhancers
+        :param progress: _Progress updated as enhancers are read
+        :return: list of the sampled enhancer tuples, in input order
+        """
+        sample = _StratifiedSample(size=self._sample,
+                                   fraction=self._sample_fraction)
+        for enhancer in enhancers:
+            sample.add((enhancer[1], enhancer[5]), enhancer)
+            if progress is not None:
+                progress.update(sample.count)
+        sampled = sample.get()
+        logger.info('Sampled {} of {} enhancers of {}'.format(
+            len(sampled), sample.count, file_name))
+        return sampled
+
+    def _iter_enhancers(self, store, csv_file_path, progress=None,
+                        quarantine=None):
+        """
+        Reads the enhancers from store if it is set, else from the input
+        file; see _iter_input_enhancers
+        """
+        if store is not None:
+            return self._iter_store_enhancers(store)
+        return self._iter_input_enhancers(csv_file_path, progress, quarantine)
+
+    def _get_input_format(self, file_path):
+        """
+        Finds the InputReader of an input file by sniffing its first
+        SNIFF_SIZE bytes. --delimiter, when set, takes precedence over the
+        delimiter sniffed from input files, though not from the files this
+        process writes.
+        :return: tuple of (reader, options for reader.read())
+        :raises ValueError: if no reader can read the file
+        """
+        stat = os.stat(file_path)
+        key = (file_path, stat.st_size, stat.st_mtime)
+        if key not in self._input_formats:
+            with _open_input_file(file_path) as (_, stream):
+                head = stream.read(SNIFF_SIZE)
+            for reader in get_input_readers():
+                options = reader.sniff(os.path.basename(file_path), head)
+                if options is not None:
+                    break
+            else:
+                raise ValueError('Unable to tell the format of ' + file_path)
+            if (self._delimiter is not None and 'delimiter' in options and
+                    self._is_input_file(os.path.basename(file_path))):
+                options = dict(options, delimiter=self._delimiter)
+            self._input_formats[key] = (reader, options)
+        return self._input_formats[key]
+
+    def _read_input_header(self, file_path):
+        """
+        Reads the header of an input file; the first row is taken for a
+        header unless --noheader is set or it looks like a GeneHancer row
+        :return: the header, or None if the file has none
+        """
+        if self._no_header:
+            return None
+        reader, options = self._get_input_format(file_path)
+        with _open_input_file(file_path) as (_, stream):
+            first_row = next(iter(reader.read(stream, options)), [])
+        if _is_header_row(first_row):
+            return first_row
+        return None
+
+    def _iter_input_rows(self, file_path, progress=None):
+        """
+        Reads the rows of an input file after its header, letting progress,
+        if set, know how much of the file has been read
+        :return: iterator of (line number, row) tuples
+        """
+        reader, options = self._get_input_format(file_path)
+        has_header = self._read_input_header(file_path) is not None
+        with _open_input_file(file_path) as (raw, stream):
+            if progress is not None:
+                progress.total_bytes = os.path.getsize(file_path)
+                progress.position = raw.tell
+            rows = enumerate(reader.read(stream, options), 1)
+            if has_header:
+                next(rows, None)
+            yield from rows
+
+    def _get_input_header(self, csv_file_path):
+        """
+        Gets the column names of an input file
+        """
+        header = self._read_input_header(csv_file_path)
+        if header is None:
+            return self._get_default_header()
+        return header
+
+    def _validate_input_file(self, csv_file_path, file_name):
+        """
+        Checks every row of an input file with _RowValidator, logging the
+        problems of invalid rows with their line numbers
+        :return: number of invalid rows
+        """
+        header = self._get_input_header(csv_file_path)
+        validator = _RowValidator(header)
+        rows_in = 0
+        invalid = 0
+        progress = _Progress(file_name)
+        for line_num, row in self._iter_input_rows(csv_file_path, progress):
+            rows_in += 1
+            progress.update(rows_in)
+            problems = validator.check(row)
+            if problems:
+                invalid += 1
+                logger.warning('{} line {}: {}'.format(
+                    file_name, line_num, '; '.join(problems)))
+        self._metrics.add(STAGE_VALIDATION, rows_in=rows_in)
+        logger.info('{} of {} rows of {} are invalid'.format(
+            invalid, rows_in, file_name))
+        return invalid
+
+    def _iter_input_enhancers(self, csv_file_path, progress=None,
+                              quarantine=None):
+        """
+        Reads the enhancers of an input file, letting progress, if set,
+        know how much of the file has been read. With a quarantine, invalid
+        rows are skipped and added to it; otherwise an invalid row raises
+        ValueError naming its line and problems.
+        :return: iterator of (enhancer ID, chromosome, start, end,
+                 confidence score, enhancer type, genes) tuples, where genes
+                 is a list of (gene name, GeneEnhancerScore) tuples. Values
+                 are strings as in the input.
+        """
+        validator = None
+        header = self._get_input_header(csv_file_path)
+        for line_num, line in self._iter_input_rows(csv_file_path, progress):
+            if self._quarantine:
+                # Invalid rows are skipped rather than stopping the load
+                if validator is None:
+                    validator = _RowValidator(header)
+                problems = validator.check(line)
+                if problems:
+                    if quarantine is not None:
+                        quarantine.add(line_num, problems, line)
+                    continue
+            try:
+                enhancer = self._parse_input_row(header, line)
+            except (IndexError, ValueError) as e:
+                try:
+                    problems = _RowValidator(header).check(line) or [str(e)]
+                except ValueError as header_error:
+                    problems = [str(header_error)]
+                raise ValueError('Line {} of {} is invalid: {}'.format(
+                    line_num, csv_file_path, '; '.join(problems))) from e
+            yield enhancer
+
+    def _parse_input_row(self, header, line):
+        """
+        Parses a row of an input file into the tuple _iter_input_enhancers
+        yields
+        """
+        attributes = line[header.index('attributes')].split(";")
 
+        # Take care of trailing semi-colons
+        if len(attributes) % 2 == 0:
+            iRange = len(attributes) - 1
+        else:
+            iRange = len(attributes)
 
-    def _get_original_name(self, file_name):
-        reverse_string = file_name[::-1]
-        try:
-            new_string = reverse_string.split(".", 1)[1]
-            return new_string[::-1]
-        except IndexError:
-            return file_name
+        # Find genes; names, chromosomes and types repeat a lot, so
+        # they are interned for whoever keeps them
+        genes = []
+        for j in range(1, iRange, 2):
+            genes.append((sys.intern(attributes[j].split("=")[1]),
+                          attributes[j+1].split("=")[1]))
 
-    def _get_default_header(self): 
-        return DEFAULT_HEADER
+        if 'chrom' in header:
+            enhancer_chrom = line[header.index('chrom')]
+        else:
+            enhancer_chrom = line[header.index('#chrom')]
+        return (attributes[0].split("=")[1],
+                sys.intern(enhancer_chrom),
+                line[header.index('start')],
+                line[header.index('end')],
+                line[header.index('score')],
+                sys.intern(line[header.index('feature name')]),
+                genes)
 
-    def _get_output_header(self):
-        return OUTPUT_HEADER
+    def _iter_store_enhancers(self, store):
+        """
+        Reads the enhancers of an edge store in the form of
+        _iter_input_enhancers. Edges of an enhancer are stored next to each
+        other, in input order.
+        """
+        columns = store.get_columns(['Enhancer', 'Chromosome', 'StartLocation',
+                                     'EndLocation', 'EnhancerConfidenceScore',
+                                     'EnhancerEnhancerType', 'Gene',
+                                     'GeneEnhancerScore'])
+        enhancer_ids = store.get_dictionary('Enhancer')
+        chromosomes = store.get_dictionary('Chromosome')
+        enhancer_types = store.get_dictionary('EnhancerEnhancerType')
+        gene_names = store.get_dictionary('Gene')
+        enhancer_codes = columns['Enhancer']
+        gene_codes = columns['Gene']
+        scores = columns['GeneEnhancerScore']
+        formatted = {}
 
-    def _data_directory_exists(self):
-        return os.path.exists(self._data_directory)
+        def format_score(value):
+            # Scores repeat a lot, and formatting them is not cheap
+            text = formatted.get(value)
+            if text is None:
+                text = formatted[value] = format_float32(value)
+            return text
+
+        enhancer = None
+        for i in range(store.num_edges):
+            if enhancer is None or enhancer_codes[i] != enhancer_codes[i-1]:
+                if enhancer is not None:
+                    yield enhancer
+                enhancer = (enhancer_ids[enhancer_codes[i]],
+                            chromosomes[columns['Chromosome'][i]],
+                            str(columns['StartLocation'][i]),
+                            str(columns['EndLocation'][i]),
+                            format_score(
+                                columns['EnhancerConfidenceScore'][i]),
+                            enhancer_types[columns['EnhancerEnhancerType'][i]],
+                            [])
+            enhancer[6].append((gene_names[gene_codes[i]],
+                                format_score(scores[i])))
+        if enhancer is not None:
+            yield enhancer
+
+    def _get_store_path(self, original_name):
+        return self._get_file_path(RESULT_PREFIX + original_name +
+                                   STORE_SUFFIX)
+
+    def _get_reusable_store(self, original_name, file_name):
+        """
+        Opens the edge store of file_name if it was made from the same input
+        and either without pruning or with the same pruning options
+        :return: EdgeStore, or None
+        """
+        store_path = self._get_store_path(original_name)
+        if not os.path.isdir(store_path):
+            return None
+        try:
+            store = EdgeStore.open(store_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        source = self._get_index_source(file_name)
+        if source is None or store.source is None:
+            return None
+        for key in ['file', 'files', 'size', 'mtime', 'aggregate']:
+            if store.source.get(key) != source.get(key):
+                return None
+        filters = store.source.get('filters')
+        if (filters != source['filters'] and
+                any(f is not None for f in filters)):
+            return None
+        return store
 
-    def _file_is_xl(self, file_name):
-        extension = file_name.split(".")[-1]
-        if extension[0:2] == 'xl':
+    def _has_reusable_edges(self, original_name, file_name):
+        """
+        Tells whether _load_file would read the edges of file_name from a
+        reformatted file or a store of an earlier run instead of the input
+        """
+        if (self._regions is not None and
+                self._get_reusable_result(original_name,
+                                          file_name) is not None):
             return True
+        if self._store:
+            store = self._get_reusable_store(original_name, file_name)
+            if store is not None:
+                store.close()
+                return True
         return False
 
-    def _convert_from_xl_to_tsv(self, file_path, original_name):
-        workbook = xlrd.open_workbook(file_path)
-        sheet = workbook.sheet_by_index(0)
+    def _get_store_gene_types(self, store):
+        """
+        :return: dict of gene name to the gene type stored with its edges
+        """
+        columns = store.get_columns(['Gene', 'GeneGeneType'])
+        gene_names = store.get_dictionary('Gene')
+        gene_types = store.get_dictionary('GeneGeneType')
+        return {gene_names[gene_code]: gene_types[type_code]
+                for gene_code, type_code in zip(columns['Gene'],
+                                                columns['GeneGeneType'])}
+
+    def _get_index_source(self, file_name):
+        """
+        Describes the input file and the pruning options, so that an index
+        written for other input or options is not reused. The file of a
+        --merge is described by the input files that were merged and how
+        their scores were aggregated.
+        :return: dict, or None if the input file cannot be found
+        """
+        filters = [self._min_score, self._min_confidence,
+                   self._top_genes, self._top_enhancers]
+        if self._merged_files is not None and file_name == MERGE_NAME + '.tsv':
+            try:
+                stats = [os.stat(self._get_file_path(merged_file))
+                         for merged_file in self._merged_files]
+            except OSError:
+                return None
+            return {
+                'file': file_name,
+                'files': list(self._merged_files),
+                'size': [stat.st_size for stat in stats],
+                'mtime': [stat.st_mtime for stat in stats],
+                'aggregate': self._aggregate,
+                'filters': filters
+            }
+        try:
+            stat = os.stat(self._get_file_path(file_name))
+        except OSError:
+            return None
+        return {
+            'file': file_name,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'filters': filters
+        }
 
-        new_csv_file_path = self._get_file_path(INTERMEDIARY_PREFIX + original_name + ".tsv")
-        new_csv_file = open(new_csv_file_path, 'w')
-        wr = csv.writer(new_csv_file, quoting=csv.QUOTE_ALL, delimiter='\t')
+    def _get_reusable_result(self, original_name, file_name):
+        """
+        Finds a reformatted file and index of file_name left by an earlier
+        run with --nocleanup, which region runs use instead of reformatting
+        :return: path of the reformatted file, or None
+        """
+        result_tsv_file_path = self._get_file_path(
+            RESULT_PREFIX + original_name + ".tsv")
+        index_file_path = result_tsv_file_path + INDEX_SUFFIX
+        if not (os.path.isfile(result_tsv_file_path) and
+                os.path.isfile(index_file_path)):
+            return None
+        try:
+            index = EnhancerIndex.load(index_file_path)
+        except (ValueError, KeyError):
+            return None
+        source = self._get_index_source(file_name)
+        if (source is None or index.source != source or
+                index.tsv_size != os.path.getsize(result_tsv_file_path)):
+            return None
+        return result_tsv_file_path
 
-        for row_num in range(sheet.nrows):
-            wr.writerow(sheet.row_values(row_num))
+    def _get_regions(self):
+        """
+        Parses the regions given with --region and --bed
+        :raises ValueError: if a region is malformed
+        :return: list of (chromosome, start, end) tuples, 1-based and
+                 inclusive
+        """
+        regions = []
+        for region in self._region_args or []:
+            match = re.match(r'^([^:\s]+):([0-9,]+)-([0-9,]+)$',
+                             region.strip())
+            if match is None:
+                raise ValueError('Region "{}" is not of the form '
+                                 'chromosome:start-end'.format(region))
+            regions.append((match.group(1),
+                            int(match.group(2).replace(',', '')),
+                            int(match.group(3).replace(',', ''))))
+        if self._bed_file is not None:
+            with open(self._bed_file, 'r') as bed:
+                for line_number, line in enumerate(bed, 1):
+                    fields = line.split()
+                    if (not fields or fields[0].startswith('#') or
+                            fields[0] in ('track', 'browser')):
+                        continue
+                    try:
+                        # BED is 0-based and half-open
+                        regions.append((fields[0], int(fields[1]) + 1,
+                                        int(fields[2])))
+                    except (IndexError, ValueError):
+                        raise ValueError(
+                            'Line {} of {} is not a BED region'.format(
+                                line_number, self._bed_file))
+        return regions
 
-        new_csv_file.close()
-        self._delimiter = '\t'
-        return new_csv_file_path
+    def _extract_regions(self, result_tsv_file_path, original_name):
+        """
+        Copies the rows of the enhancers overlapping the regions from a
+        reformatted file into a new one, reading only those rows
+        :return: path of the new file
+        """
+        index = EnhancerIndex.load(result_tsv_file_path + INDEX_SUFFIX)
+        byte_ranges = set()
+        for chrom, start, end in self._regions:
+            byte_ranges.update(index.query(chrom, start, end))
 
-    def _create_ndex_connection(self):
+        region_tsv_file_path = self._get_scratch_path(
+            RESULT_PREFIX + original_name + REGION_SUFFIX + ".tsv")
+        with open(result_tsv_file_path, 'rb') as result_file:
+            with open(region_tsv_file_path, 'wb') as region_file:
+                region_file.write(result_file.readline())
+                for offset, length in sorted(byte_ranges):
+                    result_file.seek(offset)
+                    region_file.write(result_file.read(length))
+        logger.info('{} enhancers overlap the {} region(s)'.format(
+            len(byte_ranges), len(self._regions)))
+        return region_tsv_file_path
+
+    def _prune_genes(self, enhancer_confidence_score, genes):
         """
-        creates connection to ndex
+        Leaves out the genes of an enhancer pruned by --minscore,
+        --minconfidence and --topgenes
+        :param genes: list of (gene name, GeneEnhancerScore) tuples
+        :return: list of the (gene name, GeneEnhancerScore) tuples kept, in
+                 input order
         """
-        if self._ndex is None:
-            self._ndex = Ndex2(host=self._server, 
-                               username=self._user, 
-                               password=self._pass)
-        return self._ndex
+        if (self._min_confidence is not None and
+                float(enhancer_confidence_score) < self._min_confidence):
+            return []
 
-    def _reformat_input_file(self, csv_file_path, original_name, file_name):
-        if self._gene_types is None:
-            self._get_gene_types()
-        if not self._update_gene_types and self._internal_gene_types is None:
-            self._internal_gene_types = {}
-        try:
-            result_tsv_file_path = self._get_file_path(RESULT_PREFIX + original_name + ".tsv")
-
-            with open(csv_file_path, 'r', encoding='utf-8-sig') as read_file:
-                reader = csv.reader(read_file, delimiter=self._delimiter)
-                with open(result_tsv_file_path, 'w') as write_file:
-                    writer = csv.writer(write_file, delimiter='\t')
-                    writer.writerow(self._get_output_header())
-
-                    for i, line in enumerate(reader):
-                        if i == 0:
-                            if self._no_header:
-                                header = self._get_default_header()
-                            else:
-                                header = line
-                                continue
-                        elif i % 100 == 0:
-                            print('{} - processing row {} of {}'.format(
-                                str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 
-                                str(i), 
-                                file_name))
-
-                        attributes = line[header.index('attributes')].split(";")
-
-                        #Find enhancer attributes
-                        enhancer_id = attributes[0].split("=")[1]
-                        enhancer_rep = self._get_rep(enhancer_id)
-                        if 'chrom' in header:
-                            enhancer_chrom = line[header.index('chrom')]
-                        else:
-                            enhancer_chrom = line[header.index('#chrom')]
-                        enhancer_start = line[header.index('start')]
-                        enhancer_end = line[header.index('end')]
-                        enhancer_enhancer_type = line[header.index('feature name')]
-                        enhancer_confidence_score = line[header.index('score')]
-
-                        #Take care of trailing semi-colons
-                        if len(attributes) % 2 == 0:
-                            iRange = len(attributes) - 1
-                        else:
-                            iRange = len(attributes)
-                
-                        #Find genes
-                        for i in range(1, iRange, 2):
-                            gene_name = attributes[i].split("=")[1]
-                            gene_rep = self._get_rep(gene_name)
-                            gene_enhancer_score = attributes[i+1].split("=")[1]
-                            gene_gene_type = self._get_gene_type(gene_name)
-                            writer.writerow([
-                                enhancer_id,
-                                enhancer_rep,
-                                enhancer_chrom,
-                                enhancer_start,
-                                enhancer_end,
-                                enhancer_confidence_score,
-                                ENHANCER,
-                                enhancer_enhancer_type,
-                                gene_name,
-                                gene_rep,
-                                gene_enhancer_score,
-                                GENE,
-                                gene_gene_type
-                            ])
-            return result_tsv_file_path
-        except Exception as e:
-            print(traceback.format_exc())
-            print(e)
+        if self._min_score is not None:
+            genes = [gene for gene in genes
+                     if float(gene[1]) >= self._min_score]
+
+        if self._top_genes is not None and len(genes) > self._top_genes:
+            top = sorted(range(len(genes)),
+                         key=lambda j: float(genes[j][1]),
+                         reverse=True)[:self._top_genes]
+            genes = [genes[j] for j in sorted(top)]
+        return genes
+
+    def _get_top_enhancer_edges(self, enhancers):
+        """
+        Reads the enhancers once to find, for every gene, the --topenhancers
+        associations with the highest GeneEnhancerScore among those left by
+        the other filters. Ties go to the association that comes first.
+        :param enhancers: iterator as returned by _iter_enhancers()
+        :return: set of (enhancer ID, gene name) tuples to keep
+        """
+        top = {}
+        position = 0
+        for enhancer in enhancers:
+            enhancer_id = enhancer[0]
+            genes = self._prune_genes(enhancer[4], enhancer[6])
+            for gene_name, gene_enhancer_score in genes:
+                position += 1
+                heap = top.setdefault(gene_name, [])
+                entry = (float(gene_enhancer_score), -position, enhancer_id)
+                if len(heap) < self._top_enhancers:
+                    heapq.heappush(heap, entry)
+                else:
+                    heapq.heappushpop(heap, entry)
+        return set((enhancer_id, gene_name)
+                   for gene_name, heap in top.items()
+                   for _, _, enhancer_id in heap)
 
     def _get_gene_type(self, gene_name):
         # Match known genes
         if self._gene_types is not None and gene_name in self._gene_types:
             return self._gene_types[gene_name]
-        if self._internal_gene_types is not None and gene_name in self._internal_gene_types:
-            return self._internal_gene_types[gene_name]    
+        if (self._internal_gene_types is not None and
+                gene_name in self._internal_gene_types):
+            return self._internal_gene_types[gene_name]
+
+        # Only genes that are not known yet are timed, as the lookups
+        # above are too quick to be worth the clock calls
+        with self._metrics.stage(STAGE_GENE_TYPING):
+            gene_type = self._classify_gene_type(gene_name)
+        if self._update_gene_types:
+            self._gene_types[gene_name] = gene_type
+        else:
+            self._internal_gene_types[gene_name] = gene_type
+        return gene_type
 
+    def _classify_gene_type(self, gene_name):
         gene_type = None
 
         # Match known types
         if (re.match('^LINC[0-9-]+$', gene_name) or
-            re.match('^LOC[0-9-]+$', gene_name) or
-            re.match('^GC([0-9]+|MT)[A-Z]+[0-9]+', gene_name)):
+                re.match('^LOC[0-9-]+$', gene_name) or
+                re.match('^GC([0-9]+|MT)[A-Z]+[0-9]+', gene_name)):
             gene_type = "ncRNA gene"
 
         # Use mygene.info
         else:
             gene_type = self._get_gene_type_from_gene_info(gene_name)
-            
+
             # Use known prefix
-            if (gene_type is None and 
-               (re.match('^RF[0-9]{5}', gene_name) or
-                re.match('^HSALNG[0-9]+', gene_name) or
-                re.match('^(M|m|P|p)(I|i)(R|r)', gene_name) or
-                re.match('^(L|l)(N|n)(C|c)', gene_name) or
-                re.match('^[A-Z]{2}[0-9-]+$', gene_name) or
-                re.match('^5[A-Z0-9]{3}_', gene_name) or
-                re.match('^hsa-miR-[0-9-]+', gene_name) or 
-                re.match('^NONHSAG[0-9-.]+$', gene_name) or 
-                re.match('^(L|Z)[0-9-]+', gene_name) or
-                re.match('^SNOR[A-Z0-9-]+$', gene_name))): #Given exceptions in genetypes file
+            # Given exceptions in genetypes file
+            if (gene_type is None and
+                    (re.match('^RF[0-9]{5}', gene_name) or
+                     re.match('^HSALNG[0-9]+', gene_name) or
+                     re.match('^(M|m|P|p)(I|i)(R|r)', gene_name) or
+                     re.match('^(L|l)(N|n)(C|c)', gene_name) or
+                     re.match('^[A-Z]{2}[0-9-]+$', gene_name) or
+                     re.match('^5[A-Z0-9]{3}_', gene_name) or
+                     re.match('^hsa-miR-[0-9-]+', gene_name) or
+                     re.match('^NONHSAG[0-9-.]+$', gene_name) or
+                     re.match('^(L|Z)[0-9-]+', gene_name) or
+                     re.match('^SNOR[A-Z0-9-]+$', gene_name))):
                 gene_type = 'ncRNA gene'
 
         if gene_type is None:
             gene_type = 'Other gene'
-        if self._update_gene_types:
-            self._gene_types[gene_name] = gene_type
-        else:
-            self._internal_gene_types[gene_name] = gene_type
         return gene_type
 
     def _get_gene_type_from_gene_info(self, gene_name):
-        gene_info = mg.query(gene_name, fields='type_of_gene,ensembl.type_of_gene')
+        gene_info = _get_mygene_client().query(
+            gene_name, fields='type_of_gene,ensembl.type_of_gene')
         if gene_info is not None:
             for entry in gene_info['hits']:
                 try:
@@ -689,11 +3213,12 @@ class NDExGeneHancerLoader(object):
                         return gene_type
                 except KeyError:
                     pass
-        
+
             for entry in gene_info['hits']:
                 try:
                     ensembl_info = entry['ensembl']
-                    gene_type = self._map_gene_type(ensembl_info['type_of_gene'])
+                    gene_type = self._map_gene_type(
+                        ensembl_info['type_of_gene'])
                     if gene_type is not None:
                         return gene_type
                 except KeyError:
@@ -701,18 +3226,10 @@ class NDExGeneHancerLoader(object):
         return None
 
     def _map_gene_type(self, original_gene_type):
-        for key in TYPE_OF_GENE_TO_GENE_TYPE_MAP:
-            for regex in TYPE_OF_GENE_TO_GENE_TYPE_MAP[key]:
-                if re.match(regex, original_gene_type):
-                    return key
-
-        return None
+        return _map_type_of_gene(original_gene_type)
 
     def _get_rep(self, id):
-        if re.match('^GH([0-9]{2}|MT|0X|0Y)[A-Z][0-9]+', id):
-            return EN_GENECARDS + id
-        else:
-            return P_GENECARDS + id
+        return _get_node_rep(id)
 
     def _generate_nice_cx_from_tsv(self, tsv_file_path, original_name):
         if self._network_attributes is None:
@@ -720,63 +3237,1156 @@ class NDExGeneHancerLoader(object):
         if self._style_network is None:
             self._get_style_network()
 
+        if self._no_layout:
+            from ndexutil.tsv.streamtsvloader import StreamTSVLoader
+        else:
+            StreamTSVLoader = _get_layout_tsv_loader_class()
+        StreamTSVLoader = _get_canonical_tsv_loader_class(StreamTSVLoader)
+        if self._export:
+            StreamTSVLoader = _get_export_tsv_loader_class(StreamTSVLoader)
         cx_file_path = self._get_cx_file_path(original_name)
-        with open(tsv_file_path, 'r') as tsv_file:
-            with open(cx_file_path, 'w') as cx_file:
-                loader = StreamTSVLoader(self._load_plan_file, self._style_network)
-                loader.write_cx_network(tsv_file, cx_file, self._network_attributes)
+        with _TempFiles(keep=self._no_cleanup) as temp_files:
+            sorted_file_path = temp_files.add(
+                self._sort_network_file(tsv_file_path, original_name))
+            with open(sorted_file_path, 'r', encoding='utf-8',
+                      newline='') as tsv_file:
+                with _open_cx_file(cx_file_path, 'wb') as cx_binary_file:
+                    # The fingerprint is of the CX text, before any gzip
+                    # compression
+                    digest_writer = _DigestWriter(cx_binary_file)
+                    with io.TextIOWrapper(io.BufferedWriter(digest_writer),
+                                          encoding='utf-8') as cx_file:
+                        cx_writer = _CountingWriter(cx_file)
+                        loader = StreamTSVLoader(self._load_plan_file,
+                                                 self._style_network)
+                        if self._export:
+                            # Every format is written from the same read of
+                            # the file
+                            loader.export = NetworkExport(
+                                loader._plan,
+                                self._get_file_path(RESULT_PREFIX +
+                                                    original_name),
+                                self._export)
+                        try:
+                            loader.write_cx_network(tsv_file, cx_writer,
+                                                    self._network_attributes)
+                        finally:
+                            if self._export:
+                                export_file_paths = loader.export.close()
+        fingerprint = digest_writer.hexdigest()
+        self._cx_fingerprints[cx_file_path] = fingerprint
+        self._metrics.set_file_info(fingerprint=fingerprint)
+        logger.info('network fingerprint (SHA-256): ' + fingerprint)
+        if self._export:
+            for export_file_path in export_file_paths:
+                logger.info('wrote ' + export_file_path)
+            self._metrics.add(STAGE_EXPORT,
+                              edges_out=loader.export.edges,
+                              bytes_written=sum(
+                                  os.path.getsize(export_file_path)
+                                  for export_file_path in export_file_paths))
+        self._metrics.add(STAGE_CX_GENERATION,
+                          rows_in=loader.edgeCounter,
+                          edges_out=loader.edgeCounter,
+                          bytes_written=os.path.getsize(cx_file_path))
+        if self._gzip_cx:
+            compressed_size = os.path.getsize(cx_file_path)
+            logger.info('compressed network from {} to {} bytes (ratio '
+                        '{:.1f})'.format(cx_writer.count,
+                                         compressed_size,
+                                         cx_writer.count /
+                                         max(compressed_size, 1)))
         return cx_file_path
 
+    def _sort_network_file(self, tsv_file_path, original_name):
+        """
+        Writes the rows of a network file in order of their source and
+        target nodes, so that the same network always gets the same node
+        and edge IDs in the CX, whatever order its rows were in. Rows with
+        the same nodes are ordered by their text.
+        :return: path of the sorted file
+        """
+        with open(self._load_plan_file, 'r') as f:
+            load_plan = json.load(f)
+        sorted_file_path = self._get_scratch_path(
+            RESULT_PREFIX + original_name + SORTED_SUFFIX + '.tsv')
+        with open(tsv_file_path, 'r', encoding='utf-8',
+                  newline='') as tsv_file:
+            header_line = tsv_file.readline()
+            header = [column.strip() for column in header_line.split('\t')]
+            key_columns = []
+            for node_plan_name in ['source_plan', 'target_plan']:
+                node_plan = load_plan[node_plan_name]
+                column = (node_plan.get('rep_column') or
+                          node_plan.get('node_name_column'))
+                if column not in header:
+                    raise ValueError(
+                        'Column {} of load plan {} is not in the header of '
+                        '{}'.format(column, self._load_plan_file,
+                                    tsv_file_path))
+                key_columns.append(header.index(column))
+            source, target = key_columns
+
+            with open(sorted_file_path, 'w', encoding='utf-8',
+                      newline='') as sorted_file:
+                sorted_file.write(header_line)
+                sorted_file.writelines(_sort_tsv_records(
+                    tsv_file,
+                    key=lambda fields: (fields[source], fields[target]),
+                    directory=os.path.dirname(sorted_file_path)))
+        return sorted_file_path
+
     def _get_cx_file_path(self, original_name):
-        return self._get_file_path(RESULT_PREFIX + original_name + ".cx")
+        if self._gzip_cx:
+            return self._get_scratch_path(RESULT_PREFIX + original_name +
+                                          ".cx.gz")
+        return self._get_scratch_path(RESULT_PREFIX + original_name + ".cx")
 
     def _write_gene_type_to_file(self, original_name):
+        """
+        Adds the gene types of this run to the gene types file, or writes
+        them to the data directory when the gene types file is not updated.
+        The gene types file is locked while it is read, merged with the
+        gene types of this run and replaced, so that runs sharing it keep
+        each other's gene types.
+        """
         if self._update_gene_types and self._gene_types is not None:
-            with open(self._gene_types_file, 'w') as f:
-                json.dump(self._gene_types, f, indent=4)
+            with _locked(self._gene_types_file):
+                try:
+                    gene_types = _read_gene_types_file(self._gene_types_file)
+                except FileNotFoundError:
+                    gene_types = {}
+                except (OSError, ValueError) as e:
+                    logger.warning('Replacing unreadable gene types file ' +
+                                   self._gene_types_file + ': ' + str(e))
+                    gene_types = {}
+                gene_types.update(self._gene_types)
+                _write_json_atomically(self._gene_types_file, gene_types)
+            self._gene_types = gene_types
             return self._gene_types_file
         elif self._internal_gene_types is not None:
-            gene_type_file_path = self._get_file_path(GENE_TYPES_PREFIX + original_name + ".json")
-            with open(gene_type_file_path, 'w') as f:
-                json.dump(self._internal_gene_types, f, indent=4)
+            gene_type_file_path = self._get_file_path(
+                GENE_TYPES_PREFIX + original_name + ".json")
+            _write_json_atomically(gene_type_file_path,
+                                   self._internal_gene_types)
             return gene_type_file_path
 
     def _upload_cx(self, cx_file_path, network_file_name):
-        with open(cx_file_path, 'rb') as network_out:
-            try:
-                if self._update_uuid is None:
-                    print('{} - started uploading "{}" on {} for user {}...'.
-                          format(str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-                                 network_file_name, 
-                                 self._server, 
-                                 self._user))
-                    self._ndex.save_cx_stream_as_new_network(network_out)
-                    print('{} - finished uploading "{}" on {} for user {}'.
-                          format(str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-                                 network_file_name, 
-                                 self._server, 
-                                 self._user))
+        self._upload_skipped = False
+        if self._skip_unchanged:
+            fingerprint = self._get_fingerprint(cx_file_path)
+            upload_key = self._get_upload_key(network_file_name)
+            last_upload = self._read_upload_state().get(upload_key)
+            if (last_upload is not None and
+                    last_upload.get('fingerprint') == fingerprint):
+                logger.info('"{}" is the same as network {} uploaded on {} '
+                            'for user {} at {}; not uploading it again'.
+                            format(network_file_name,
+                                   last_upload.get('uuid'),
+                                   self._server,
+                                   self._user,
+                                   last_upload.get('uploaded')))
+                self._upload_skipped = True
+                return 0
+
+        if self._update_uuid is None:
+            action = 'uploading'
+        else:
+            action = 'updating'
+        logger.info('started {} "{}" on {} for user {}...'.
+                    format(action,
+                           network_file_name,
+                           self._server,
+                           self._user))
+        try:
+            send_cx = self._send_cx
+            if self._gzip_upload:
+                if self._ndex.version.startswith('1.'):
+                    logger.warning('NDEx {} on {} does not take gzip '
+                                   'compressed uploads; uploading without '
+                                   'compression'.format(self._ndex.version,
+                                                        self._server))
                 else:
-                    print('{} - started updating "{}" on {} for user {}...'.
-                          format(str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 
-                                 network_file_name,
-                                 self._server, 
-                                 self._user))
-                    self._ndex.update_cx_network(network_out, self._update_uuid)
-                    print('{} - finished updating "{}" on {} for user {}'.
-                          format(str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 
-                                 network_file_name,
-                                 self._server, 
-                                 self._user))
+                    send_cx = self._send_cx_gzip
+            # A new network may have been saved even though the request
+            # failed, so creating one is only retried when it cannot have
+            # reached NDEx
+            network_uuid = self._call_with_retries(
+                send_cx, cx_file_path,
+                idempotent=self._update_uuid is not None)
+            logger.info('finished {} "{}" on {} for user {}'.
+                        format(action,
+                               network_file_name,
+                               self._server,
+                               self._user))
+            self._log_transfer_stats()
+            stats = self._transfer_stats
+            self._metrics.add(STAGE_UPLOAD,
+                              bytes_written=(stats['raw']
+                                             if stats['compressed'] is None
+                                             else stats['compressed']))
+        except Exception as e:
+            logger.error('Upload of ' + network_file_name + ' failed: ' +
+                         str(e))
+            logger.error('unable to update or upload "{}" on {} for user {}'.
+                         format(network_file_name,
+                                self._server,
+                                self._user))
+            return 2
+
+        if not self._no_verify:
+            if not self._verify_upload(cx_file_path, network_uuid):
+                return 2
+        if self._skip_unchanged:
+            self._record_upload(upload_key, fingerprint, network_uuid)
+        return 0
+
+    def _get_fingerprint(self, cx_file_path):
+        """
+        Gets the SHA-256 fingerprint of a CX file, as computed while it was
+        written, or by reading it if it was not written by this run
+        """
+        fingerprint = self._cx_fingerprints.get(cx_file_path)
+        if fingerprint is None:
+            fingerprint = _get_cx_fingerprint(cx_file_path)
+            self._cx_fingerprints[cx_file_path] = fingerprint
+        return fingerprint
+
+    def _get_upload_key(self, network_file_name):
+        """
+        Gets the key under which uploads to the account, and to the
+        --updateuuid network or else of network_file_name, are recorded
+        in UPLOAD_STATE_FILE
+        """
+        if self._update_uuid is not None:
+            network = self._update_uuid
+        else:
+            network = network_file_name
+        return '{} {} {}'.format(self._server, self._user, network)
+
+    def _read_upload_state(self):
+        """
+        Reads UPLOAD_STATE_FILE
+        :return: dict of upload key to the fingerprint, network UUID and
+                 time of the last upload
+        """
+        state_file_path = self._get_file_path(UPLOAD_STATE_FILE)
+        try:
+            with open(state_file_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable ' + state_file_path + ': ' +
+                           str(e))
+            return {}
+
+    def _record_upload(self, upload_key, fingerprint, network_uuid):
+        """
+        Records an upload in UPLOAD_STATE_FILE. The file is locked while it
+        is updated, so that uploads to several targets at the same time
+        keep each other's records.
+        """
+        if not os.path.isdir(self._data_directory):
+            return
+        state_file_path = self._get_file_path(UPLOAD_STATE_FILE)
+        with _locked(state_file_path):
+            state = self._read_upload_state()
+            state[upload_key] = {'fingerprint': fingerprint,
+                                 'uuid': network_uuid,
+                                 'uploaded': datetime.now().isoformat()}
+            _write_json_atomically(state_file_path, state)
+
+    def _upload_cx_to_targets(self, cx_file_path, network_file_name):
+        """
+        Uploads the CX file to every --targets account at the same time, or
+        to the --profile account if there are no targets. Each target gets a
+        copy of the loader with its own credentials and NDEx connection.
+        :return: 0 if every upload succeeded, otherwise 2
+        """
+        if self._targets is None:
+            return_value = self._upload_cx(cx_file_path, network_file_name)
+            self._metrics.set_file_info(
+                uploads_skipped=int(self._upload_skipped))
+            return return_value
+
+        target_loaders = [self._get_target_loader(target)
+                          for target in self._targets]
+        with ThreadPoolExecutor(max_workers=len(target_loaders)) as executor:
+            futures = [executor.submit(target_loader._upload_cx_to_target,
+                                       target,
+                                       cx_file_path,
+                                       network_file_name)
+                       for target, target_loader in zip(self._targets,
+                                                        target_loaders)]
+            results = [future.result() for future in futures]
+
+        for target_loader, result in zip(target_loaders, results):
+            if result != 0:
+                outcome = 'failed'
+            elif target_loader._upload_skipped:
+                outcome = 'unchanged, not uploaded'
+            else:
+                outcome = 'succeeded'
+            logger.info('"{}" on {} for user {}: {}'.format(
+                network_file_name,
+                target_loader._server,
+                target_loader._user,
+                outcome))
+            stats = target_loader._transfer_stats
+            if stats is not None and stats['end'] is not None:
+                self._metrics.add(STAGE_UPLOAD,
+                                  bytes_written=(stats['raw']
+                                                 if stats['compressed'] is None
+                                                 else stats['compressed']))
+        self._metrics.set_file_info(
+            uploads_skipped=sum(target_loader._upload_skipped
+                                for target_loader in target_loaders))
+        if any(result != 0 for result in results):
+            return 2
+        return 0
+
+    def _get_target_loader(self, target):
+        """
+        Gets a copy of the loader that uploads to target. The first target
+        shares the connection made for --profile.
+        """
+        if target is self._targets[0] and target.get('ndex') is None:
+            target['ndex'] = self._ndex
+        target_loader = copy.copy(self)
+        target_loader._profile = target['profile']
+        target_loader._user = target['user']
+        target_loader._pass = target['pass']
+        target_loader._server = target['server']
+        target_loader._update_uuid = target['update_uuid']
+        target_loader._ndex = target.get('ndex')
+        target_loader._transfer_stats = None
+        target_loader._upload_skipped = False
+        target_loader._metrics = RunMetrics(get_cache_stats)
+        return target_loader
+
+    def _upload_cx_to_target(self, target, cx_file_path, network_file_name):
+        """
+        Connects to target, keeping the connection for later files, and
+        uploads the CX file to it
+        """
+        try:
+            target['ndex'] = self._create_ndex_connection()
+        except Exception as e:
+            logger.error('unable to connect to {} for user {}: {}'.format(
+                self._server,
+                self._user,
+                e))
+            return 2
+        return self._upload_cx(cx_file_path, network_file_name)
+
+    def _send_cx(self, cx_file_path):
+        """
+        Streams the CX file from disk to NDEx. The file is reopened on every
+        call so that a retry never sends a partially consumed stream.
+        :return: UUID of the created or updated network
+        """
+        size = _get_uncompressed_size(cx_file_path)
+        self._transfer_stats = {'start': time.time(), 'end': None,
+                                'raw': size, 'compressed': None}
+        with _open_cx_file(cx_file_path, 'rb') as cx_file:
+            network_out = _SizedReader(cx_file, size)
+            if self._update_uuid is None:
+                response = self._ndex.save_cx_stream_as_new_network(
+                    network_out)
+                network_uuid = str(response).strip().split('/')[-1]
+            else:
+                self._ndex.update_cx_network(network_out, self._update_uuid)
+                network_uuid = self._update_uuid
+        self._transfer_stats['end'] = time.time()
+        return network_uuid
+
+    def _send_cx_gzip(self, cx_file_path):
+        """
+        Same as _send_cx, but the multipart request body is gzip compressed
+        while it is streamed and sent with Content-Encoding: gzip. Ndex2
+        cannot send a compressed body, so the request is made the way its
+        post_multipart and put_multipart make it, on its session (which
+        holds the credentials). Only for v2 servers: v1.3 uses other
+        routes (/network/asCX).
+        :return: UUID of the created or updated network
+        """
+        from requests_toolbelt import MultipartEncoder
+        size = _get_uncompressed_size(cx_file_path)
+        self._transfer_stats = {'start': time.time(), 'end': None,
+                                'raw': 0, 'compressed': 0}
+        with _open_cx_file(cx_file_path, 'rb') as cx_file:
+            network_out = _SizedReader(cx_file, size)
+            multipart_data = MultipartEncoder(fields={
+                'CXNetworkStream': ('filename', network_out,
+                                    'application/octet-stream')
+            })
+            headers = {'Content-Type': multipart_data.content_type,
+                       'Content-Encoding': 'gzip',
+                       'User-Agent': self._ndex._get_user_agent(),
+                       'Connection': 'close'}
+            url = self._ndex.host + self._ndex.version_endpoint + '/network'
+            body = _iter_gzip(multipart_data, self._transfer_stats)
+            if self._update_uuid is None:
+                response = self._ndex.s.post(url, data=body, headers=headers,
+                                             timeout=self._ndex.timeout)
+            else:
+                response = self._ndex.s.put(url + '/' + self._update_uuid,
+                                            data=body, headers=headers,
+                                            timeout=self._ndex.timeout)
+            response.raise_for_status()
+        self._transfer_stats['end'] = time.time()
+        if self._update_uuid is None:
+            return response.text.strip().split('/')[-1]
+        return self._update_uuid
+
+    def _log_transfer_stats(self):
+        stats = self._transfer_stats
+        if stats is None or stats['end'] is None:
+            return
+        elapsed = stats['end'] - stats['start']
+        if stats['compressed'] is None:
+            logger.info('sent {} bytes in {:.1f} seconds'.format(
+                stats['raw'],
+                elapsed))
+        else:
+            logger.info('sent {} bytes compressed to {} bytes (ratio {:.1f}) '
+                        'in {:.1f} seconds'.format(
+                            stats['raw'],
+                            stats['compressed'],
+                            stats['raw'] / max(stats['compressed'], 1),
+                            elapsed))
 
+    def _call_with_retries(self, func, *args, idempotent=True):
+        """
+        Calls func, retrying transient failures with exponential backoff
+        and jitter up to self._upload_retries times
+        :param idempotent: False if calling func again after a failure that
+                           reached the server could do something twice
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
             except Exception as e:
-                print('{} - unable to update or upload "{}" on {} for user {}'.
-                      format(str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 
-                             network_file_name,
-                             self._server, 
-                             self._user))
+                if (attempt >= self._upload_retries or
+                        not self._is_retryable(e, idempotent)):
+                    raise
+                delay = self._get_backoff_delay(attempt)
+                attempt += 1
+                logger.warning('Attempt {} of {} failed ({}). Retrying in '
+                               '{:.1f} seconds'.format(
+                                   attempt, self._upload_retries + 1, e,
+                                   delay))
+                time.sleep(delay)
+
+    def _is_retryable(self, error, idempotent=True):
+        """
+        Connection problems, timeouts, server errors and throttling are
+        worth retrying; anything else (bad credentials, invalid CX) is not.
+        If the call is not idempotent, only failures to connect and
+        throttling are, as the server may have acted on the request before
+        any other failure.
+        """
+        import requests
+        if not idempotent:
+            if _is_connect_error(error):
+                return True
+        elif isinstance(error, (requests.exceptions.ConnectionError,
+                                requests.exceptions.Timeout)):
+            return True
+        response = getattr(error, 'response', None)
+        if response is not None and response.status_code is not None:
+            if response.status_code == 429:
+                return True
+            return idempotent and response.status_code >= 500
+        return False
+
+    def _get_backoff_delay(self, attempt):
+        delay = self._upload_backoff * (2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _get_cx_element_counts(self, cx_file_path):
+        """
+        Reads the node and edge counts from the post-metadata at the end of
+        a CX file without parsing the whole file
+        :return: tuple of (node count, edge count) or None if not found
+        """
+        with _open_cx_file(cx_file_path, 'rb') as cx_file:
+            if cx_file_path.endswith('.gz'):
+                # gzip streams cannot seek from the end
+                tail = b''
+                for chunk in iter(lambda: cx_file.read(CX_TAIL_SIZE), b''):
+                    tail = (tail + chunk)[-CX_TAIL_SIZE:]
+            else:
+                cx_file.seek(0, os.SEEK_END)
+                cx_file.seek(max(0, cx_file.tell() - CX_TAIL_SIZE))
+                tail = cx_file.read()
+        tail = tail.decode('utf-8', errors='ignore')
+        index = tail.rfind('{"metaData"')
+        if index < 0:
+            return None
+        try:
+            post_metadata, _ = json.JSONDecoder().raw_decode(tail, index)
+        except ValueError:
+            return None
+        counts = {}
+        for entry in post_metadata.get('metaData', []):
+            counts[entry.get('name')] = entry.get('elementCount')
+        if counts.get('nodes') is None or counts.get('edges') is None:
+            return None
+        return counts['nodes'], counts['edges']
+
+    def _get_completed_network_summary(self, network_uuid):
+        """
+        Polls NDEx until the network has been processed or VERIFY_TIMEOUT
+        seconds have passed
+        """
+        deadline = time.time() + VERIFY_TIMEOUT
+        attempt = 0
+        while True:
+            summary = self._call_with_retries(self._ndex.get_network_summary,
+                                              network_uuid)
+            if summary.get('completed', True) or time.time() >= deadline:
+                return summary
+            time.sleep(min(self._get_backoff_delay(attempt),
+                           max(0, deadline - time.time())))
+            attempt += 1
+
+    def _verify_upload(self, cx_file_path, network_uuid):
+        """
+        Checks the node and edge counts of the network on NDEx against the
+        counts in the CX file that was uploaded
+        :return: True if the counts match or cannot be determined
+        """
+        expected_counts = self._get_cx_element_counts(cx_file_path)
+        if expected_counts is None:
+            logger.warning('unable to find node and edge counts in "{}", '
+                           'skipping verification'.format(cx_file_path))
+            return True
+        try:
+            summary = self._get_completed_network_summary(network_uuid)
+        except Exception as e:
+            logger.error('unable to verify network {}: {}'.format(
+                network_uuid,
+                e))
+            return False
+        actual_counts = (summary.get('nodeCount'), summary.get('edgeCount'))
+        if actual_counts != expected_counts:
+            logger.error('network {} has {} nodes and {} edges, expected {} '
+                         'nodes and {} edges'.format(network_uuid,
+                                                     actual_counts[0],
+                                                     actual_counts[1],
+                                                     expected_counts[0],
+                                                     expected_counts[1]))
+            return False
+        return True
+
+    def _is_input_file(self, file_name):
+        """
+        Tells files of the data directory that are input apart from files
+        that result from this process
+        """
+        return not (file_name.startswith(RESULT_PREFIX) or
+                    file_name.startswith(INTERMEDIARY_PREFIX) or
+                    file_name.startswith(GENE_TYPES_PREFIX) or
+                    file_name.startswith(QUARANTINE_PREFIX) or
+                    file_name.startswith(DIFF_PREFIX) or
+                    file_name.startswith('.'))
+
+    def _load_file(self, file_name, file_path=None):
+        """
+        Loads one input file of the data directory into NDEx
+        :param file_path: path of the file, if it is not in the data
+                          directory
+        :return: 0 on success, otherwise 2
+        """
+        if file_path is None:
+            file_path = self._get_file_path(file_name)
+        return_value = 2
+        logger.info('started processing "{}"...'.format(file_name))
+        original_name = self._get_original_name(file_name)
+        self._metrics.start_file(file_name)
+        try:
+            with _TempFiles(keep=self._no_cleanup) as temp_files:
+                csv_file_path = None
+                result_tsv_file_path = None
+
+                if self._regions is not None:
+                    result_tsv_file_path = self._get_reusable_result(
+                        original_name, file_name)
+                if result_tsv_file_path is not None:
+                    logger.info('Using the reformatted file and index of '
+                                'an earlier run')
+                elif (self._store and self._get_reusable_store(
+                        original_name, file_name) is not None):
+                    # Edges are read from the store, not the input
+                    pass
+                elif not self._check_scratch_space([file_path]):
+                    return 2
+                elif self._file_is_xl(file_path):
+                    with self._stage(STAGE_XL_CONVERSION):
+                        csv_file_path = temp_files.add(
+                            self._convert_from_xl_to_tsv(file_path,
+                                                         original_name))
+                else:
+                    csv_file_path = file_path
+
+                # Check the rows before spending time on them (merged files
+                # are made of input files that have been checked already)
+                if (self._validate and csv_file_path is not None and
+                        self._merged_files is None):
+                    with self._stage(STAGE_VALIDATION):
+                        invalid = self._validate_input_file(csv_file_path,
+                                                            file_name)
+                    if invalid > 0 and not self._quarantine:
+                        logger.error('Not loading "{}" because it has '
+                                     'invalid rows. Fix them, or use '
+                                     '--quarantine to leave them '
+                                     'out'.format(file_name))
+                        return 2
+
+                # Reformat csv into network
+                if result_tsv_file_path is None:
+                    with self._stage(STAGE_REFORMAT):
+                        result_tsv_file_path = self._reformat_input_file(
+                            csv_file_path,
+                            original_name,
+                            file_name)
+                    if result_tsv_file_path is None:
+                        return 2
+                    temp_files.add(result_tsv_file_path)
+                    temp_files.add(result_tsv_file_path + INDEX_SUFFIX)
+
+                # Keep only the enhancers in the regions
+                network_tsv_file_path = result_tsv_file_path
+                if self._regions is not None:
+                    with self._stage(STAGE_REFORMAT):
+                        network_tsv_file_path = temp_files.add(
+                            self._extract_regions(result_tsv_file_path,
+                                                  original_name))
+
+                # Make and modify network
+                logger.info('generating network...')
+                with self._stage(STAGE_CX_GENERATION):
+                    cx_file_path = temp_files.add(
+                        self._generate_nice_cx_from_tsv(network_tsv_file_path,
+                                                        original_name))
+
+                # Upload network
+                with self._stage(STAGE_UPLOAD):
+                    return_value = self._upload_cx_to_targets(cx_file_path,
+                                                              file_name)
+        except Exception:
+            logger.exception('Unable to load ' + file_name)
+            return_value = 2
+        finally:
+            if return_value != 0:
+                self._write_gene_type_to_file('')
+            elif self._no_cleanup or self._update_gene_types:
+                self._write_gene_type_to_file(original_name)
+        return return_value
+
+    def _load_diff(self, old_file, new_file):
+        """
+        Loads the network of differences between two GeneHancer files made
+        by _write_diff
+        :return: 0 on success, otherwise 2
+        """
+        old_name = self._get_original_name(os.path.basename(old_file))
+        new_name = self._get_original_name(os.path.basename(new_file))
+        diff_name = new_name + '_vs_' + old_name
+        self._metrics.start_file(diff_name)
+        load_plan_file = self._load_plan_file
+        return_value = 2
+        try:
+            with _TempFiles(keep=self._no_cleanup) as temp_files:
+                old_file_path = self._get_diff_input_path(old_file)
+                new_file_path = self._get_diff_input_path(new_file)
+                if not self._check_scratch_space([old_file_path,
+                                                  new_file_path]):
+                    return 2
+                csv_file_paths = []
+                for file_path, original_name in [(old_file_path, old_name),
+                                                 (new_file_path, new_name)]:
+                    if self._file_is_xl(file_path):
+                        with self._stage(STAGE_XL_CONVERSION):
+                            file_path = temp_files.add(
+                                self._convert_from_xl_to_tsv(file_path,
+                                                             original_name))
+                    csv_file_paths.append(file_path)
+                with self._stage(STAGE_DIFF):
+                    result_tsv_file_path = temp_files.add(self._write_diff(
+                        csv_file_paths[0], csv_file_paths[1], diff_name,
+                        original_names=(old_name, new_name)))
+
+                load_plan_file_path = temp_files.add(self._get_scratch_path(
+                    RESULT_PREFIX + diff_name + '_loadplan.json'))
+                self._write_diff_load_plan(load_plan_file_path)
+                self._load_plan_file = load_plan_file_path
+                if self._style_network is None:
+                    self._get_style_network()
+                self._add_change_type_style()
+
+                logger.info('generating network...')
+                with self._stage(STAGE_CX_GENERATION):
+                    cx_file_path = temp_files.add(
+                        self._generate_nice_cx_from_tsv(result_tsv_file_path,
+                                                        diff_name))
+                with self._stage(STAGE_UPLOAD):
+                    return_value = self._upload_cx_to_targets(cx_file_path,
+                                                              diff_name)
+        except Exception:
+            logger.exception('Unable to load the changes from {} to {}'.format(
+                old_file, new_file))
+            return_value = 2
+        finally:
+            self._load_plan_file = load_plan_file
+            if (return_value != 0 or self._no_cleanup or
+                    self._update_gene_types):
+                self._write_gene_type_to_file(diff_name)
+        return return_value
+
+    def _get_diff_input_path(self, file_name):
+        """
+        Gets the path of a --diff file, looking in the data directory if it
+        is not a path to an existing file
+        """
+        if os.path.isfile(file_name):
+            return _get_path(file_name)
+        return self._get_file_path(file_name)
+
+    def _write_diff(self, old_file_path, new_file_path, diff_name,
+                    original_names=None):
+        """
+        Compares the edges of two GeneHancer files and writes the edges
+        that were added, removed or re-scored as a reformatted file with
+        DIFF_HEADER columns. The edges of both files are partitioned by
+        enhancer and joined one partition at a time, so memory use does not
+        grow with the input. Counts of every type of change are logged
+        and written to DIFF_PREFIX + diff_name + '.json'. Workbooks are
+        converted to tab separated files by _load_diff beforehand.
+        :param original_names: (old, new) names of the files in the counts,
+                               by default taken from the file paths
+        :return: path of the reformatted file
+        """
+        if self._gene_types is None:
+            self._get_gene_types()
+        if not self._update_gene_types and self._internal_gene_types is None:
+            self._internal_gene_types = {}
+        if original_names is None:
+            original_names = [
+                self._get_original_name(os.path.basename(file_path))
+                for file_path in [old_file_path, new_file_path]]
+        inputs = [('old', original_names[0], old_file_path),
+                  ('new', original_names[1], new_file_path)]
+
+        input_size = sum(_estimate_input_size(csv_file_path)
+                         for _, _, csv_file_path in inputs)
+        partitions = _EdgePartitions(
+            self._get_scratch_path(DIFF_PREFIX + diff_name + '.partitions'),
+            max(1, -(-input_size // PARTITION_SIZE)))
+        rows_in = 0
+        summary = {'old': inputs[0][1], 'new': inputs[1][1], 'unchanged': 0}
+        summary.update(dict.fromkeys(CHANGE_TYPES, 0))
+        result_tsv_file_path = self._get_scratch_path(
+            RESULT_PREFIX + diff_name + '.tsv')
+        try:
+            for side, original_name, csv_file_path in inputs:
+                logger.info('partitioning "{}"...'.format(
+                    os.path.basename(csv_file_path)))
+                progress = _Progress(os.path.basename(csv_file_path))
+                file_rows = 0
+                for (enhancer_id, enhancer_chrom, enhancer_start, enhancer_end,
+                     enhancer_confidence_score, enhancer_enhancer_type,
+                     genes) in self._iter_input_enhancers(csv_file_path,
+                                                          progress):
+                    rows_in += 1
+                    file_rows += 1
+                    progress.update(file_rows)
+                    for gene_name, gene_enhancer_score in genes:
+                        partitions.add(enhancer_id, [
+                            side, enhancer_id, enhancer_chrom, enhancer_start,
+                            enhancer_end, enhancer_confidence_score,
+                            enhancer_enhancer_type, gene_name,
+                            gene_enhancer_score])
+            partitions.close()
+
+            with open(result_tsv_file_path, 'w', encoding='utf-8',
+                      newline='') as write_file:
+                writer = csv.writer(write_file, delimiter='\t')
+                writer.writerow(DIFF_HEADER)
+                for i in range(partitions.count):
+                    changes = self._diff_partition(partitions.read(i))
+                    for (change_type, enhancer, gene_name, gene_enhancer_score,
+                         previous_score) in changes:
+                        summary[change_type] += 1
+                        if change_type == 'unchanged':
+                            continue
+                        writer.writerow([
+                            enhancer[0],
+                            self._get_rep(enhancer[0]),
+                            enhancer[1],
+                            enhancer[2],
+                            enhancer[3],
+                            enhancer[4],
+                            ENHANCER,
+                            enhancer[5],
+                            gene_name,
+                            self._get_rep(gene_name),
+                            gene_enhancer_score,
+                            GENE,
+                            self._get_gene_type(gene_name),
+                            change_type,
+                            previous_score
+                        ])
+        finally:
+            partitions.remove()
+
+        logger.info('{} edges added, {} removed, {} re-scored and {} '
+                    'unchanged from {} to {}'.format(summary['added'],
+                                                     summary['removed'],
+                                                     summary['rescored'],
+                                                     summary['unchanged'],
+                                                     summary['old'],
+                                                     summary['new']))
+        with open(self._get_file_path(DIFF_PREFIX + diff_name + '.json'),
+                  'w') as f:
+            json.dump(summary, f, indent=4)
+        self._diff_summary = summary
+        self._metrics.add(STAGE_DIFF,
+                          rows_in=rows_in,
+                          edges_out=sum(summary[change_type]
+                                        for change_type in CHANGE_TYPES),
+                          bytes_written=os.path.getsize(result_tsv_file_path))
+        return result_tsv_file_path
+
+    def _diff_partition(self, rows):
+        """
+        Joins the old and new edges of a partition on (enhancer, gene). An
+        edge found more than once in a file counts where it is first found.
+        :return: iterator of (change type, enhancer, gene name, score,
+                 previous score) tuples, where change type is one of
+                 CHANGE_TYPES or 'unchanged', enhancer is the (ID,
+                 chromosome, start, end, confidence score, enhancer type)
+                 of the newest file the edge is in, and previous score is
+                 the old score of re-scored and removed edges
+        """
+        edges = {'old': {}, 'new': {}}
+        for row in rows:
+            side_edges = edges[row[0]]
+            key = (row[1], row[7])
+            if key not in side_edges:
+                side_edges[key] = (tuple(row[1:7]), row[8])
+        old_edges = edges['old']
+        new_edges = edges['new']
+        for (enhancer_id, gene_name), (enhancer, score) in new_edges.items():
+            old_edge = old_edges.pop((enhancer_id, gene_name), None)
+            if old_edge is None:
+                yield 'added', enhancer, gene_name, score, ''
+            elif float(old_edge[1]) != float(score):
+                yield 'rescored', enhancer, gene_name, score, old_edge[1]
+            else:
+                yield 'unchanged', enhancer, gene_name, score, old_edge[1]
+        for (enhancer_id, gene_name), (enhancer, score) in old_edges.items():
+            yield 'removed', enhancer, gene_name, score, score
+
+    def _write_diff_load_plan(self, load_plan_file_path):
+        """
+        Writes the load plan with the ChangeType and
+        PreviousGeneEnhancerScore columns of a --diff network added as
+        edge attributes
+        """
+        with open(self._load_plan_file, 'r') as f:
+            load_plan = json.load(f)
+        load_plan['edge_plan'].setdefault('property_columns', []).extend([
+            {
+                "column_name": "ChangeType",
+                "attribute_name": "ChangeType"
+            },
+            {
+                "column_name": "PreviousGeneEnhancerScore",
+                "attribute_name": "PreviousGeneEnhancerScore",
+                "data_type": "double"
+            }
+        ])
+        with open(load_plan_file_path, 'w') as f:
+            json.dump(load_plan, f, indent=4)
+
+    def _add_change_type_style(self):
+        """
+        Maps the color and line type of edges from their ChangeType in the
+        style network
+        """
+        if self._style_network is None:
+            return
+        visual_properties = self._style_network.get_opaque_aspect(
+            'cyVisualProperties')
+        for element in visual_properties or []:
+            if element.get('properties_of') != 'edges:default':
+                continue
+            mappings = element.setdefault('mappings', {})
+            for visual_property, values in CHANGE_TYPE_STYLE.items():
+                definition = ['COL=ChangeType', 'T=string']
+                for i, (change_type, value) in enumerate(zip(CHANGE_TYPES,
+                                                             values)):
+                    definition.append('K={}={}'.format(i, change_type))
+                    definition.append('V={}={}'.format(i, value))
+                mappings[visual_property] = {
+                    'type': 'DISCRETE',
+                    'definition': ','.join(definition)}
+
+    def _load_merged_files(self):
+        """
+        Merges the input files of the data directory with _merge_input_files
+        and loads the result as one network. The files are not merged again
+        if the edges of an earlier merge of them can be reused, from a
+        --store or a reformatted file kept with --nocleanup.
+        :return: 0 on success, otherwise 2
+        """
+        file_names = sorted(
+            file_name for file_name in os.listdir(self._data_directory)
+            if self._is_input_file(file_name) and
+            os.path.isfile(self._get_file_path(file_name)))
+        if len(file_names) == 0:
+            logger.error("No files found in directory: {}".format(
+                self._data_directory))
+            return 2
+        self._merged_files = list(file_names)
+        merged_file_name = MERGE_NAME + '.tsv'
+        if self._has_reusable_edges(self._get_original_name(merged_file_name),
+                                    merged_file_name):
+            logger.info('Using the edges of an earlier merge of the input '
+                        'files')
+            return self._load_file(merged_file_name,
+                                   self._get_scratch_path(merged_file_name))
+        if not self._check_scratch_space([self._get_file_path(file_name)
+                                          for file_name in file_names]):
+            return 2
+        self._metrics.start_file(MERGE_NAME)
+        with _TempFiles(keep=self._no_cleanup) as temp_files:
+            try:
+                input_files = self._get_merge_inputs(file_names)
+                with self._stage(STAGE_MERGE):
+                    merged_file_path = temp_files.add(
+                        self._merge_input_files(input_files))
+            except Exception:
+                logger.exception('Unable to merge the input files')
                 return 2
-        return 0 
+            return self._load_file(os.path.basename(merged_file_path),
+                                   merged_file_path)
+
+    def _get_merge_inputs(self, file_names):
+        """
+        Converts the workbooks among the input files to tab separated files
+        and validates the input files if --validate is set. Both are timed
+        as their own stages rather than as part of the merge.
+        :return: list of (file name, original name, path of the file to
+                 read) tuples for _merge_input_files
+        """
+        input_files = []
+        for file_name in file_names:
+            original_name = self._get_original_name(file_name)
+            if self._file_is_xl(self._get_file_path(file_name)):
+                with self._stage(STAGE_XL_CONVERSION):
+                    csv_file_path = self._convert_from_xl_to_tsv(
+                        self._get_file_path(file_name), original_name)
+            else:
+                csv_file_path = self._get_file_path(file_name)
+            if self._validate:
+                with self._stage(STAGE_VALIDATION):
+                    invalid = self._validate_input_file(csv_file_path,
+                                                        file_name)
+                if invalid > 0 and not self._quarantine:
+                    raise ValueError('Not merging because "{}" has invalid '
+                                     'rows. Fix them, or use --quarantine to '
+                                     'leave them out'.format(file_name))
+            input_files.append((file_name, original_name, csv_file_path))
+        return input_files
+
+    def _merge_input_files(self, input_files):
+        """
+        Combines input files into one input file in which every
+        enhancer-gene pair is found once. Edges are partitioned by enhancer
+        into files of about PARTITION_SIZE bytes of input, and the
+        partitions are merged one at a time, so memory use does not grow
+        with the input.
+        :param input_files: input files as returned by _get_merge_inputs;
+                            converted workbooks are removed once read
+        :return: path of the merged file, MERGE_NAME + '.tsv' in the data
+                 directory
+        """
+        file_names = [file_name for file_name, _, _ in input_files]
+        input_size = sum(_estimate_input_size(csv_file_path)
+                         for _, _, csv_file_path in input_files)
+        partitions = _EdgePartitions(
+            self._get_scratch_path(MERGE_NAME + '.partitions'),
+            max(1, -(-input_size // PARTITION_SIZE)))
+        merged_file_path = self._get_scratch_path(MERGE_NAME + '.tsv')
+        rows_in = 0
+        edges_in = 0
+        edges_out = 0
+        try:
+            for file_name, original_name, csv_file_path in input_files:
+                logger.info('partitioning "{}"...'.format(file_name))
+                quarantine = None
+                if self._quarantine:
+                    quarantine = _Quarantine(
+                        self._get_file_path(
+                            QUARANTINE_PREFIX + original_name + '.tsv'),
+                        self._get_input_header(csv_file_path))
+                progress = _Progress(file_name)
+                file_rows = 0
+                try:
+                    for (enhancer_id, enhancer_chrom, enhancer_start,
+                         enhancer_end, enhancer_confidence_score,
+                         enhancer_enhancer_type,
+                         genes) in self._iter_input_enhancers(csv_file_path,
+                                                              progress,
+                                                              quarantine):
+                        rows_in += 1
+                        file_rows += 1
+                        progress.update(file_rows)
+                        for gene_name, gene_enhancer_score in genes:
+                            edges_in += 1
+                            partitions.add(enhancer_id, [
+                                enhancer_id, enhancer_chrom, enhancer_start,
+                                enhancer_end, enhancer_confidence_score,
+                                enhancer_enhancer_type, gene_name,
+                                gene_enhancer_score])
+                finally:
+                    if quarantine is not None:
+                        quarantine.close()
+                if csv_file_path != self._get_file_path(file_name):
+                    os.remove(csv_file_path)
+            partitions.close()
+
+            with open(merged_file_path, 'w', encoding='utf-8',
+                      newline='') as f:
+                writer = csv.writer(f, delimiter='\t')
+                if not self._no_header:
+                    writer.writerow(self._get_default_header())
+                for i in range(partitions.count):
+                    for row in self._merge_partition(partitions.read(i)):
+                        edges_out += row[-1].count(';connected_gene=')
+                        writer.writerow(row)
+        finally:
+            partitions.remove()
+
+        logger.info('Merged {} files with {} edges into {} edges'.format(
+            len(file_names), edges_in, edges_out))
+        self._merged_files = list(file_names)
+        self._metrics.add(STAGE_MERGE,
+                          rows_in=rows_in,
+                          edges_out=edges_out,
+                          bytes_written=os.path.getsize(merged_file_path))
+        return merged_file_path
+
+    def _merge_partition(self, rows):
+        """
+        Merges the edge rows of a partition, combining the scores of
+        enhancer-gene pairs found more than once as set by --aggregate
+        :return: list of input rows, one per enhancer in the order
+                 enhancers are first found
+        """
+        enhancers = {}
+        for (enhancer_id, enhancer_chrom, enhancer_start, enhancer_end,
+             enhancer_confidence_score, enhancer_enhancer_type, gene_name,
+             gene_enhancer_score) in rows:
+            enhancer = enhancers.get(enhancer_id)
+            if enhancer is None:
+                enhancer = enhancers[enhancer_id] = (
+                    [enhancer_chrom, 'GeneHancer', enhancer_enhancer_type,
+                     enhancer_start, enhancer_end, enhancer_confidence_score,
+                     '.', '.'],
+                    {})
+            genes = enhancer[1]
+            scores = genes.get(gene_name)
+            if scores is None:
+                genes[gene_name] = [gene_enhancer_score]
+            elif self._aggregate != 'first':
+                scores.append(gene_enhancer_score)
+
+        merged = []
+        for enhancer_id, (row, genes) in enhancers.items():
+            attributes = ['genehancer_id=' + enhancer_id]
+            for gene_name, scores in genes.items():
+                attributes.append('connected_gene=' + gene_name)
+                attributes.append('score=' + self._aggregate_scores(scores))
+            merged.append(row + [';'.join(attributes)])
+        return merged
+
+    def _aggregate_scores(self, scores):
+        if len(scores) == 1 or self._aggregate == 'first':
+            return scores[0]
+        if self._aggregate == 'max':
+            return max(scores, key=float)
+        return repr(round(sum(float(score) for score in scores) / len(scores),
+                          6))
+
+    def _watch_data_directory(self, max_polls=None):
+        """
+        Polls the data directory and loads every input file that is new or
+        has changed since it was loaded, once its size and modification
+        time have stayed the same for --settletime seconds. The loader and
+        everything it has loaded stay in memory between files. Files loaded
+        are recorded in WATCH_STATE_FILE, so a restarted watch only loads
+        files it has not loaded yet.
+        :param max_polls: number of polls after which to stop, or None to
+                          poll until interrupted
+        :return: 0
+        """
+        state_file_path = self._get_file_path(WATCH_STATE_FILE)
+        loaded = {}
+        if os.path.isfile(state_file_path):
+            try:
+                with open(state_file_path, 'r') as f:
+                    loaded = json.load(f)
+            except ValueError:
+                logger.warning('Ignoring unreadable ' + state_file_path)
+        failed = {}
+        changing = {}
+        polls = 0
+        logger.info('watching {} for new files...'.format(
+            self._data_directory))
+        try:
+            while max_polls is None or polls < max_polls:
+                if polls > 0:
+                    time.sleep(self._watch_interval)
+                polls += 1
+                now = time.time()
+                for file_name in sorted(os.listdir(self._data_directory)):
+                    file_path = self._get_file_path(file_name)
+                    if (not self._is_input_file(file_name) or
+                            not os.path.isfile(file_path)):
+                        continue
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    signature = [stat.st_size, stat.st_mtime]
+                    if (loaded.get(file_name) == signature or
+                            failed.get(file_name) == signature):
+                        continue
+                    if (file_name not in changing or
+                            changing[file_name][0] != signature):
+                        changing[file_name] = (signature, now)
+                    if now - changing[file_name][1] < self._settle_time:
+                        continue
+                    del changing[file_name]
+
+                    if self._load_file(file_name) == 0:
+                        loaded[file_name] = signature
+                        _write_json_atomically(state_file_path, loaded)
+                    else:
+                        logger.error('Loading {} failed; it is loaded again '
+                                     'once it changes'.format(file_name))
+                        failed[file_name] = signature
+                    if self._metrics_file is not None:
+                        self._metrics.write(self._metrics_file)
+        except KeyboardInterrupt:
+            logger.info('Stopped watching ' + self._data_directory)
+        return 0
 
     def run(self):
         try:
@@ -787,92 +4397,73 @@ class NDExGeneHancerLoader(object):
             """
             # Setup
             self._parse_config()
+            self._check_export_formats()
+            if self._region_args is not None or self._bed_file is not None:
+                try:
+                    self._regions = self._get_regions()
+                except (OSError, ValueError) as e:
+                    logger.error(str(e))
+                    return 2
+
+            # Upload a previously generated network
+            if self._cx_file is not None:
+                self._create_ndex_connection()
+                self._metrics.start_file(os.path.basename(self._cx_file))
+                with self._stage(STAGE_UPLOAD):
+                    return self._upload_cx_to_targets(
+                        _get_path(self._cx_file),
+                        os.path.basename(self._cx_file))
 
             # Check for data
             data_dir_exists = self._data_directory_exists()
             if data_dir_exists is False:
-                print('Data directory does not exist')
+                logger.error('Data directory does not exist')
                 return 2
 
-            #Connect to ndex
+            # Connect to ndex
             self._create_ndex_connection()
             if self._ndex is None:
-                print("Error occured while connecting to ndex")
+                logger.error("Error occured while connecting to ndex")
                 return 2
 
-            # Turn data into network
-            if len(os.listdir(self._data_directory)) == 0:
-                print("No files found in directory: {}".format(self._data_directory))
+            # Fetch the network attributes and style while the input is
+            # being read
+            self._prefetch_network_metadata()
+
+            if (self._scratch_dir is not None and not self._no_cleanup and
+                    not os.path.isdir(self._scratch_dir)):
+                logger.error('Scratch directory does not exist')
                 return 2
 
-            else:
-                for file_name in os.listdir(self._data_directory):
-                    try:
-                        return_value = None
+            # Turn data into network
+            with self._scratch():
+                if self._diff_files is not None:
+                    return self._load_diff(*self._diff_files)
+                if self._merge:
+                    return self._load_merged_files()
+                if self._watch:
+                    return self._watch_data_directory()
 
+                if len(os.listdir(self._data_directory)) == 0:
+                    logger.error("No files found in directory: {}".format(
+                        self._data_directory))
+                    return 2
+
+                else:
+                    for file_name in os.listdir(self._data_directory):
                         # Skip files that result from this process
-                        if (file_name.startswith(RESULT_PREFIX) or 
-                            file_name.startswith(INTERMEDIARY_PREFIX) or
-                            file_name.startswith(GENE_TYPES_PREFIX) or
-                            file_name.startswith('.')):
+                        if not self._is_input_file(file_name):
                             continue
+                        return self._load_file(file_name)
+        except Exception:
+            logger.exception('Unable to load GeneHancer data')
+        finally:
+            if self._metrics_file is not None:
+                self._metrics.write(self._metrics_file)
+                logger.info('Wrote metrics to ' + self._metrics_file)
+            if self._profiler is not None:
+                self._profiler.write()
 
-                        print('\n{} - started processing "{}"...'.format(
-                            str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 
-                            file_name))
-                        original_name = self._get_original_name(file_name)
-                        
-                        # Check for file type
-                        file_is_xl = self._file_is_xl(file_name)
-                        if file_is_xl:
-                            xl_file_path = self._get_file_path(file_name)
-                            csv_file_path = self._convert_from_xl_to_csv(xl_file_path, 
-                                                                        original_name)
-                        else:
-                            self._find_delimiter(file_name)
-                            csv_file_path = self._get_file_path(file_name)
-                        
-                        # Reformat csv into network
-                        result_tsv_file_path = self._reformat_input_file(
-                            csv_file_path, 
-                            original_name,
-                            file_name)
-
-                        # Make and modify network
-                        print('{} - generating network...'.format(
-                            str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))))
-                        cx_file_path = self._generate_nice_cx_from_tsv(
-                            result_tsv_file_path, 
-                            original_name)
-                        
-                        # Upload network
-                        return_value = self._upload_cx(cx_file_path, file_name)
-
-                    except Exception as e:
-                        print(e)
-                        print(traceback.format_exc())
-                        return 2
-                    finally:
-                        written = False
-                        if return_value is not None:
-                            if return_value == 0:
-                                if self._no_cleanup:
-                                    self._write_gene_type_to_file(original_name)
-                                    written = True
-                                else:
-                                    if file_is_xl:
-                                        os.remove(csv_file_path)
-                                    os.remove(result_tsv_file_path)
-                                    os.remove(cx_file_path)
-                            else:
-                                self._write_gene_type_to_file('')
-                                written = True
-                            return return_value
-                        if not written:
-                            self._write_gene_type_to_file('')
-        except Exception as e:
-            print(e)
-            print(traceback.format_exc())
 
 def main(args):
     """
@@ -884,20 +4475,20 @@ def main(args):
     Version {version}
 
     Loads GeneHancer data into NDEx (http://ndexbio.org).
-    
+
     To connect to NDEx server a configuration file must be passed
-    into --conf parameter. If --conf is unset, then ~/{confname} 
-    is examined. 
-         
+    into --conf parameter. If --conf is unset, then ~/{confname}
+    is examined.
+
     The configuration file should be formatted as follows:
-         
+
     [<value in --profile (default ndexgenehancerloader)>]
-         
+
     {user} = <NDEx username>
     {password} = <NDEx password>
     {server} = <NDEx server(omit http) ie public.ndexbio.org>
-    
-    
+
+
     """.format(confname=NDExUtilConfig.CONFIG_FILE,
                user=NDExUtilConfig.USER,
                password=NDExUtilConfig.PASSWORD,
@@ -910,7 +4501,7 @@ def main(args):
         _setup_logging(theargs)
         loader = NDExGeneHancerLoader(theargs)
         return loader.run()
-    except Exception as e:
+    except Exception:
         logger.exception('Caught exception')
         return 2
     finally:
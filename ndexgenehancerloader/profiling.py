@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""Run metrics and per stage profiling of the loader."""
+
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import json
+import pstats
+import time
+import tracemalloc
+
+import ndexgenehancerloader
+
+PROFILE_TOP = 25
+"""
+Number of functions and allocation sites listed per stage in profile
+summaries
+"""
+
+PROFILE_FRAMES = 10
+"""
+Number of frames tracemalloc records for each allocation
+"""
+
+
+class RunMetrics(object):
+    """
+    Collects wall time, CPU time and throughput counters for the stages of
+    every file that is loaded. The gene_typing stage times the typing of
+    genes that are not in the gene types yet. It happens while
+    reformatting, so its time is also included in the reformat stage.
+    """
+    STAGE_FIELDS = ['wall_time', 'cpu_time', 'rows_in', 'edges_out',
+                    'bytes_written']
+
+    def __init__(self, cache_stats=None):
+        """
+        :param cache_stats: function getting the counters of the memoized
+                            functions, such as get_cache_stats() of
+                            ndexloadgenehancer, whose hits and misses during
+                            the run are reported
+        """
+        self._started = datetime.now()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._files = []
+        self._current = None
+        self._cache_stats = cache_stats
+        self._cache_start = self._get_cache_stats()
+
+    def _get_cache_stats(self):
+        if self._cache_stats is None:
+            return {}
+        return self._cache_stats()
+
+    def start_file(self, file_name):
+        self._current = {'file': file_name, 'stages': {}}
+        self._files.append(self._current)
+
+    def set_file_info(self, **info):
+        """
+        Sets information about the current file, such as the fingerprint
+        of its network
+        """
+        if self._current is None:
+            self.start_file(None)
+        self._current.update(info)
+
+    def add(self, stage_name, **counts):
+        """
+        Adds counts (any of STAGE_FIELDS) to a stage of the current file
+        """
+        if self._current is None:
+            self.start_file(None)
+        stages = self._current['stages']
+        if stage_name not in stages:
+            stages[stage_name] = dict.fromkeys(self.STAGE_FIELDS, 0)
+        for field, value in counts.items():
+            stages[stage_name][field] += value
+
+    @contextmanager
+    def stage(self, stage_name):
+        """
+        Times the body of the with statement as stage_name
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(stage_name,
+                     wall_time=time.perf_counter() - wall_start,
+                     cpu_time=time.process_time() - cpu_start)
+
+    def get_report(self):
+        files = []
+        for file_metrics in self._files:
+            stages = {}
+            for stage_name, stage in file_metrics['stages'].items():
+                stage = dict(stage)
+                if stage['wall_time'] > 0:
+                    wall_time = stage['wall_time']
+                    stage['rows_per_second'] = stage['rows_in'] / wall_time
+                    stage['edges_per_second'] = stage['edges_out'] / wall_time
+                stages[stage_name] = stage
+            files.append(dict(file_metrics, stages=stages))
+        return {
+            'version': ndexgenehancerloader.__version__,
+            'started': self._started.isoformat(),
+            'wall_time': time.perf_counter() - self._wall_start,
+            'cpu_time': time.process_time() - self._cpu_start,
+            'files': files,
+            'caches': self._get_cache_report()
+        }
+
+    def _get_cache_report(self):
+        """
+        Gets the hits and misses of the memoized functions during this run
+        """
+        caches = {}
+        for name, stats in self._get_cache_stats().items():
+            start = self._cache_start.get(name, {})
+            stats['hits'] -= start.get('hits', 0)
+            stats['misses'] -= start.get('misses', 0)
+            lookups = stats['hits'] + stats['misses']
+            if lookups > 0:
+                stats['hit_rate'] = stats['hits'] / lookups
+            caches[name] = stats
+        return caches
+
+    def write(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump(self.get_report(), f, indent=4)
+
+
+class StageProfiler(object):
+    """
+    Profiles CPU time with cProfile and/or memory allocations with
+    tracemalloc separately for every stage of a run. Stages opened inside
+    another stage are attributed to the outermost one, since enabling
+    another profile stops the outer one and resetting the tracemalloc
+    peak loses the outer peak. Repeated runs of a stage are added up, so
+    the profiler does not grow with the number of files loaded
+    """
+    def __init__(self, cpu_file=None, mem_file=None):
+        """
+        :param cpu_file: file cProfile stats are written to, or None
+        :param mem_file: file tracemalloc snapshots are written to, or None
+        """
+        self._cpu_file = cpu_file
+        self._mem_file = mem_file
+        self._stage_names = []
+        self._open_stages = 0
+        self._cpu_stats = {}
+        self._mem_stages = {}
+        if self._mem_file is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_FRAMES)
+
+    @contextmanager
+    def stage(self, stage_name):
+        """
+        Profiles the body of the with statement as stage_name
+        """
+        if self._open_stages > 0:
+            yield
+            return
+        if stage_name not in self._stage_names:
+            self._stage_names.append(stage_name)
+        self._open_stages += 1
+        profile = None
+        if self._mem_file is not None:
+            start_snapshot = self._take_snapshot()
+            start_size = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        if self._cpu_file is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield
+        finally:
+            self._open_stages -= 1
+            if profile is not None:
+                profile.disable()
+                self._add_profile(stage_name, profile)
+            if self._mem_file is not None:
+                size, peak = tracemalloc.get_traced_memory()
+                end_snapshot = self._take_snapshot()
+                end_snapshot.dump(self._mem_file + '.' + stage_name)
+                self._add_mem_stage(
+                    stage_name, peak - start_size, size - start_size,
+                    end_snapshot.compare_to(start_snapshot,
+                                            'lineno')[:PROFILE_TOP])
+
+    def _add_profile(self, stage_name, profile):
+        stats = self._cpu_stats.get(stage_name)
+        if stats is None:
+            self._cpu_stats[stage_name] = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+
+    def _add_mem_stage(self, stage_name, peak, growth, top):
+        """
+        Adds a run of stage_name to its summary, which keeps the number of
+        runs, the net growth of all runs and the highest peak with the
+        allocation sites of that run
+        """
+        summary = self._mem_stages.get(stage_name)
+        if summary is None:
+            summary = {'runs': 0, 'peak': peak, 'growth': 0, 'top': top}
+            self._mem_stages[stage_name] = summary
+        summary['runs'] += 1
+        summary['growth'] += growth
+        if peak >= summary['peak']:
+            summary['peak'] = peak
+            summary['top'] = top
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>')
+        ])
+
+    def write(self):
+        """
+        Writes the stats and summaries of all stages profiled so far
+        """
+        if self._cpu_file is not None:
+            self._write_cpu_stats()
+        if self._mem_file is not None:
+            self._write_mem_stats()
+
+    def _write_cpu_stats(self):
+        all_stats = []
+        with open(self._cpu_file + '.txt', 'w') as summary:
+            for stage_name in self._stage_names:
+                stats = self._cpu_stats.get(stage_name)
+                if stats is None:
+                    continue
+                all_stats.append(stats)
+                stats.stream = summary
+                stats.dump_stats(self._cpu_file + '.' + stage_name)
+                summary.write('=== ' + stage_name + ' ===\n')
+                stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+                stats.sort_stats('tottime').print_stats(PROFILE_TOP)
+        if all_stats:
+            run_stats = pstats.Stats()
+            run_stats.add(*all_stats)
+            run_stats.dump_stats(self._cpu_file)
+
+    def _write_mem_stats(self):
+        self._take_snapshot().dump(self._mem_file)
+        with open(self._mem_file + '.txt', 'w') as summary:
+            for stage_name in self._stage_names:
+                stage = self._mem_stages.get(stage_name)
+                if stage is None:
+                    continue
+                summary.write('=== ' + stage_name + ' ===\n')
+                summary.write('{} runs, highest peak {} bytes above start, '
+                              'net growth {} bytes\n'.format(stage['runs'],
+                                                             stage['peak'],
+                                                             stage['growth']))
+                for stat in stage['top']:
+                    summary.write(str(stat) + '\n')
+                summary.write('\n')
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""Interval index and columnar store of reformatted edges."""
+
+from array import array
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+
+class EnhancerIndex(object):
+    """
+    Interval index over the enhancers of a reformatted file. The enhancers
+    of each chromosome are kept sorted by start location together with the
+    byte range of their rows in the file, so the rows of the enhancers
+    overlapping a region are found with a binary search and read directly.
+    """
+    def __init__(self, source=None, tsv_size=None):
+        """
+        :param source: dict describing the input file the index was made from
+        :param tsv_size: size of the reformatted file in bytes
+        """
+        self.source = source
+        self.tsv_size = tsv_size
+        self._entries = {}
+        self._starts = None
+        self._max_lengths = None
+
+    def add(self, chrom, start, end, offset, length):
+        """
+        Adds an enhancer whose rows take up length bytes from offset
+        """
+        self._entries.setdefault(chrom, []).append(
+            [start, end, offset, length])
+        self._starts = None
+
+    def _sort(self):
+        if self._starts is not None:
+            return
+        self._starts = {}
+        self._max_lengths = {}
+        for chrom, entries in self._entries.items():
+            entries.sort()
+            self._starts[chrom] = [entry[0] for entry in entries]
+            self._max_lengths[chrom] = max(entry[1] - entry[0]
+                                           for entry in entries)
+
+    def query(self, chrom, start, end):
+        """
+        Finds the enhancers on chrom that overlap start-end (inclusive).
+        Only enhancers starting less than the longest enhancer of the
+        chromosome before start are looked at.
+        :return: list of (offset, length) byte ranges of their rows
+        """
+        self._sort()
+        if chrom not in self._entries and not chrom.startswith('chr'):
+            chrom = 'chr' + chrom
+        if chrom not in self._entries:
+            return []
+        entries = self._entries[chrom]
+        starts = self._starts[chrom]
+        first = bisect.bisect_left(starts, start - self._max_lengths[chrom])
+        last = bisect.bisect_right(starts, end)
+        return [(entries[i][2], entries[i][3])
+                for i in range(first, last) if entries[i][1] >= start]
+
+    def write(self, index_file_path):
+        self._sort()
+        with open(index_file_path, 'w') as f:
+            json.dump({
+                'source': self.source,
+                'tsvSize': self.tsv_size,
+                'chromosomes': self._entries
+            }, f)
+
+    @staticmethod
+    def load(index_file_path):
+        with open(index_file_path, 'r') as f:
+            index_object = json.load(f)
+        index = EnhancerIndex(source=index_object['source'],
+                              tsv_size=index_object['tsvSize'])
+        index._entries = index_object['chromosomes']
+        return index
+
+
+def format_float32(value):
+    """
+    Formats a float32 with the fewest digits that read back as the same
+    float32, so that 0.35 is written as 0.35 and not 0.3499999940395355
+    """
+    for precision in range(1, 10):
+        text = '%.*g' % (precision, value)
+        if struct.unpack('f', struct.pack('f', float(text)))[0] == value:
+            return text
+    return repr(value)
+
+
+class EdgeColumns(object):
+    """
+    Compact table of edges, for anything that has to hold many edges in
+    memory. Locations and scores are kept in arrays of native numbers and
+    strings as int32 codes into a dictionary per column, so each distinct
+    enhancer, chromosome, gene or type is stored once. Rows are read back as
+    tuples of values in the order of COLUMNS.
+    """
+    COLUMNS = [
+        ('Enhancer', 'i'),
+        ('Chromosome', 'i'),
+        ('StartLocation', 'q'),
+        ('EndLocation', 'q'),
+        ('EnhancerConfidenceScore', 'f'),
+        ('EnhancerEnhancerType', 'i'),
+        ('Gene', 'i'),
+        ('GeneEnhancerScore', 'f'),
+        ('GeneGeneType', 'i')
+    ]
+    """
+    Columns as (name, array typecode); 'i' columns are dictionary encoded
+    """
+
+    def __init__(self):
+        self.arrays = {name: array(typecode)
+                       for name, typecode in EdgeColumns.COLUMNS}
+        self.dictionaries = {name: [] for name, typecode in EdgeColumns.COLUMNS
+                             if typecode == 'i'}
+        self._codes = {name: {} for name in self.dictionaries}
+
+    def __len__(self):
+        return len(self.arrays['Enhancer'])
+
+    def append(self, *values):
+        """
+        Adds an edge, with values in the order of COLUMNS
+        """
+        for (name, typecode), value in zip(EdgeColumns.COLUMNS, values):
+            if typecode == 'i':
+                codes = self._codes[name]
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes)
+                    self.dictionaries[name].append(value)
+                value = code
+            self.arrays[name].append(value)
+
+    def __getitem__(self, i):
+        values = []
+        for name, typecode in EdgeColumns.COLUMNS:
+            value = self.arrays[name][i]
+            if typecode == 'i':
+                value = self.dictionaries[name][value]
+            values.append(value)
+        return tuple(values)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class EdgeStore(object):
+    """
+    Columnar store of the edges of a reformatted file. Each column of
+    EdgeColumns is a file of native numbers in the store directory, with
+    the dictionaries of the encoded columns next to them. Columns are
+    memory mapped when read and only the columns asked for are opened.
+    """
+    VERSION = 1
+    META_FILE = 'meta.json'
+
+    def __init__(self, store_path, source=None):
+        """
+        :param store_path: directory of the store
+        :param source: dict describing the input file the store is made from
+        """
+        self.store_path = store_path
+        self.source = source
+        self.num_edges = 0
+        self._edges = None
+        self._mapped = []
+
+    def append(self, *values):
+        """
+        Adds an edge, with values in the order of EdgeColumns.COLUMNS
+        """
+        if self._edges is None:
+            self._edges = EdgeColumns()
+        self._edges.append(*values)
+        self.num_edges += 1
+
+    def save(self):
+        """
+        Writes the appended edges, replacing the store directory only once
+        all columns are written
+        """
+        temp_path = self.store_path + '.tmp'
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.mkdir(temp_path)
+        if self._edges is None:
+            self._edges = EdgeColumns()
+        for name, typecode in EdgeColumns.COLUMNS:
+            with open(os.path.join(temp_path, name + '.bin'), 'wb') as f:
+                self._edges.arrays[name].tofile(f)
+            if typecode == 'i':
+                with open(os.path.join(temp_path, name + '.json'), 'w') as f:
+                    json.dump(self._edges.dictionaries[name], f)
+        with open(os.path.join(temp_path, EdgeStore.META_FILE), 'w') as f:
+            json.dump({
+                'version': EdgeStore.VERSION,
+                'byteorder': sys.byteorder,
+                'source': self.source,
+                'numEdges': self.num_edges,
+                'columns': dict(EdgeColumns.COLUMNS)
+            }, f)
+        if os.path.exists(self.store_path):
+            shutil.rmtree(self.store_path)
+        os.rename(temp_path, self.store_path)
+
+    @staticmethod
+    def open(store_path):
+        """
+        Opens an existing store. No column is read until get_columns()
+        :raises ValueError: if the store was written by another version or
+                            on a machine of other byte order
+        """
+        with open(os.path.join(store_path, EdgeStore.META_FILE), 'r') as f:
+            meta = json.load(f)
+        if (meta['version'] != EdgeStore.VERSION or
+                meta['byteorder'] != sys.byteorder or
+                meta['columns'] != dict(EdgeColumns.COLUMNS)):
+            raise ValueError('Edge store ' + store_path + ' cannot be read')
+        store = EdgeStore(store_path, source=meta['source'])
+        store.num_edges = meta['numEdges']
+        return store
+
+    def get_columns(self, names):
+        """
+        Memory maps columns of the store
+        :return: dict of column name to a sequence of its values
+        """
+        typecodes = dict(EdgeColumns.COLUMNS)
+        columns = {}
+        for name in names:
+            if self.num_edges == 0:
+                columns[name] = array(typecodes[name])
+                continue
+            with open(os.path.join(self.store_path, name + '.bin'), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped).cast(typecodes[name])
+            self._mapped.append((view, mapped))
+            columns[name] = view
+        return columns
+
+    def get_dictionary(self, name):
+        """
+        :return: list of the strings of a dictionary encoded column, by code
+        """
+        with open(os.path.join(self.store_path, name + '.json'), 'r') as f:
+            return json.load(f)
+
+    def close(self):
+        for view, mapped in self._mapped:
+            view.release()
+            mapped.close()
+        self._mapped = []
@@ -18,15 +18,19 @@ with open('README.rst') as readme_file:
 with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = ['ndex2',
-                'ndexutil',
+# The loader subclasses StreamTSVLoader of ndexutil and overrides members
+# that are not public, so both stay within the versions tested
+requirements = ['ndex2>=3.2.0,<=4.0.0',
+                'ndexutil>=0.3.0,<=1.0.0',
                 'xlrd',
                 'mygene',
-                'pandas']
+                'requests',
+                # MultipartEncoder, to stream gzip compressed uploads
+                'requests_toolbelt']
 
 setup_requirements = []
 
-test_requirements = ['xlwt']
+test_requirements = ['pandas', 'xlwt']
 
 setup(
     author="Sophie Liu",
@@ -36,10 +40,11 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     description="Loads GeneHancer database to NDEx",
     install_requires=requirements,
@@ -49,6 +54,7 @@ setup(
     keywords='ndexgenehancerloader',
     name='ndexgenehancerloader',
     packages=find_packages(include=['ndexgenehancerloader']),
+    python_requires='>=3.7',
     package_dir={'ndexgenehancerloader': 'ndexgenehancerloader'},
     package_data={'ndexgenehancerloader': ['loadplan.json',
                                            'style.cx',
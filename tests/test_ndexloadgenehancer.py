@@ -8,12 +8,19 @@ import tempfile
 import shutil
 import unittest
 import csv
+import gzip
+import hashlib
 import json
+import logging
+import pstats
+import subprocess
 import sys
 from contextlib import contextmanager
-from io import StringIO
+from io import BytesIO, StringIO
 import traceback
+import tracemalloc
 import pandas as pd
+import requests
 import xlwt
 from xlwt import Workbook
 
@@ -21,6 +28,8 @@ from ndexutil.config import NDExUtilConfig
 import ndexgenehancerloader
 from ndexgenehancerloader import ndexloadgenehancer
 from ndexgenehancerloader.ndexloadgenehancer import NDExGeneHancerLoader
+from ndexgenehancerloader.profiling import RunMetrics
+from ndexgenehancerloader.store import EdgeStore
 import ndexutil.tsv.tsv2nicecx2 as t2n
 import ndex2
 from ndex2.client import Ndex2
@@ -35,6 +44,21 @@ def captured_output():
     finally:
         sys.stdout, sys.stderr = old_out, old_err
 
+@contextmanager
+def captured_logs():
+    """Captures the messages logged by ndexloadgenehancer, one per line"""
+    stream = StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    level = ndexloadgenehancer.logger.level
+    ndexloadgenehancer.logger.addHandler(handler)
+    ndexloadgenehancer.logger.setLevel(logging.DEBUG)
+    try:
+        yield stream
+    finally:
+        ndexloadgenehancer.logger.removeHandler(handler)
+        ndexloadgenehancer.logger.setLevel(level)
+
 class Param(object):
     """
     Dummy object
@@ -47,6 +71,65 @@ class dotdict(dict):
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
+class FakeNdex(object):
+    """
+    Stands in for Ndex2, failing the first 'failures' uploads
+    """
+    def __init__(self, failures=0, error=None, node_count=0, edge_count=0):
+        self.failures = failures
+        self.error = error
+        self.node_count = node_count
+        self.edge_count = edge_count
+        self.uploads = []
+        self.updated = []
+
+    def _upload(self, cx_stream):
+        self.uploads.append(cx_stream.read())
+        if self.failures > 0:
+            self.failures -= 1
+            raise self.error
+
+    def save_cx_stream_as_new_network(self, cx_stream):
+        self._upload(cx_stream)
+        return 'http://test_server/v2/network/new_uuid'
+
+    def update_cx_network(self, cx_stream, network_id):
+        self.updated.append(network_id)
+        self._upload(cx_stream)
+        return ''
+
+    def get_network_summary(self, network_id):
+        return {
+            'externalId': network_id,
+            'completed': True,
+            'nodeCount': self.node_count,
+            'edgeCount': self.edge_count
+        }
+
+class FakeResponse(object):
+    def __init__(self, text):
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+class FakeSession(object):
+    """
+    Stands in for the requests session of Ndex2
+    """
+    def __init__(self):
+        self.requests = []
+
+    def _send(self, method, url, data, headers, timeout):
+        self.requests.append((method, url, b''.join(data), headers))
+        return FakeResponse('http://test_server/v2/network/new_uuid')
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        return self._send('POST', url, data, headers, timeout)
+
+    def put(self, url, data=None, headers=None, timeout=None):
+        return self._send('PUT', url, data, headers, timeout)
+
 class TestNdexgenehancerloader(unittest.TestCase):
     """Tests for 'ndexgenehancerloader' package"""
 
@@ -154,8 +237,18 @@ class TestNdexgenehancerloader(unittest.TestCase):
         self.assertEqual(actual_profile, expected_profile)
 
     def test_get_default_gene_types_name(self):
-        actual_gene = ndexloadgenehancer._get_default_gene_types_name()
-        expected_gene = os.path.join(ndexloadgenehancer.get_package_dir(), ndexloadgenehancer.GENE_TYPES)
+        cache_home = os.environ.get('XDG_CACHE_HOME')
+        try:
+            os.environ['XDG_CACHE_HOME'] = self._args['datadir']
+            actual_gene = ndexloadgenehancer._get_default_gene_types_name()
+        finally:
+            if cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = cache_home
+        expected_gene = os.path.join(os.path.realpath(self._args['datadir']),
+                                     ndexloadgenehancer.CACHE_DIR,
+                                     ndexloadgenehancer.GENE_TYPES)
         self.assertEqual(actual_gene, expected_gene)
 
     def test_get_path(self):
@@ -163,6 +256,28 @@ class TestNdexgenehancerloader(unittest.TestCase):
         actual_path = ndexloadgenehancer._get_path('file')
         self.assertEqual(actual_path, expected_path)
 
+    def test_help_imports(self):
+        # --help does not import the dependencies of the loading stages or
+        # connect to mygene.info
+        script = ('import sys\n'
+                  'from ndexgenehancerloader import ndexloadgenehancer\n'
+                  'try:\n'
+                  '    ndexloadgenehancer.main(["ndexloadgenehancer.py", "--help"])\n'
+                  'except SystemExit:\n'
+                  '    pass\n'
+                  'modules = ["mygene", "pandas", "ndex2", "xlrd", "openpyxl",\n'
+                  '           "pyarrow", "ndexutil.tsv.streamtsvloader"]\n'
+                  'sys.stderr.write(repr([m for m in modules if m in sys.modules]))\n'
+                  'assert ndexloadgenehancer.mg is None\n')
+        process = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        self.assertEqual(process.stderr, '[]')
+        self.assertTrue('--datadir' in process.stdout)
+
     def test_parse_arguments(self):
         self.maxDiff = None
         desc = """
@@ -194,6 +309,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
         expected_default_args['stylefile'] = None
         expected_default_args['conf'] = ndexloadgenehancer._get_default_configuration_name()
         expected_default_args['profile'] = 'ndexgenehancerloader'
+        expected_default_args['targets'] = None
         expected_default_args['styleprofile'] = None
         expected_default_args['genetypes'] = None
         expected_default_args['networkattributes'] = None
@@ -202,6 +318,36 @@ class TestNdexgenehancerloader(unittest.TestCase):
         expected_default_args['verbose'] = 0
         expected_default_args['noheader'] = False
         expected_default_args['nocleanup'] = False
+        expected_default_args['minscore'] = None
+        expected_default_args['minconfidence'] = None
+        expected_default_args['topgenes'] = None
+        expected_default_args['topenhancers'] = None
+        expected_default_args['sample'] = None
+        expected_default_args['samplefraction'] = None
+        expected_default_args['diff'] = None
+        expected_default_args['merge'] = False
+        expected_default_args['aggregate'] = 'max'
+        expected_default_args['store'] = False
+        expected_default_args['validate'] = False
+        expected_default_args['quarantine'] = False
+        expected_default_args['region'] = None
+        expected_default_args['bed'] = None
+        expected_default_args['watch'] = False
+        expected_default_args['watchinterval'] = ndexloadgenehancer.WATCH_INTERVAL
+        expected_default_args['settletime'] = ndexloadgenehancer.WATCH_SETTLE_TIME
+        expected_default_args['cxfile'] = None
+        expected_default_args['uploadretries'] = ndexloadgenehancer.UPLOAD_RETRIES
+        expected_default_args['uploadbackoff'] = ndexloadgenehancer.UPLOAD_BACKOFF
+        expected_default_args['gzipupload'] = False
+        expected_default_args['nolayout'] = False
+        expected_default_args['export'] = None
+        expected_default_args['scratchdir'] = None
+        expected_default_args['gzipcx'] = False
+        expected_default_args['metricsout'] = None
+        expected_default_args['profilecpu'] = None
+        expected_default_args['profilemem'] = None
+        expected_default_args['noverify'] = False
+        expected_default_args['skipunchanged'] = False
 
         default_args = ndexloadgenehancer._parse_arguments(desc, args)
         self.assertDictEqual(default_args.__dict__, expected_default_args)
@@ -221,6 +367,9 @@ class TestNdexgenehancerloader(unittest.TestCase):
         args.append('new_conf')
         args.append('--profile')
         args.append('new_profile')
+        args.append('--targets')
+        args.append('target_1')
+        args.append('target_2:target_uuid')
         args.append('--styleprofile')
         args.append('new_style_profile')
         args.append('--genetypes')
@@ -234,6 +383,58 @@ class TestNdexgenehancerloader(unittest.TestCase):
         args.append('--verbose')
         args.append('--noheader')
         args.append('--nocleanup')
+        args.append('--minscore')
+        args.append('1.5')
+        args.append('--minconfidence')
+        args.append('0.2')
+        args.append('--topgenes')
+        args.append('3')
+        args.append('--topenhancers')
+        args.append('4')
+        args.append('--sample')
+        args.append('100')
+        args.append('--diff')
+        args.append('old_release')
+        args.append('new_release')
+        args.append('--merge')
+        args.append('--aggregate')
+        args.append('mean')
+        args.append('--store')
+        args.append('--validate')
+        args.append('--quarantine')
+        args.append('--region')
+        args.append('chr1:1-100')
+        args.append('--region')
+        args.append('chr2:5-10')
+        args.append('--bed')
+        args.append('new_bed')
+        args.append('--watch')
+        args.append('--watchinterval')
+        args.append('2.5')
+        args.append('--settletime')
+        args.append('0')
+        args.append('--cxfile')
+        args.append('new_cx_file')
+        args.append('--uploadretries')
+        args.append('5')
+        args.append('--uploadbackoff')
+        args.append('0.5')
+        args.append('--gzipupload')
+        args.append('--nolayout')
+        args.append('--scratchdir')
+        args.append('new_scratch_dir')
+        args.append('--export')
+        args.append('sif')
+        args.append('graphml')
+        args.append('--gzipcx')
+        args.append('--metricsout')
+        args.append('new_metrics_out')
+        args.append('--profilecpu')
+        args.append('new_profile_cpu')
+        args.append('--profilemem')
+        args.append('new_profile_mem')
+        args.append('--noverify')
+        args.append('--skipunchanged')
 
         expected_args = {}
         expected_args['datadir'] = 'new_dir'
@@ -243,6 +444,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
         expected_args['stylefile'] = 'new_style_file'
         expected_args['conf'] = 'new_conf'
         expected_args['profile'] = 'new_profile'
+        expected_args['targets'] = ['target_1', 'target_2:target_uuid']
         expected_args['styleprofile'] = 'new_style_profile'
         expected_args['genetypes'] = 'new_gene_types'
         expected_args['networkattributes'] = 'new_network_attributes'
@@ -251,6 +453,36 @@ class TestNdexgenehancerloader(unittest.TestCase):
         expected_args['verbose'] = 1
         expected_args['noheader'] = True
         expected_args['nocleanup'] = True
+        expected_args['minscore'] = 1.5
+        expected_args['minconfidence'] = 0.2
+        expected_args['topgenes'] = 3
+        expected_args['topenhancers'] = 4
+        expected_args['sample'] = 100
+        expected_args['samplefraction'] = None
+        expected_args['diff'] = ['old_release', 'new_release']
+        expected_args['merge'] = True
+        expected_args['aggregate'] = 'mean'
+        expected_args['store'] = True
+        expected_args['validate'] = True
+        expected_args['quarantine'] = True
+        expected_args['region'] = ['chr1:1-100', 'chr2:5-10']
+        expected_args['bed'] = 'new_bed'
+        expected_args['watch'] = True
+        expected_args['watchinterval'] = 2.5
+        expected_args['settletime'] = 0.0
+        expected_args['cxfile'] = 'new_cx_file'
+        expected_args['uploadretries'] = 5
+        expected_args['uploadbackoff'] = 0.5
+        expected_args['gzipupload'] = True
+        expected_args['nolayout'] = True
+        expected_args['export'] = ['sif', 'graphml']
+        expected_args['scratchdir'] = 'new_scratch_dir'
+        expected_args['gzipcx'] = True
+        expected_args['metricsout'] = 'new_metrics_out'
+        expected_args['profilecpu'] = 'new_profile_cpu'
+        expected_args['profilemem'] = 'new_profile_mem'
+        expected_args['noverify'] = True
+        expected_args['skipunchanged'] = True
 
         the_args = ndexloadgenehancer._parse_arguments(desc, args)
         self.assertDictEqual(the_args.__dict__, expected_args)
@@ -357,7 +589,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
             config.write(NDExUtilConfig.PASSWORD + ' = test_password\n')
             config.flush()
         try:
-            with captured_output() as (out, err):
+            with captured_logs() as out:
                 loader._parse_config()
             self.fail("Failed to throw exception when server was not in config")
         except:
@@ -370,7 +602,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
             config.write(NDExUtilConfig.SERVER + ' = test_server\n')
             config.flush()
         try:
-            with captured_output() as (out, err):
+            with captured_logs() as out:
                 loader._parse_config()
             self.fail("Failed to throw exception when password was not in config")
         except:
@@ -383,7 +615,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
             config.write(NDExUtilConfig.PASSWORD + ' = test_password\n')
             config.flush()
         try:
-            with captured_output() as (out, err):
+            with captured_logs() as out:
                 loader._parse_config()
             self.fail("Failed to throw exception when user was not in config")
         except:
@@ -396,7 +628,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
             config.write(NDExUtilConfig.PASSWORD + ' = test_password\n')
             config.flush()
         try:
-            with captured_output() as (out, err):
+            with captured_logs() as out:
                 loader._parse_config()
             self.fail("Failed to throw exception when profile was not in config")
         except:
@@ -451,7 +683,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
             config.write(ndexloadgenehancer.UUID + ' = test_uuid')
             config.flush()
         try:
-            with captured_output() as (out, err):
+            with captured_logs() as out:
                 loader = NDExGeneHancerLoader(self._args)
                 loader._parse_style_config()
                 self.assertEqual(
@@ -473,7 +705,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
             config.write(ndexloadgenehancer.UUID + ' = test_uuid')
             config.flush()
         try:
-            with captured_output() as (out, err):
+            with captured_logs() as out:
                 loader = NDExGeneHancerLoader(self._args)
                 loader._parse_style_config()
                 self.assertEqual(
@@ -495,7 +727,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
             config.write(ndexloadgenehancer.UUID + ' = test_uuid')
             config.flush()
         try:
-            with captured_output() as (out, err):
+            with captured_logs() as out:
                 loader = NDExGeneHancerLoader(self._args)
                 loader._parse_style_config()
                 self.assertEqual(
@@ -517,7 +749,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
             config.write(NDExUtilConfig.USER + ' = test_user\n')
             config.flush()
         try:
-            with captured_output() as (out, err):
+            with captured_logs() as out:
                 loader = NDExGeneHancerLoader(self._args)
                 loader._parse_style_config()
                 self.assertEqual(
@@ -532,16 +764,91 @@ class TestNdexgenehancerloader(unittest.TestCase):
         except:
             self.fail()
 
-    def test_find_delimiter(self):
-        loader = NDExGeneHancerLoader(self._args)
-        loader._find_delimiter('file.tsv')
-        self.assertEqual(loader.__getattribute__('_delimiter'), '\t')
-        loader._find_delimiter('file.csv')
-        self.assertEqual(loader.__getattribute__('_delimiter'), '\t')
+    def test_get_input_format(self):
+        header = ['#chrom', 'source', 'feature name', 'start', 'end',
+                  'score', 'strand', 'frame', 'attributes']
+        row = ['chr1', 'GeneHancer', 'Enhancer', '100', '200', '0.5', '.', '.',
+               'genehancer_id=GH01J000100;connected_gene=A;score=5.0']
+        datadir = self._args['datadir']
+        with open(os.path.join(datadir, 'header.txt'), 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(header)
+            writer.writerow(row)
+        with open(os.path.join(datadir, 'noheader.tsv'), 'w', newline='') as f:
+            csv.writer(f, delimiter=',').writerow(row)
+        with gzip.open(os.path.join(datadir, 'header.tsv.gz'), 'wt', newline='') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(header)
+            writer.writerow(row)
+        wb = Workbook()
+        sheet = wb.add_sheet('Sheet 1')
+        for j, value in enumerate(row):
+            sheet.write(0, j, value)
+        wb.save(os.path.join(datadir, 'workbook.dat'))
+        with open(os.path.join(datadir, 'table.parquet'), 'wb') as f:
+            f.write(b'PAR1')
 
-        loader.__setattr__('_delimiter', None)
-        loader._find_delimiter('file.csv')
-        self.assertEqual(loader.__getattribute__('_delimiter'), ',')
+        loader = NDExGeneHancerLoader(self._args)
+        cases = [
+            ('header.txt', 'delimited', {'delimiter': '\t'}, header),
+            ('noheader.tsv', 'delimited', {'delimiter': ','}, None),
+            ('header.tsv.gz', 'delimited', {'delimiter': ';'}, header),
+            ('workbook.dat', 'excel', {'xlsx': False}, None),
+            ('table.parquet', 'arrow', {'parquet': True}, None)
+        ]
+        for file_name, reader_name, options, expected_header in cases:
+            file_path = os.path.join(datadir, file_name)
+            reader, actual_options = loader._get_input_format(file_path)
+            self.assertEqual(reader.name, reader_name)
+            self.assertEqual(actual_options, options)
+            if reader_name == 'arrow':
+                continue
+            self.assertEqual(loader._read_input_header(file_path), expected_header)
+            self.assertEqual([line for line in loader._iter_input_rows(file_path)],
+                             [(2 if expected_header else 1, row)])
+        self.assertEqual(loader._get_original_name('header.tsv.gz'), 'header')
+
+        # --delimiter and --noheader take precedence over what is sniffed
+        loader = NDExGeneHancerLoader(self._args)
+        loader._delimiter = '|'
+        loader._no_header = True
+        file_path = os.path.join(datadir, 'header.txt')
+        self.assertEqual(loader._get_input_format(file_path)[1],
+                         {'delimiter': '|'})
+        self.assertIsNone(loader._read_input_header(file_path))
+
+        with open(os.path.join(datadir, 'binary.dat'), 'wb') as f:
+            f.write(b'\x00\x01\x02')
+        with self.assertRaises(ValueError):
+            loader._get_input_format(os.path.join(datadir, 'binary.dat'))
+
+    def test_register_input_reader(self):
+        class FixedWidthReader(ndexloadgenehancer.InputReader):
+            name = 'fixedwidth'
+
+            def sniff(self, file_name, head):
+                if file_name.endswith('.fw'):
+                    return {}
+                return None
+
+            def read(self, stream, options):
+                for line in stream:
+                    yield line.decode('utf-8').split()
+
+        file_path = os.path.join(self._args['datadir'], 'input.fw')
+        with open(file_path, 'w') as f:
+            f.write('chr1 GeneHancer Enhancer 100 200 0.5 . . '
+                    'genehancer_id=GH01J000100;connected_gene=A;score=5.0\n')
+        ndexloadgenehancer.register_input_reader(FixedWidthReader)
+        try:
+            self.assertEqual(ndexloadgenehancer.get_input_readers()[0].name,
+                             'fixedwidth')
+            loader = NDExGeneHancerLoader(self._args)
+            self.assertEqual(list(loader._iter_input_enhancers(file_path)), [
+                ('GH01J000100', 'chr1', '100', '200', '0.5', 'Enhancer',
+                 [('A', '5.0')])])
+        finally:
+            del ndexloadgenehancer._input_readers[0]
 
     def test_get_file_path(self):
         loader = NDExGeneHancerLoader(self._args)
@@ -561,7 +868,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
         loader = NDExGeneHancerLoader(self._args)
 
         loader.__setattr__('_gene_types_file', 'file')
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             loader._get_gene_types()
             self.assertEqual(
                 out.getvalue().strip(), 
@@ -645,7 +952,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
     def test_get_network_attributes_from_file_error(self):
         loader = NDExGeneHancerLoader(self._args)
         loader.__setattr__('_network_attributes_file', 'file')
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             loader._get_network_attributes()
             self.assertEqual(
                 out.getvalue().strip(), 
@@ -654,6 +961,80 @@ class TestNdexgenehancerloader(unittest.TestCase):
                 "Default network attributes will be used instead.")
             self.assertIsNotNone(loader._network_attributes)
 
+    def test_prefetch_network_metadata(self):
+        loader = NDExGeneHancerLoader(self._args)
+        loader._version = 'new_version'
+        loader._prefetch_network_metadata()
+        self.assertEqual(sorted(loader._prefetched),
+                         ['network_attributes', 'style_network'])
+        loader._get_network_attributes()
+        loader._get_style_network()
+        self.assertEqual(loader._prefetched, {})
+        self.assertIn({'n': 'version', 'v': 'new_version'},
+                      loader._network_attributes)
+        self.assertEqual(len(loader._style_network.get_nodes()), 13)
+
+        # Failures fall back to the default network attributes and style
+        class BrokenNdex(object):
+            def get_network_as_cx_stream(self, uuid):
+                raise requests.exceptions.ConnectionError('NDEx is down')
+
+        def broken_fetch():
+            raise RuntimeError('thread died')
+
+        class SharedNdex(object):
+            def get_network_as_cx_stream(self, uuid):
+                raise AssertionError('the client of the loader was shared')
+
+        # The background fetch has its own NDEx client
+        loader = NDExGeneHancerLoader(self._args)
+        loader._update_uuid = 'uuid'
+        loader._ndex = SharedNdex()
+        loader._create_ndex_client = BrokenNdex
+        loader._fetch_style_network = broken_fetch
+        with captured_logs() as out:
+            loader._prefetch_network_metadata()
+            loader._get_network_attributes()
+            loader._update_uuid = None
+            # Only the background fetch failed
+            del loader._fetch_style_network
+            loader._get_style_network()
+        self.assertIn('NDEx is down\nError while loading network attributes '
+                      'from NDEx. Default network attributes will be used '
+                      'instead.', out.getvalue())
+        self.assertIn('thread died\nError while fetching the style network in '
+                      'the background. They will be fetched again.',
+                      out.getvalue())
+        with open(ndexloadgenehancer._get_default_network_attributes_name()) as f:
+            self.assertEqual(loader._network_attributes, json.load(f)['attributes'])
+        self.assertEqual(len(loader._style_network.get_nodes()), 13)
+        self.assertNotIn('the client of the loader was shared', out.getvalue())
+
+    def test_fetch_style_network(self):
+        # Fetching sets nothing on the loader; the settings it used are
+        # returned to be set once the fetch is done
+        loader = NDExGeneHancerLoader(self._args)
+        loader._server = 'test_server'
+        loader._update_uuid = 'test_uuid'
+        loader._read_style_network_from_server = lambda *args: None
+        with captured_logs():
+            style_network, style = loader._fetch_style_network()
+        self.assertEqual(len(style_network.get_nodes()), 13)
+        self.assertEqual(style, {
+            '_style_server': 'test_server',
+            '_style_user': None,
+            '_style_pass': None,
+            '_style_uuid': 'test_uuid',
+            '_style_file': ndexloadgenehancer._get_default_style_file_name()})
+        self.assertIsNone(loader._style_uuid)
+        self.assertIsNone(loader._style_file)
+        self.assertIsNone(loader._style_network)
+
+        loader._get_style_network()
+        self.assertEqual(loader._style_uuid, 'test_uuid')
+        self.assertEqual(loader._style_file,
+                         ndexloadgenehancer._get_default_style_file_name())
+
     def test_get_style_network(self):
         # Setup
         loader = NDExGeneHancerLoader(self._args)
@@ -698,7 +1079,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
     def test_get_style_network_from_file_error(self):
         loader = NDExGeneHancerLoader(self._args)
         loader._style_file = 'file'
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             loader._get_style_network_from_file()
             self.assertEqual(
                 out.getvalue().strip(),
@@ -732,7 +1113,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
 
     def test_get_style_network_from_uuid_error(self):
         loader = NDExGeneHancerLoader(self._args)
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             loader._get_style_network_from_uuid()
             self.assertEqual(
                 out.getvalue().strip(),
@@ -795,29 +1176,17 @@ class TestNdexgenehancerloader(unittest.TestCase):
         self.assertFalse(loader._data_directory_exists())
 
     def test_file_is_xl(self):
-        xl_files = [
-            'file.xls',
-            'file.xlsx',
-            'file.xlsm',
-            'file.xlt',
-            'file.xltx',
-            'file.xltm',
-            'file.xla',
-            'file.xlam'
-        ]
-        non_xl_files = [
-            'file.csv',
-            'file.tsv',
-            'file.cx',
-            'file.png',
-            'file.jpg',
-            'file.xl.notxl'
-        ]
+        # Workbooks are told apart by their contents, not their names
+        xl_file = os.path.join(self._args['datadir'], 'file.tsv')
+        wb = Workbook()
+        wb.add_sheet('Sheet 1').write(0, 0, 'A')
+        wb.save(xl_file)
+        non_xl_file = os.path.join(self._args['datadir'], 'file.xls')
+        with open(non_xl_file, 'w') as f:
+            f.write('A\tB\n')
         loader = NDExGeneHancerLoader(self._args)
-        for file in xl_files:
-            self.assertTrue(loader._file_is_xl(file))
-        for file in non_xl_files:
-            self.assertFalse(loader._file_is_xl(file))
+        self.assertTrue(loader._file_is_xl(xl_file))
+        self.assertFalse(loader._file_is_xl(non_xl_file))
 
     def test_convert_from_xl_to_tsv(self):
         # Setup
@@ -1040,6 +1409,611 @@ class TestNdexgenehancerloader(unittest.TestCase):
         except Exception as e:
             self.fail('Exception during test_reformat_csv_file ' + str(e))
 
+    def _write_pruning_input_file(self):
+        input_file_path = os.path.join(self._args['datadir'], 'pruning.tsv')
+        with open(input_file_path, 'w') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['#chrom', 'source', 'feature name', 'start', 'end',
+                             'score', 'strand', 'frame', 'attributes'])
+            writer.writerow(['chr1', 'GeneHancer', 'Enhancer', '100', '200', '0.5',
+                             '.', '.', 'genehancer_id=GH1;connected_gene=A;score=5.0;'
+                             'connected_gene=B;score=1.0;connected_gene=C;score=3.0'])
+            writer.writerow(['chr1', 'GeneHancer', 'Enhancer', '300', '400', '0.1',
+                             '.', '.', 'genehancer_id=GH2;connected_gene=A;score=9.0;'])
+            writer.writerow(['chr2', 'GeneHancer', 'Enhancer', '100', '200', '0.9',
+                             '.', '.', 'genehancer_id=GH3;connected_gene=A;score=2.0;'
+                             'connected_gene=B;score=4.0'])
+        return input_file_path
+
+    def _write_invalid_input_file(self):
+        input_file_path = os.path.join(self._args['datadir'], 'invalid.tsv')
+        with open(input_file_path, 'w') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['#chrom', 'source', 'feature name', 'start', 'end',
+                             'score', 'strand', 'frame', 'attributes'])
+            writer.writerow(['chr1', 'GeneHancer', 'Enhancer', '100', '200', '0.5',
+                             '.', '.', 'genehancer_id=GH01J000100;'
+                             'connected_gene=A;score=5.0;'])
+            writer.writerow(['chr1', 'GeneHancer', 'Enhancer', '300', '400', '0.1',
+                             '.', '.', 'genehancer_id=GH01J000300;'
+                             'connected_gene=A;score'])
+            writer.writerow(['chr1', 'GeneHancer', 'Enhancer', '500'])
+            writer.writerow(['chr2', 'GeneHancer', 'Enhancer', '100', '200', '0.9',
+                             '.', '.', 'genehancer_id=GH02J000100;'
+                             'connected_gene=B;score=4.0'])
+        return input_file_path
+
+    def _write_merge_input_files(self):
+        header = ['#chrom', 'source', 'feature name', 'start', 'end',
+                  'score', 'strand', 'frame', 'attributes']
+        files = {
+            'full.tsv': [
+                ['chr1', 'GeneHancer', 'Enhancer', '100', '200', '0.5', '.', '.',
+                 'genehancer_id=GH01J000100;connected_gene=A;score=5.0;'
+                 'connected_gene=B;score=1.0'],
+                ['chr2', 'GeneHancer', 'Enhancer', '100', '200', '0.9', '.', '.',
+                 'genehancer_id=GH02J000100;connected_gene=A;score=2.0;']
+            ],
+            'elite.csv': [
+                ['chr1', 'GeneHancer', 'Promoter/Enhancer', '90', '200', '0.7',
+                 '.', '.', 'genehancer_id=GH01J000100;connected_gene=B;score=3.0;'
+                 'connected_gene=C;score=4.0'],
+                ['chr3', 'GeneHancer', 'Enhancer', '100', '200', '0.2', '.', '.',
+                 'genehancer_id=GH03J000100;connected_gene=C;score=1.5']
+            ]
+        }
+        for file_name, rows in files.items():
+            with open(os.path.join(self._args['datadir'], file_name), 'w') as f:
+                writer = csv.writer(f, delimiter=',' if file_name.endswith('csv')
+                                    else '\t')
+                writer.writerow(header)
+                writer.writerows(rows)
+        return sorted(files)
+
+    def test_merge_input_files(self):
+        file_names = self._write_merge_input_files()
+        partition_size = ndexloadgenehancer.PARTITION_SIZE
+        expected_enhancers = {
+            'GH01J000100': ['chr1', 'GeneHancer', 'Promoter/Enhancer', '90',
+                            '200', '0.7', '.', '.'],
+            'GH02J000100': ['chr2', 'GeneHancer', 'Enhancer', '100', '200',
+                            '0.9', '.', '.'],
+            'GH03J000100': ['chr3', 'GeneHancer', 'Enhancer', '100', '200',
+                            '0.2', '.', '.']
+        }
+        expected_scores = {
+            'max': {('GH01J000100', 'B'): '3.0'},
+            'mean': {('GH01J000100', 'B'): '2.0'},
+            'first': {('GH01J000100', 'B'): '3.0'}
+        }
+        try:
+            # Small partitions spread the enhancers over several files
+            ndexloadgenehancer.PARTITION_SIZE = 100
+            for aggregate in ndexloadgenehancer.AGGREGATIONS:
+                loader = NDExGeneHancerLoader(
+                    dotdict(dict(self._args, merge=True, aggregate=aggregate)))
+                with captured_logs() as out:
+                    merged_file_path = loader._merge_input_files(
+                        loader._get_merge_inputs(file_names))
+                self.assertEqual(loader._merged_files, file_names)
+                self.assertEqual(out.getvalue().strip().split('\n')[-1],
+                                 'Merged 2 files with 6 edges into 5 edges')
+                with open(merged_file_path, 'r') as f:
+                    rows = list(csv.reader(f, delimiter='\t'))
+                self.assertEqual(rows[0], ndexloadgenehancer.DEFAULT_HEADER)
+                enhancers = {}
+                scores = {}
+                for row in rows[1:]:
+                    attributes = row[8].split(';')
+                    enhancer_id = attributes[0].split('=')[1]
+                    enhancers[enhancer_id] = row[:8]
+                    for j in range(1, len(attributes), 2):
+                        scores[(enhancer_id, attributes[j].split('=')[1])] = \
+                            attributes[j+1].split('=')[1]
+                # Enhancers are described as where they are first found
+                self.assertEqual(enhancers, expected_enhancers)
+                expected = {
+                    ('GH01J000100', 'A'): '5.0',
+                    ('GH01J000100', 'C'): '4.0',
+                    ('GH02J000100', 'A'): '2.0',
+                    ('GH03J000100', 'C'): '1.5'
+                }
+                expected.update(expected_scores[aggregate])
+                self.assertEqual(scores, expected)
+                self.assertFalse(os.path.exists(merged_file_path[:-4] + '.partitions'))
+        finally:
+            ndexloadgenehancer.PARTITION_SIZE = partition_size
+
+    def test_write_diff(self):
+        header = ['#chrom', 'source', 'feature name', 'start', 'end',
+                  'score', 'strand', 'frame', 'attributes']
+        releases = {
+            'old.tsv': [
+                ['chr1', 'GeneHancer', 'Enhancer', '100', '200', '0.5', '.', '.',
+                 'genehancer_id=GH01J000100;connected_gene=A;score=5.0;'
+                 'connected_gene=B;score=1.0;connected_gene=C;score=2'],
+                ['chr2', 'GeneHancer', 'Enhancer', '100', '200', '0.9', '.', '.',
+                 'genehancer_id=GH02J000100;connected_gene=A;score=2.0']
+            ],
+            'new.tsv': [
+                ['chr1', 'GeneHancer', 'Enhancer', '100', '250', '0.6', '.', '.',
+                 'genehancer_id=GH01J000100;connected_gene=A;score=5;'
+                 'connected_gene=B;score=1.5;connected_gene=D;score=3.0'],
+                ['chr3', 'GeneHancer', 'Enhancer', '100', '200', '0.2', '.', '.',
+                 'genehancer_id=GH03J000100;connected_gene=C;score=1.5']
+            ]
+        }
+        for file_name, rows in releases.items():
+            with open(os.path.join(self._args['datadir'], file_name), 'w') as f:
+                writer = csv.writer(f, delimiter='\t')
+                writer.writerow(header)
+                writer.writerows(rows)
+        loader = NDExGeneHancerLoader(self._args)
+        loader._gene_types = dict.fromkeys('ABCD', 'Protein coding gene')
+        partition_size = ndexloadgenehancer.PARTITION_SIZE
+        try:
+            ndexloadgenehancer.PARTITION_SIZE = 100
+            with captured_output() as (out, err):
+                result_tsv_file_path = loader._write_diff(
+                    loader._get_diff_input_path('old.tsv'),
+                    loader._get_diff_input_path('new.tsv'),
+                    'new_vs_old')
+        finally:
+            ndexloadgenehancer.PARTITION_SIZE = partition_size
+
+        with open(result_tsv_file_path, 'r') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+        self.assertEqual(rows[0], ndexloadgenehancer.DIFF_HEADER)
+        self.assertEqual(sorted((row[0], row[4], row[8], row[10], row[13], row[14])
+                                for row in rows[1:]), [
+            ('GH01J000100', '200', 'C', '2', 'removed', '2'),
+            ('GH01J000100', '250', 'B', '1.5', 'rescored', '1.0'),
+            ('GH01J000100', '250', 'D', '3.0', 'added', ''),
+            ('GH02J000100', '200', 'A', '2.0', 'removed', '2.0'),
+            ('GH03J000100', '200', 'C', '1.5', 'added', '')
+        ])
+        summary = {'old': 'old', 'new': 'new', 'added': 2, 'removed': 2,
+                   'rescored': 1, 'unchanged': 1}
+        self.assertEqual(loader._diff_summary, summary)
+        summary_file_path = os.path.join(
+            os.path.realpath(self._args['datadir']),
+            ndexloadgenehancer.DIFF_PREFIX + 'new_vs_old.json')
+        with open(summary_file_path, 'r') as f:
+            self.assertEqual(json.load(f), summary)
+        self.assertEqual(sorted(os.listdir(self._args['datadir'])), [
+            os.path.basename(summary_file_path),
+            os.path.basename(result_tsv_file_path),
+            'new.tsv', 'old.tsv'])
+
+        # The network carries the counts and styles edges by change type
+        loader._get_network_attributes()
+        attributes = dict((attribute['n'], attribute['v'])
+                          for attribute in loader._network_attributes)
+        self.assertTrue(attributes['name'].endswith('(changes from old to new)'))
+        self.assertEqual(attributes['rescoredEdges'], 1)
+        loader._get_style_network()
+        loader._add_change_type_style()
+        for element in loader._style_network.get_opaque_aspect('cyVisualProperties'):
+            if element['properties_of'] == 'edges:default':
+                self.assertEqual(
+                    element['mappings']['EDGE_LINE_TYPE']['definition'],
+                    'COL=ChangeType,T=string,K=0=added,V=0=SOLID,'
+                    'K=1=removed,V=1=EQUAL_DASH,K=2=rescored,V=2=SOLID')
+
+    def test_load_diff(self):
+        header = ['#chrom', 'source', 'feature name', 'start', 'end',
+                  'score', 'strand', 'frame', 'attributes']
+        for file_name, score in [('old.tsv', '5.0'), ('new.tsv', '4.0')]:
+            with open(os.path.join(self._args['datadir'], file_name), 'w') as f:
+                writer = csv.writer(f, delimiter='\t')
+                writer.writerow(header)
+                writer.writerow(['chr1', 'GeneHancer', 'Enhancer', '100', '200',
+                                 '0.5', '.', '.', 'genehancer_id=GH01J000100;'
+                                 'connected_gene=A;score=' + score])
+        load_plan_file = ndexloadgenehancer._get_default_load_plan_name()
+        loader = NDExGeneHancerLoader(
+            dotdict(dict(self._args, loadplan=load_plan_file)))
+        loader._gene_types = {'A': 'Protein coding gene'}
+        loader._ndex = FakeNdex(node_count=2, edge_count=1)
+        with captured_logs():
+            self.assertEqual(loader._load_diff('old.tsv', 'new.tsv'), 0)
+        self.assertEqual(len(loader._ndex.uploads), 1)
+        # The load plan with the diff columns is only used for the diff
+        self.assertEqual(loader._load_plan_file, load_plan_file)
+        stages = loader._metrics.get_report()['files'][0]['stages']
+        self.assertEqual(stages['diff']['edges_out'], 1)
+
+    def test_row_validator(self):
+        validator = ndexloadgenehancer._RowValidator(
+            ndexloadgenehancer.DEFAULT_HEADER)
+        row = ['chr1', 'GeneHancer', 'Enhancer', '100', '200', '0.5', '.', '.',
+               'genehancer_id=GH01J000100;connected_gene=A;score=5.0;']
+        self.assertEqual(validator.check(row), [])
+        self.assertEqual(validator.check(row[:8]), ['8 columns instead of 9'])
+
+        def check(**changes):
+            changed = list(row)
+            for index, value in changes.items():
+                changed[int(index[1:])] = value
+            return validator.check(changed)
+
+        self.assertEqual(check(c3='1e2', c4='200.0'), [])
+        self.assertEqual(check(c3='abc'), ['start "abc" is not a location'])
+        self.assertEqual(check(c3='300'), ['start 300.0 is after end 200.0'])
+        self.assertEqual(check(c5='high'), ['score "high" is not a number'])
+        self.assertEqual(check(c8='genehancer_id=X1;connected_gene=A;score=1'),
+                         ['invalid enhancer ID "X1"'])
+        self.assertEqual(check(c8='connected_gene=A;score=1'),
+                         ['attributes do not start with genehancer_id=',
+                          'connected_gene without score'])
+        self.assertEqual(check(c8='genehancer_id=GH01J000100;connected_gene=A'),
+                         ['connected_gene without score'])
+        self.assertEqual(
+            check(c8='genehancer_id=GH01J000100;connected_gene=A;score=x;'
+                     'gene;score=1'),
+            ['score of A "x" is not a number', 'invalid gene "gene"'])
+        self.assertRaises(ValueError, ndexloadgenehancer._RowValidator,
+                          ['chrom', 'start', 'end'])
+
+    def test_validate_input_file(self):
+        input_file_path = self._write_invalid_input_file()
+        loader = NDExGeneHancerLoader(self._args)
+        loader._delimiter = '\t'
+        with captured_logs() as out:
+            self.assertEqual(loader._validate_input_file(input_file_path,
+                                                         'invalid.tsv'), 2)
+        output = out.getvalue().strip().split('\n')
+        self.assertEqual(output[:2], [
+            'invalid.tsv line 3: invalid score "score"',
+            'invalid.tsv line 4: 4 columns instead of 9'])
+        self.assertTrue(output[2].endswith('2 of 4 rows of invalid.tsv are invalid'))
+
+    def test_reformat_input_file_quarantine(self):
+        input_file_path = self._write_invalid_input_file()
+        loader = NDExGeneHancerLoader(self._args)
+        loader._delimiter = '\t'
+        loader._gene_types = {'A': 'Protein coding gene',
+                              'B': 'Protein coding gene'}
+
+        # Invalid rows stop the reformat with their line number
+        with captured_logs() as out:
+            self.assertIsNone(loader._reformat_input_file(
+                input_file_path, 'invalid', 'invalid.tsv'))
+        self.assertIn('Line 3 of ' + input_file_path +
+                      ' is invalid: invalid score "score"',
+                      out.getvalue())
+
+        # Or are left out and written to the quarantine file
+        loader._quarantine = True
+        with captured_logs() as out:
+            result_tsv_file_path = loader._reformat_input_file(
+                input_file_path, 'invalid', 'invalid.tsv')
+        with open(result_tsv_file_path, 'r') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+        self.assertEqual([(row[0], row[8]) for row in rows[1:]],
+                         [('GH01J000100', 'A'), ('GH02J000100', 'B')])
+        quarantine_file_path = os.path.join(
+            os.path.realpath(self._args['datadir']),
+            ndexloadgenehancer.QUARANTINE_PREFIX + 'invalid.tsv')
+        with open(quarantine_file_path, 'r') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+        self.assertEqual(rows[0][:3], ['line', 'problems', '#chrom'])
+        self.assertEqual([row[:2] for row in rows[1:]], [
+            ['3', 'invalid score "score"'],
+            ['4', '4 columns instead of 9']])
+        self.assertFalse(loader._is_input_file(
+            os.path.basename(quarantine_file_path)))
+
+    def test_progress(self):
+        progress = ndexloadgenehancer._Progress('input.tsv', total_bytes=1000,
+                                                interval=0)
+        progress._start -= 10
+        self.assertEqual(progress.get_message(200, 400),
+                         'input.tsv: 200 rows (20 rows/s), 400 edges (40 edges/s)')
+        progress.position = lambda: 250
+        self.assertTrue(progress.get_message(200, 400).endswith(
+            ', 25.0% of bytes read, ETA 0:00:30'))
+
+        # Only every PROGRESS_CHECK_ROWS rows is the clock looked at
+        with captured_logs() as out:
+            for rows in range(1, 2 * ndexloadgenehancer.PROGRESS_CHECK_ROWS + 1):
+                progress.update(rows, rows * 2)
+        lines = out.getvalue().strip().split('\n')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith(
+            'input.tsv: {} rows'.format(ndexloadgenehancer.PROGRESS_CHECK_ROWS)))
+
+        progress = ndexloadgenehancer._Progress('input.tsv')
+        with captured_logs() as out:
+            progress.update(ndexloadgenehancer.PROGRESS_CHECK_ROWS)
+        self.assertEqual(out.getvalue(), '')
+
+    def test_reformat_input_file_sample(self):
+        input_file_path = os.path.join(self._args['datadir'], 'sample.tsv')
+        with open(input_file_path, 'w') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['#chrom', 'source', 'feature name', 'start', 'end',
+                             'score', 'strand', 'frame', 'attributes'])
+            for i in range(40):
+                chrom = 'chr1' if i < 30 else 'chr2'
+                writer.writerow([chrom, 'GeneHancer', 'Enhancer', str(i * 1000),
+                                 str(i * 1000 + 500), '0.5', '.', '.',
+                                 'genehancer_id=GH0{}J{:06d};connected_gene=A;'
+                                 'score=1.0;connected_gene=B;score=2.0'
+                                 .format(chrom[-1], i)])
+
+        def get_sample(args):
+            loader = NDExGeneHancerLoader(dotdict(dict(self._args, **args)))
+            loader._delimiter = '\t'
+            loader._gene_types = {'A': 'Protein coding gene',
+                                  'B': 'Protein coding gene'}
+            with captured_logs() as out:
+                result_tsv_file_path = loader._reformat_input_file(
+                    input_file_path, 'sample', 'sample.tsv')
+            with open(result_tsv_file_path, 'r') as f:
+                rows = list(csv.reader(f, delimiter='\t'))[1:]
+            return out.getvalue(), rows
+
+        out, rows = get_sample({'sample': 8})
+        self.assertIn('Sampled 8 of 40 enhancers of sample.tsv', out)
+        enhancers = [row[0] for row in rows[::2]]
+        # Chromosomes are sampled in proportion, genes are all kept and
+        # enhancers stay in input order
+        self.assertEqual(len([e for e in enhancers if e.startswith('GH01')]), 6)
+        self.assertEqual(len([e for e in enhancers if e.startswith('GH02')]), 2)
+        self.assertEqual([row[8] for row in rows], ['A', 'B'] * 8)
+        self.assertEqual(enhancers, sorted(enhancers))
+        self.assertEqual(get_sample({'sample': 8})[1], rows)
+
+        out, rows = get_sample({'samplefraction': 0.5})
+        self.assertIn('Sampled 20 of 40 enhancers of sample.tsv', out)
+        self.assertEqual(len([row for row in rows[::2] if row[2] == 'chr2']), 5)
+
+        out, rows = get_sample({'sample': 100})
+        self.assertEqual(len(rows), 80)
+
+    def _get_pruned_edges(self, args, input_file_path=None):
+        if input_file_path is None:
+            input_file_path = self._write_pruning_input_file()
+        loader = NDExGeneHancerLoader(dotdict(dict(self._args, **args)))
+        loader._delimiter = '\t'
+        loader._gene_types = {'A': 'protein-coding gene',
+                              'B': 'protein-coding gene',
+                              'C': 'protein-coding gene'}
+        with captured_output() as (out, err):
+            result_tsv_file_path = loader._reformat_input_file(
+                input_file_path, 'pruning', 'pruning.tsv')
+        with open(result_tsv_file_path, 'r') as f:
+            return [(row[0], row[8], row[10])
+                    for row in csv.reader(f, delimiter='\t')][1:]
+
+    def test_reformat_input_file_pruning(self):
+        self.assertEqual(self._get_pruned_edges({}), [
+            ('GH1', 'A', '5.0'), ('GH1', 'B', '1.0'), ('GH1', 'C', '3.0'),
+            ('GH2', 'A', '9.0'), ('GH3', 'A', '2.0'), ('GH3', 'B', '4.0')
+        ])
+        self.assertEqual(self._get_pruned_edges({'minscore': 2.5}), [
+            ('GH1', 'A', '5.0'), ('GH1', 'C', '3.0'), ('GH2', 'A', '9.0'),
+            ('GH3', 'B', '4.0')
+        ])
+        self.assertEqual(self._get_pruned_edges({'minconfidence': 0.2}), [
+            ('GH1', 'A', '5.0'), ('GH1', 'B', '1.0'), ('GH1', 'C', '3.0'),
+            ('GH3', 'A', '2.0'), ('GH3', 'B', '4.0')
+        ])
+        self.assertEqual(self._get_pruned_edges({'topgenes': 2}), [
+            ('GH1', 'A', '5.0'), ('GH1', 'C', '3.0'), ('GH2', 'A', '9.0'),
+            ('GH3', 'A', '2.0'), ('GH3', 'B', '4.0')
+        ])
+        self.assertEqual(self._get_pruned_edges({'topenhancers': 1}), [
+            ('GH1', 'C', '3.0'), ('GH2', 'A', '9.0'), ('GH3', 'B', '4.0')
+        ])
+        # --topenhancers only ranks edges the other filters keep
+        self.assertEqual(self._get_pruned_edges({'minconfidence': 0.2,
+                                                 'topenhancers': 1}), [
+            ('GH1', 'A', '5.0'), ('GH1', 'C', '3.0'), ('GH3', 'B', '4.0')
+        ])
+
+    def test_get_regions(self):
+        bed_file = os.path.join(self._args['datadir'], 'regions.bed')
+        with open(bed_file, 'w') as f:
+            f.write('track name=test\n')
+            f.write('chr2\t99\t200\tname\n')
+            f.write('\n')
+        args = dotdict(dict(self._args, region=['chr1:1,000-2,000'], bed=bed_file))
+        loader = NDExGeneHancerLoader(args)
+        self.assertEqual(loader._get_regions(),
+                         [('chr1', 1000, 2000), ('chr2', 100, 200)])
+
+        loader._region_args = ['chr1-1000']
+        self.assertRaises(ValueError, loader._get_regions)
+        loader._region_args = None
+        with open(bed_file, 'w') as f:
+            f.write('chr2\tstart\tend\n')
+        self.assertRaises(ValueError, loader._get_regions)
+
+    def test_extract_regions(self):
+        input_file_path = self._write_pruning_input_file()
+        loader = NDExGeneHancerLoader(self._args)
+        loader._delimiter = '\t'
+        loader._gene_types = {'A': 'protein-coding gene',
+                              'B': 'protein-coding gene',
+                              'C': 'protein-coding gene'}
+        with captured_output() as (out, err):
+            result_tsv_file_path = loader._reformat_input_file(
+                input_file_path, 'pruning', 'pruning.tsv')
+        self.assertTrue(os.path.exists(
+            result_tsv_file_path + ndexloadgenehancer.INDEX_SUFFIX))
+        self.assertEqual(loader._get_reusable_result('pruning', 'pruning.tsv'),
+                         result_tsv_file_path)
+
+        loader._regions = [('chr1', 150, 350), ('chr2', 150, 150)]
+        with captured_output() as (out, err):
+            region_tsv_file_path = loader._extract_regions(result_tsv_file_path,
+                                                           'pruning')
+        with open(region_tsv_file_path, 'r') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+        self.assertEqual(rows[0], loader._get_output_header())
+        self.assertEqual([(row[0], row[8]) for row in rows[1:]], [
+            ('GH1', 'A'), ('GH1', 'B'), ('GH1', 'C'), ('GH2', 'A'),
+            ('GH3', 'A'), ('GH3', 'B')
+        ])
+
+        loader._regions = [('chr1', 201, 299), ('chr2', 150, 300)]
+        with captured_output() as (out, err):
+            region_tsv_file_path = loader._extract_regions(result_tsv_file_path,
+                                                           'pruning')
+        with open(region_tsv_file_path, 'r') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+        self.assertEqual([(row[0], row[8]) for row in rows[1:]],
+                         [('GH3', 'A'), ('GH3', 'B')])
+
+        # The index is not reused once the input or the options change
+        loader._min_score = 2.5
+        self.assertIsNone(loader._get_reusable_result('pruning', 'pruning.tsv'))
+
+    def test_watch_data_directory(self):
+        data_dir = self._args['datadir']
+        args = dotdict(dict(self._args, watch=True, watchinterval=0,
+                            settletime=0))
+
+        def get_loader(results=None):
+            loader = NDExGeneHancerLoader(args)
+            loader.loaded = []
+
+            def load_file(file_name):
+                loader.loaded.append(file_name)
+                return (results or {}).get(file_name, 0)
+            loader._load_file = load_file
+            return loader
+
+        for file_name in ['a.tsv', 'b.tsv', '_result_a.tsv', '.hidden']:
+            with open(os.path.join(data_dir, file_name), 'w') as f:
+                f.write('x')
+        os.mkdir(os.path.join(data_dir, 'subdir'))
+
+        loader = get_loader(results={'b.tsv': 2})
+        with captured_output() as (out, err):
+            self.assertEqual(loader._watch_data_directory(max_polls=2), 0)
+        self.assertEqual(loader.loaded, ['a.tsv', 'b.tsv'])
+        self.assertTrue(os.path.isfile(
+            os.path.join(data_dir, ndexloadgenehancer.WATCH_STATE_FILE)))
+
+        # A restarted watch only loads what it did not load before
+        loader = get_loader()
+        with captured_output() as (out, err):
+            loader._watch_data_directory(max_polls=1)
+        self.assertEqual(loader.loaded, ['b.tsv'])
+
+        # Changed files are loaded again
+        with open(os.path.join(data_dir, 'a.tsv'), 'a') as f:
+            f.write('more')
+        loader = get_loader()
+        with captured_output() as (out, err):
+            loader._watch_data_directory(max_polls=1)
+        self.assertEqual(loader.loaded, ['a.tsv'])
+
+        # New files wait until they have settled
+        with open(os.path.join(data_dir, 'c.tsv'), 'w') as f:
+            f.write('x')
+        loader = get_loader()
+        loader._settle_time = 3600
+        with captured_output() as (out, err):
+            loader._watch_data_directory(max_polls=2)
+        self.assertEqual(loader.loaded, [])
+
+    def test_reformat_input_file_store(self):
+        input_file_path = self._write_pruning_input_file()
+        first_rows = self._get_pruned_edges({'store': True}, input_file_path)
+        store_path = os.path.join(self._args['datadir'],
+                                  ndexloadgenehancer.RESULT_PREFIX + 'pruning' +
+                                  ndexloadgenehancer.STORE_SUFFIX)
+        self.assertTrue(os.path.isdir(store_path))
+
+        # Later runs read the store, not the input
+        original_iter = NDExGeneHancerLoader._iter_input_enhancers
+        NDExGeneHancerLoader._iter_input_enhancers = None
+        try:
+            self.assertEqual(self._get_pruned_edges({'store': True}, input_file_path),
+                             [(e, g, str(float(score)).rstrip('0').rstrip('.'))
+                              for e, g, score in first_rows])
+            self.assertEqual(self._get_pruned_edges({'store': True, 'minscore': 2.5},
+                                                    input_file_path), [
+                ('GH1', 'A', '5'), ('GH1', 'C', '3'), ('GH2', 'A', '9'),
+                ('GH3', 'B', '4')
+            ])
+        finally:
+            NDExGeneHancerLoader._iter_input_enhancers = original_iter
+
+        # A store of pruned edges is only reused with the same options
+        shutil.rmtree(store_path)
+        self._get_pruned_edges({'store': True, 'topgenes': 1}, input_file_path)
+        loader = NDExGeneHancerLoader(dotdict(dict(self._args, store=True, topgenes=1)))
+        self.assertIsNotNone(loader._get_reusable_store('pruning', 'pruning.tsv'))
+        loader._top_genes = None
+        self.assertIsNone(loader._get_reusable_store('pruning', 'pruning.tsv'))
+
+    def test_run_merge_store(self):
+        data_dir = os.path.join(self._args['datadir'], 'data')
+        os.mkdir(data_dir)
+        for file_name in self._write_merge_input_files():
+            os.rename(os.path.join(self._args['datadir'], file_name),
+                      os.path.join(data_dir, file_name))
+        conf_file = os.path.join(self._args['datadir'], 'conf')
+        with open(conf_file, 'w') as cf:
+            cf.write('[profile]\nuser = test_user\npassword = test_password\n'
+                     'server = test_server')
+        gene_types_file = os.path.join(self._args['datadir'], 'genetypes.json')
+        with open(gene_types_file, 'w') as f:
+            json.dump(dict.fromkeys('ABC', 'Protein coding gene'), f)
+        args = dotdict(dict(self._args,
+                            datadir=data_dir,
+                            conf=conf_file,
+                            profile='profile',
+                            loadplan=ndexloadgenehancer._get_default_load_plan_name(),
+                            genetypes=gene_types_file,
+                            merge=True,
+                            store=True))
+        store_path = os.path.join(data_dir,
+                                  ndexloadgenehancer.RESULT_PREFIX +
+                                  ndexloadgenehancer.MERGE_NAME +
+                                  ndexloadgenehancer.STORE_SUFFIX)
+        loader = NDExGeneHancerLoader(args)
+        loader._ndex = FakeNdex(node_count=6, edge_count=5)
+        with captured_logs():
+            self.assertEqual(loader.run(), 0)
+        self.assertTrue(os.path.isdir(store_path))
+        source = EdgeStore.open(store_path).source
+        self.assertEqual(source['files'], ['elite.csv', 'full.tsv'])
+        self.assertEqual(source['aggregate'], 'max')
+
+        # A later merge of the same files reads the store instead of merging
+        loader = NDExGeneHancerLoader(args)
+        loader._ndex = FakeNdex(node_count=6, edge_count=5)
+        loader._merge_input_files = None
+        loader._iter_input_enhancers = None
+        with captured_logs() as out:
+            self.assertEqual(loader.run(), 0)
+        self.assertIn('Using the edges of an earlier merge', out.getvalue())
+        self.assertEqual(len(loader._ndex.uploads), 1)
+
+        # Merges aggregated another way do not use it
+        loader = NDExGeneHancerLoader(dotdict(dict(args, aggregate='mean')))
+        loader._merged_files = ['elite.csv', 'full.tsv']
+        self.assertFalse(loader._has_reusable_edges(
+            ndexloadgenehancer.MERGE_NAME, ndexloadgenehancer.MERGE_NAME + '.tsv'))
+
+    def test_get_network_attributes_pruning(self):
+        args = dotdict(dict(self._args, minscore=2.5, topenhancers=1))
+        loader = NDExGeneHancerLoader(args)
+        loader._get_network_attributes()
+        attributes = {a['n']: a for a in loader._network_attributes}
+        self.assertEqual(attributes['minimumGeneEnhancerScore'],
+                         {'n': 'minimumGeneEnhancerScore', 'v': 2.5, 'd': 'double'})
+        self.assertEqual(attributes['topEnhancersPerGene'],
+                         {'n': 'topEnhancersPerGene', 'v': 1, 'd': 'integer'})
+        self.assertNotIn('minimumEnhancerConfidenceScore', attributes)
+        self.assertNotIn('topGenesPerEnhancer', attributes)
+
     def test_get_gene_type_no_update(self):
         self._args['genetypes'] = 'file'
         loader = NDExGeneHancerLoader(self._args)
@@ -1201,6 +2175,37 @@ class TestNdexgenehancerloader(unittest.TestCase):
             new_internal_gene_types = json.load(gt)
         self.assertEqual(new_internal_gene_types, internal_gene_types)
 
+    def test_write_gene_type_to_file_merge(self):
+        gene_types_file = os.path.join(self._args['datadir'], 'cache',
+                                       'types.json')
+        first = NDExGeneHancerLoader(self._args)
+        second = NDExGeneHancerLoader(self._args)
+        for loader in [first, second]:
+            loader._update_gene_types = True
+            loader._gene_types_file = gene_types_file
+            loader._gene_types = {'shared': 'ncRNA gene'}
+        first._gene_types['A'] = 'Protein coding gene'
+        second._gene_types['B'] = 'Other gene'
+
+        # Runs that share the file keep each other's gene types
+        self.assertEqual(first._write_gene_type_to_file(''), gene_types_file)
+        self.assertEqual(second._write_gene_type_to_file(''), gene_types_file)
+        expected = {'shared': 'ncRNA gene', 'A': 'Protein coding gene',
+                    'B': 'Other gene'}
+        with open(gene_types_file, 'r') as f:
+            self.assertEqual(json.load(f), expected)
+        self.assertEqual(second._gene_types, expected)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(gene_types_file))),
+                         ['types.json', 'types.json' + ndexloadgenehancer.LOCK_SUFFIX])
+
+        # A corrupt file is replaced
+        with open(gene_types_file, 'w') as f:
+            f.write('{"A": ')
+        with captured_output() as (out, err):
+            first._write_gene_type_to_file('')
+        with open(gene_types_file, 'r') as f:
+            self.assertEqual(json.load(f), first._gene_types)
+
     def test_map_gene_type(self):
         loader = NDExGeneHancerLoader(self._args)
 
@@ -1253,6 +2258,36 @@ class TestNdexgenehancerloader(unittest.TestCase):
                     ndexloadgenehancer.RESULT_PREFIX + 'file.cx')))
         self.assertIsNotNone(loader.__getattribute__('_network_attributes'))
         self.assertIsNotNone(loader.__getattribute__('_style_network'))
+
+    def test_stream_tsv_loader_members(self):
+        # The loader classes override members of StreamTSVLoader and its
+        # CXStreamWriter that are not public, so check that the installed
+        # ndexutil still has them
+        from ndexutil.tsv.streamtsvloader import (CXStreamWriter,
+                                                  StreamTSVLoader)
+        for name in ['write_cx_network', '_create_edge', '_create_attr_obj',
+                     '_print_batch']:
+            self.assertTrue(callable(getattr(StreamTSVLoader, name, None)),
+                            name)
+        for name in ['write_pre_metadata', 'write_aspect_fragment',
+                     'write_post_metadata']:
+            self.assertTrue(callable(getattr(CXStreamWriter, name, None)),
+                            name)
+
+        load_plan_file = os.path.join(self._args['datadir'], 'loadplan.json')
+        with open(load_plan_file, 'w') as lpf:
+            json.dump(self._load_plan, lpf, indent=4)
+        tsv = StringIO()
+        writer = csv.writer(tsv, delimiter='\t')
+        writer.writerow(self._network_data_header)
+        writer.writerows(self._network_data)
+        tsv.seek(0)
+        loader = StreamTSVLoader(load_plan_file, None)
+        loader.write_cx_network(tsv, StringIO())
+        self.assertIsInstance(loader.cxWriter, CXStreamWriter)
+        self.assertIsInstance(loader.batchsize, int)
+        self.assertEqual(loader.newNodes, [])
+        self.assertEqual(loader.newEdges, [])
     
     def test_write_gene_type_to_file(self):
         gene_type = {
@@ -1279,7 +2314,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
         network = t2n.convert_pandas_to_nice_cx_with_load_plan(network_dataframe, self._load_plan)
         network.set_name('test')
         test_network_file = os.path.join(self._args['datadir'], 'test.cx')
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             with open(test_network_file, 'w') as f:
                 json.dump(network.to_cx(), f, indent=4)
         
@@ -1289,64 +2324,64 @@ class TestNdexgenehancerloader(unittest.TestCase):
         loader.__setattr__('_network_summaries', {})
 
         # Test exceptions
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             loader._upload_cx(test_network_file, 'test')
         output = out.getvalue().strip().split('\n')
-        output_1 = output[0].split('-')[3]
-        output_2 = output[1].split('-')[3]
+        output_1 = output[0]
+        output_2 = output[-1]
         self.assertEqual(
             output_1, 
-            ' started uploading "test" on test_server for user test_user...')
+            'started uploading "test" on test_server for user test_user...')
         self.assertEqual(
             output_2,
-            ' unable to update or upload "test" on test_server for user test_user')
+            'unable to update or upload "test" on test_server for user test_user')
 
         loader.__setattr__('_update_uuid', self._test_network_uuid)
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             loader._upload_cx(test_network_file, 'test')
         output = out.getvalue().strip().split('\n')
-        output_1 = output[0].split('-')[3]
-        output_2 = output[1].split('-')[3]
+        output_1 = output[0]
+        output_2 = output[-1]
         self.assertEqual(
             output_1, 
-            ' started updating "test" on test_server for user test_user...')
+            'started updating "test" on test_server for user test_user...')
         self.assertEqual(
             output_2,
-            ' unable to update or upload "test" on test_server for user test_user')
+            'unable to update or upload "test" on test_server for user test_user')
 
         # Test updating network
         loader.__setattr__('_ndex', self._ndex_client)
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             loader._upload_cx(test_network_file, 'test')
         output = out.getvalue().strip().split('\n')
-        output_1 = output[0].split('-')[3]
-        output_2 = output[1].split('-')[3]
+        output_1 = output[0]
+        output_2 = output[-1]
         self.assertEqual(
             output_1, 
-            ' started updating "test" on test_server for user test_user...')
+            'started updating "test" on test_server for user test_user...')
         self.assertEqual(
             output_2,
-            ' finished updating "test" on test_server for user test_user')
+            'finished updating "test" on test_server for user test_user')
 
         # Test uploading new network
         network.set_name('delete_me')
         delete_network_file = os.path.join(self._args['datadir'], 'delete.cx')
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             with open(delete_network_file, 'w') as f:
                 json.dump(network.to_cx(), f, indent=4)
 
         loader.__setattr__('_update_uuid', None)
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             loader._upload_cx(delete_network_file, 'delete_me')
         output = out.getvalue().strip().split('\n')
-        output_1 = output[0].split('-')[3]
-        output_2 = output[1].split('-')[3]
+        output_1 = output[0]
+        output_2 = output[-1]
         self.assertEqual(
             output_1, 
-            ' started uploading "delete_me" on test_server for user test_user...')
+            'started uploading "delete_me" on test_server for user test_user...')
         self.assertEqual(
             output_2,
-            ' finished uploading "delete_me" on test_server for user test_user')
+            'finished uploading "delete_me" on test_server for user test_user')
 
         # Delete new network
         network_summaries = self._ndex_client.get_network_summaries_for_user(self._user)
@@ -1356,6 +2391,686 @@ class TestNdexgenehancerloader(unittest.TestCase):
                 uuid = summary.get('externalId')
                 returnString = self._ndex_client.delete_network(uuid, retry=10)
 
+    def _write_stream_cx_file(self):
+        loader = NDExGeneHancerLoader(self._args)
+        tsv_file = os.path.join(self._args['datadir'], 'file.tsv')
+        load_plan_file = os.path.join(self._args['datadir'], 'loadplan.json')
+        with open(load_plan_file, 'w') as lpf:
+            json.dump(self._load_plan, lpf, indent=4)
+        loader._load_plan_file = load_plan_file
+        with open(tsv_file, 'w') as tf:
+            writer = csv.writer(tf, delimiter='\t')
+            writer.writerow(self._network_data_header)
+            writer.writerows(self._network_data)
+        return loader._generate_nice_cx_from_tsv(tsv_file, 'file')
+
+    def test_generate_nice_cx_from_tsv_deterministic(self):
+        cx_file_path = self._write_stream_cx_file()
+        with open(cx_file_path, 'rb') as f:
+            cx_bytes = f.read()
+
+        # The same network, with its rows and columns in another order, is
+        # written the same way
+        self._network_data_header = ['target', 'source']
+        self._network_data = [['target2', 'source2'], ['target1', 'source1']]
+        loader = NDExGeneHancerLoader(self._args)
+        tsv_file = os.path.join(self._args['datadir'], 'file.tsv')
+        loader._load_plan_file = os.path.join(self._args['datadir'], 'loadplan.json')
+        with open(tsv_file, 'w') as tf:
+            writer = csv.writer(tf, delimiter='\t')
+            writer.writerow(self._network_data_header)
+            writer.writerows(self._network_data)
+        with open(loader._generate_nice_cx_from_tsv(tsv_file, 'file'), 'rb') as f:
+            self.assertEqual(f.read(), cx_bytes)
+
+        cx = json.loads(cx_bytes)
+        nodes = [n['n'] for a in cx for n in a.get('nodes', [])]
+        self.assertEqual(nodes, ['source1', 'target1', 'source2', 'target2'])
+        fingerprint = hashlib.sha256(cx_bytes).hexdigest()
+        self.assertEqual(loader._cx_fingerprints[cx_file_path], fingerprint)
+        self.assertEqual(loader._metrics.get_report()['files'][0]['fingerprint'],
+                         fingerprint)
+        self.assertEqual(ndexloadgenehancer._get_cx_fingerprint(cx_file_path),
+                         fingerprint)
+        self.assertEqual(os.listdir(self._args['datadir']).count(
+            ndexloadgenehancer.RESULT_PREFIX + 'file' +
+            ndexloadgenehancer.SORTED_SUFFIX + '.tsv'), 0)
+
+    def test_sort_tsv_records(self):
+        rows = [[str(i % 7), str(i)] for i in range(20)]
+        rows.append(['3a', 'quoted\tfield with "quotes"\nand a line break'])
+        rows.append(['3b', 'non-ASCII \u03b1-globin'])
+        tsv_file = os.path.join(self._args['datadir'], 'records.tsv')
+        with open(tsv_file, 'w', encoding='utf-8', newline='') as f:
+            csv.writer(f, delimiter='\t').writerows(rows)
+        for chunk_rows in [3, 100]:
+            with open(tsv_file, 'r', encoding='utf-8', newline='') as f:
+                text = ''.join(ndexloadgenehancer._sort_tsv_records(
+                    f, key=lambda fields: fields[0],
+                    directory=self._args['datadir'], chunk_rows=chunk_rows))
+            self.assertEqual(list(csv.reader(StringIO(text), delimiter='\t')),
+                             sorted(rows, key=lambda row: (row[0], row[1])))
+
+    def test_get_cx_element_counts(self):
+        loader = NDExGeneHancerLoader(self._args)
+        cx_file_path = self._write_stream_cx_file()
+        self.assertEqual(loader._get_cx_element_counts(cx_file_path), (4, 2))
+
+        no_metadata_file = os.path.join(self._args['datadir'], 'empty.cx')
+        with open(no_metadata_file, 'w') as f:
+            json.dump([{'nodes': [{'@id': 0}]}], f)
+        self.assertIsNone(loader._get_cx_element_counts(no_metadata_file))
+
+    def _write_layout_cx_file(self):
+        loader = NDExGeneHancerLoader(self._args)
+        loader._load_plan_file = ndexloadgenehancer._get_default_load_plan_name()
+        loader._style_file = ndexloadgenehancer._get_default_style_file_name()
+        loader._check_export_formats()
+        tsv_file = os.path.join(self._args['datadir'], 'layout.tsv')
+        with open(tsv_file, 'w') as tf:
+            writer = csv.writer(tf, delimiter='\t')
+            writer.writerow(ndexloadgenehancer.OUTPUT_HEADER)
+            for enhancer, chromosome, start, gene in [
+                    ('GH02J001000', 'chr2', '1000', 'A'),
+                    ('GH02J003000', 'chr2', '3000', 'A'),
+                    ('GH01J004000', 'chr1', '4000', 'B')]:
+                writer.writerow([enhancer, 'en-genecards:' + enhancer,
+                                 chromosome, start, str(int(start) + 100),
+                                 '1.0', 'Enhancer', 'Enhancer', gene,
+                                 'p-genecards:' + gene, '2.0',
+                                 'Protein coding gene', 'Protein coding gene'])
+        with open(loader._generate_nice_cx_from_tsv(tsv_file, 'layout'), 'r') as f:
+            return json.load(f)
+
+    def test_generate_nice_cx_from_tsv_layout(self):
+        cx = self._write_layout_cx_file()
+        layout = [e for a in cx for e in a.get('cartesianLayout', [])]
+        nodes = {n['@id']: n['n'] for a in cx for n in a.get('nodes', [])}
+        self.assertEqual([e['node'] for e in layout], sorted(nodes))
+        metadata = [m for a in cx for m in a.get('metaData', [])]
+        self.assertIn({'name': 'cartesianLayout', 'version': '1.0',
+                       'consistencyGroup': 1, 'elementCount': 5},
+                      metadata)
+
+        positions = {nodes[e['node']]: (e['x'], e['y']) for e in layout}
+        # chr1 is laid out in the row above chr2, enhancers ordered by start
+        self.assertLess(positions['GH01J004000'][1], positions['GH02J001000'][1] - 100)
+        self.assertLess(positions['GH02J001000'][0], positions['GH02J003000'][0])
+        self.assertEqual(positions['GH01J004000'][0], ndexloadgenehancer.LAYOUT_WIDTH)
+        # Genes are placed above the centroid of their enhancers
+        self.assertEqual(positions['A'][0], ndexloadgenehancer.LAYOUT_WIDTH / 2)
+        self.assertLess(positions['B'][1], positions['GH01J004000'][1])
+
+        # The same input always gives the same layout
+        self.assertEqual(self._write_layout_cx_file(), cx)
+
+        self._args['nolayout'] = True
+        cx = self._write_layout_cx_file()
+        self.assertFalse([a for a in cx if 'cartesianLayout' in a])
+        self.assertFalse([m for a in cx for m in a.get('metaData', [])
+                          if m['name'] == 'cartesianLayout'])
+
+    def test_generate_nice_cx_from_tsv_export(self):
+        self._args['export'] = ['graphml', 'sif', 'edges', 'nodes']
+        cx = self._write_layout_cx_file()
+        nodes = {n['@id']: n['n'] for a in cx for n in a.get('nodes', [])}
+        edges = [(nodes[e['s']], e['i'], nodes[e['t']])
+                 for a in cx for e in a.get('edges', [])]
+        prefix = os.path.join(self._args['datadir'],
+                              ndexloadgenehancer.RESULT_PREFIX + 'layout')
+
+        with open(prefix + '.sif', 'r') as f:
+            self.assertEqual([tuple(line.split('\t')) for line in f.read().splitlines()],
+                             edges)
+        with open(prefix + '.edges.tsv', 'r') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+        self.assertEqual(rows[0], ['source', 'source_represents', 'interaction',
+                                   'target', 'target_represents',
+                                   'GeneEnhancerScore'])
+        # Edges are exported in the order of the CX, by source and target
+        self.assertEqual(rows[1], ['GH01J004000', 'en-genecards:GH01J004000',
+                                   'enhances', 'B', 'p-genecards:B', '2.0'])
+        self.assertEqual(len(rows), 4)
+        with open(prefix + '.nodes.tsv', 'r') as f:
+            rows = list(csv.reader(f, delimiter='\t'))
+        self.assertEqual(rows[0][:4], ['id', 'name', 'represents', 'Chromosome'])
+        self.assertEqual({row[0]: row[1] for row in rows[1:]},
+                         {str(node_id): name for node_id, name in nodes.items()})
+
+        import xml.etree.ElementTree as ET
+        ns = {'g': 'http://graphml.graphdrawing.org/xmlns'}
+        graphml = ET.parse(prefix + '.graphml').getroot()
+        keys = {key.get('id'): key.get('attr.name')
+                for key in graphml.findall('g:key', ns)}
+        graph = graphml.find('g:graph', ns)
+        graphml_nodes = {}
+        for node in graph.findall('g:node', ns):
+            data = {keys[d.get('key')]: d.text for d in node.findall('g:data', ns)}
+            graphml_nodes[node.get('id')] = data['name']
+        self.assertEqual(sorted(graphml_nodes.values()), sorted(nodes.values()))
+        self.assertEqual([(graphml_nodes[e.get('source')],
+                           graphml_nodes[e.get('target')])
+                          for e in graph.findall('g:edge', ns)],
+                         [(s, t) for s, _, t in edges])
+
+    def test_check_export_formats(self):
+        # pyarrow cannot be imported
+        saved_pyarrow = sys.modules.get('pyarrow')
+        sys.modules['pyarrow'] = None
+        try:
+            self._args['export'] = ['sif', 'parquet']
+            loader = NDExGeneHancerLoader(self._args)
+            with captured_logs() as out:
+                loader._check_export_formats()
+            self.assertEqual(loader._export, ['sif'])
+            self.assertIn('Not exporting parquet: pyarrow is not installed',
+                          out.getvalue())
+
+            self._args['export'] = ['parquet']
+            loader = NDExGeneHancerLoader(self._args)
+            with captured_logs() as out:
+                loader._check_export_formats()
+            self.assertIsNone(loader._export)
+
+            # The other formats are still written
+            self._args['export'] = ['sif', 'parquet']
+            self._write_layout_cx_file()
+            prefix = os.path.join(self._args['datadir'],
+                                  ndexloadgenehancer.RESULT_PREFIX + 'layout')
+            self.assertTrue(os.path.isfile(prefix + '.sif'))
+            self.assertFalse(os.path.isfile(prefix + '.edges.parquet'))
+        finally:
+            if saved_pyarrow is None:
+                del sys.modules['pyarrow']
+            else:
+                sys.modules['pyarrow'] = saved_pyarrow
+
+    def test_chromosome_layout(self):
+        layout = ndexloadgenehancer._ChromosomeLayout()
+        layout.add(0, 1, 'chr2', '1000')
+        layout.add(2, 1, 'chr2', '3000')
+        layout.add(3, 4, 'chr1', '4000')
+        layout.add(5, 4, 'chrX', '')
+        positions = {e['node']: (e['x'], e['y']) for e in layout.get_aspect()}
+        self.assertEqual(sorted(positions), [0, 1, 2, 3, 4])
+        self.assertEqual(len(layout), 5)
+
+        # chr1 is laid out in the row above chr2, ordered by start
+        self.assertLess(positions[3][1], positions[0][1])
+        self.assertLess(positions[0][0], positions[2][0])
+        self.assertEqual(positions[3][0], ndexloadgenehancer.LAYOUT_WIDTH)
+        # Genes are placed at the centroid of their enhancers
+        self.assertEqual(positions[1][0], ndexloadgenehancer.LAYOUT_WIDTH / 2)
+
+        self.assertEqual(
+            sorted(['chrY', 'chr10', 'chrM', 'chr2', 'chrX', 'chrUn_1'],
+                   key=ndexloadgenehancer._chromosome_sort_key),
+            ['chr2', 'chr10', 'chrX', 'chrY', 'chrM', 'chrUn_1'])
+
+    def test_upload_cx_retries(self):
+        cx_file_path = self._write_stream_cx_file()
+        with open(cx_file_path, 'rb') as f:
+            cx_bytes = f.read()
+        loader = NDExGeneHancerLoader(self._args)
+        loader._upload_backoff = 0
+        loader._update_uuid = 'test_uuid'
+
+        # Transient errors are retried with the whole file each time
+        error = requests.exceptions.ConnectionError('connection reset')
+        loader._ndex = FakeNdex(failures=2, error=error, node_count=4, edge_count=2)
+        with captured_output() as (out, err):
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 0)
+        self.assertEqual(loader._ndex.uploads, [cx_bytes] * 3)
+
+        # Retries are exhausted
+        loader._ndex = FakeNdex(failures=5, error=error, node_count=4, edge_count=2)
+        with captured_output() as (out, err):
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 2)
+        self.assertEqual(len(loader._ndex.uploads), loader._upload_retries + 1)
+
+        # Client errors are not retried
+        response = requests.models.Response()
+        response.status_code = 401
+        error = requests.exceptions.HTTPError('unauthorized', response=response)
+        loader._ndex = FakeNdex(failures=1, error=error)
+        with captured_output() as (out, err):
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 2)
+        self.assertEqual(len(loader._ndex.uploads), 1)
+
+    def test_upload_cx_retries_new_network(self):
+        cx_file_path = self._write_stream_cx_file()
+        loader = NDExGeneHancerLoader(self._args)
+        loader._upload_backoff = 0
+
+        def server_error(status_code):
+            response = requests.models.Response()
+            response.status_code = status_code
+            return requests.exceptions.HTTPError(str(status_code), response=response)
+
+        # Saving a new network is retried only if the request cannot have
+        # reached NDEx, or NDEx asked to slow down
+        refused = requests.exceptions.ConnectionError(
+            'connection failed', ConnectionRefusedError(111, 'Connection refused'))
+        for error in [refused, requests.exceptions.ConnectTimeout('timeout'),
+                      server_error(429)]:
+            loader._ndex = FakeNdex(failures=1, error=error, node_count=4, edge_count=2)
+            with captured_logs():
+                self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 0)
+            self.assertEqual(len(loader._ndex.uploads), 2)
+
+        # Otherwise the network may have been saved already
+        for error in [requests.exceptions.ConnectionError('connection reset'),
+                      requests.exceptions.ReadTimeout('timeout'),
+                      server_error(502)]:
+            loader._ndex = FakeNdex(failures=1, error=error, node_count=4, edge_count=2)
+            with captured_logs():
+                self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 2)
+            self.assertEqual(len(loader._ndex.uploads), 1)
+
+    def test_upload_cx_to_targets(self):
+        cx_file_path = self._write_stream_cx_file()
+        with open(cx_file_path, 'rb') as f:
+            cx_bytes = f.read()
+        args = dotdict(dict(self._args,
+                            targets=['public', 'mirror:mirror_uuid', 'down']))
+        loader = NDExGeneHancerLoader(args)
+        self.assertEqual(loader._profile, 'public')
+        self.assertIsNone(loader._update_uuid)
+        for target in loader._targets:
+            target['user'] = target['profile'] + '_user'
+            target['pass'] = None
+            target['server'] = target['profile'] + '_server'
+        loader._ndex = FakeNdex(node_count=4, edge_count=2)
+        loader._targets[1]['ndex'] = FakeNdex(node_count=4, edge_count=2)
+        loader._targets[2]['ndex'] = FakeNdex(node_count=4, edge_count=1)
+
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx_to_targets(cx_file_path, 'test'), 2)
+        self.assertEqual(loader._ndex.uploads, [cx_bytes])
+        self.assertEqual(loader._targets[0]['ndex'], loader._ndex)
+        self.assertEqual(loader._targets[1]['ndex'].updated, ['mirror_uuid'])
+        self.assertEqual(loader._targets[1]['ndex'].uploads, [cx_bytes])
+        self.assertEqual(loader._targets[2]['ndex'].uploads, [cx_bytes])
+        status = out.getvalue().strip().split('\n')[-3:]
+        self.assertEqual(status, [
+            '"test" on public_server for user public_user: succeeded',
+            '"test" on mirror_server for user mirror_user: succeeded',
+            '"test" on down_server for user down_user: failed'
+        ])
+
+        loader._targets = loader._targets[:2]
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx_to_targets(cx_file_path, 'test'), 0)
+        self.assertEqual(loader._targets[1]['ndex'].updated,
+                         ['mirror_uuid', 'mirror_uuid'])
+
+    def test_upload_cx_skip_unchanged(self):
+        cx_file_path = self._write_stream_cx_file()
+        self._args['skipunchanged'] = True
+        loader = NDExGeneHancerLoader(self._args)
+        loader._server = 'test_server'
+        loader._user = 'test_user'
+        loader._ndex = FakeNdex(node_count=4, edge_count=2)
+
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx_to_targets(cx_file_path, 'test'), 0)
+            self.assertEqual(loader._upload_cx_to_targets(cx_file_path, 'test'), 0)
+        self.assertEqual(len(loader._ndex.uploads), 1)
+        self.assertIn('not uploading it again', out.getvalue())
+        self.assertEqual(loader._metrics.get_report()['files'][0]['uploads_skipped'], 1)
+        state_file_path = os.path.join(self._args['datadir'],
+                                       ndexloadgenehancer.UPLOAD_STATE_FILE)
+        with open(state_file_path, 'r') as f:
+            state = json.load(f)
+        self.assertEqual(state['test_server test_user test']['uuid'], 'new_uuid')
+        self.assertEqual(state['test_server test_user test']['fingerprint'],
+                         ndexloadgenehancer._get_cx_fingerprint(cx_file_path))
+
+        # Another network, or a changed one, is uploaded
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx(cx_file_path, 'other'), 0)
+        self.assertEqual(len(loader._ndex.uploads), 2)
+        with open(cx_file_path, 'a') as f:
+            f.write(' ')
+        loader = NDExGeneHancerLoader(self._args)
+        loader._server = 'test_server'
+        loader._user = 'test_user'
+        loader._ndex = FakeNdex(node_count=4, edge_count=2)
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 0)
+        self.assertEqual(len(loader._ndex.uploads), 1)
+
+    def test_upload_cx_verify(self):
+        cx_file_path = self._write_stream_cx_file()
+        loader = NDExGeneHancerLoader(self._args)
+        loader._server = 'test_server'
+        loader._user = 'test_user'
+
+        loader._ndex = FakeNdex(node_count=4, edge_count=1)
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 2)
+        self.assertIn(
+            'network new_uuid has 4 nodes and 1 edges, expected 4 nodes and 2 edges',
+            out.getvalue().strip().split('\n'))
+
+        loader._no_verify = True
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 0)
+
+    def test_iter_gzip(self):
+        data = b'{"nodes": [{"@id": 0, "n": "gene"}]}' * 1000
+        stats = {'raw': 0, 'compressed': 0}
+        compressed = b''.join(ndexloadgenehancer._iter_gzip(BytesIO(data), stats))
+        self.assertEqual(gzip.decompress(compressed), data)
+        self.assertEqual(stats['raw'], len(data))
+        self.assertEqual(stats['compressed'], len(compressed))
+        self.assertLess(stats['compressed'], stats['raw'])
+
+    def test_generate_gzipped_cx(self):
+        plain_cx_file_path = self._write_stream_cx_file()
+        with open(plain_cx_file_path, 'rb') as f:
+            plain_cx = f.read()
+        self._args['gzipcx'] = True
+        with captured_logs() as out:
+            cx_file_path = self._write_stream_cx_file()
+        self.assertEqual(
+            cx_file_path,
+            os.path.realpath(os.path.join(
+                self._args['datadir'],
+                ndexloadgenehancer.RESULT_PREFIX + 'file.cx.gz')))
+        with gzip.open(cx_file_path, 'rb') as f:
+            self.assertEqual(f.read(), plain_cx)
+        self.assertTrue('compressed network from ' + str(len(plain_cx)) in
+                        out.getvalue())
+
+        loader = NDExGeneHancerLoader(self._args)
+        self.assertEqual(loader._get_cx_element_counts(cx_file_path), (4, 2))
+        self.assertEqual(ndexloadgenehancer._get_uncompressed_size(cx_file_path),
+                         len(plain_cx))
+
+        # Gzipped files are decompressed for a plain upload
+        loader._ndex = FakeNdex(node_count=4, edge_count=2)
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 0)
+        self.assertEqual(loader._ndex.uploads, [plain_cx])
+
+    def test_upload_cx_gzip(self):
+        cx_file_path = self._write_stream_cx_file()
+        with open(cx_file_path, 'rb') as f:
+            cx_bytes = f.read()
+        self._args['gzipupload'] = True
+        loader = NDExGeneHancerLoader(self._args)
+        loader._ndex = FakeNdex(node_count=4, edge_count=2)
+        loader._ndex.host = 'http://test_server'
+        loader._ndex.version = '2.4.5'
+        loader._ndex.version_endpoint = '/v2'
+        loader._ndex.timeout = 30
+        loader._ndex.s = FakeSession()
+        loader._ndex._get_user_agent = lambda: 'test_agent'
+
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 0)
+        method, url, body, headers = loader._ndex.s.requests[0]
+        self.assertEqual(method, 'POST')
+        self.assertEqual(url, 'http://test_server/v2/network')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['User-Agent'], 'test_agent')
+        self.assertTrue(headers['Content-Type'].startswith('multipart/form-data'))
+        self.assertTrue(cx_bytes in gzip.decompress(body))
+        self.assertTrue('bytes compressed to ' + str(len(body)) + ' bytes' in
+                        out.getvalue())
+
+        loader._update_uuid = 'old_uuid'
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 0)
+        method, url, body, headers = loader._ndex.s.requests[1]
+        self.assertEqual(method, 'PUT')
+        self.assertEqual(url, 'http://test_server/v2/network/old_uuid')
+
+        # NDEx 1.3 servers get an uncompressed upload through Ndex2
+        loader._ndex.version = '1.3'
+        with captured_logs() as out:
+            self.assertEqual(loader._upload_cx(cx_file_path, 'test'), 0)
+        self.assertEqual(len(loader._ndex.s.requests), 2)
+        self.assertEqual(loader._ndex.uploads, [cx_bytes])
+        self.assertEqual(loader._ndex.updated, ['old_uuid'])
+        self.assertTrue('uploading without compression' in out.getvalue())
+
+    def _write_genehancer_file(self, file_name, rows):
+        """
+        Writes GeneHancer rows, given as (enhancer id, [(gene, score), ...]),
+        to a tab separated file with a header
+        """
+        file_path = os.path.join(self._args['datadir'], file_name)
+        with open(file_path, 'w') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(ndexloadgenehancer.DEFAULT_HEADER)
+            for i, (enhancer_id, genes) in enumerate(rows):
+                attributes = 'genehancer_id=' + enhancer_id
+                for gene, score in genes:
+                    attributes += ';connected_gene=' + gene + ';score=' + str(score)
+                writer.writerow(['chr1', 'GeneHancer', 'Enhancer', str(i * 1000),
+                                 str(i * 1000 + 500), '0.5', '.', '.', attributes])
+        return file_path
+
+    def test_reformat_input_file_metrics(self):
+        file_path = self._write_genehancer_file('input.tsv', [
+            ('GH01J000001', [('GENE1', 1.0), ('LINC00002', 2.0)]),
+            ('GH01J000002', [('GENE1', 3.0), ('LINC00002', 4.0)])
+        ])
+        loader = NDExGeneHancerLoader(self._args)
+        loader._delimiter = '\t'
+        loader._gene_types = {'GENE1': 'Protein coding gene'}
+        classify_gene_type = loader._classify_gene_type
+        classified = []
+
+        def classify(gene_name):
+            classified.append(gene_name)
+            return classify_gene_type(gene_name)
+
+        loader._classify_gene_type = classify
+        result_tsv_file_path = loader._reformat_input_file(file_path, 'input', 'input.tsv')
+
+        stages = loader._metrics.get_report()['files'][0]['stages']
+        self.assertEqual(stages['reformat']['rows_in'], 2)
+        self.assertEqual(stages['reformat']['edges_out'], 4)
+        self.assertEqual(stages['reformat']['bytes_written'],
+                         os.path.getsize(result_tsv_file_path))
+        self.assertEqual(stages['gene_typing']['rows_in'], 4)
+        # Only the gene missing from the gene types is classified and timed
+        self.assertEqual(classified, ['LINC00002'])
+        self.assertGreater(stages['gene_typing']['wall_time'], 0)
+
+    def test_memoized_classification(self):
+        ndexloadgenehancer._get_node_rep.cache_clear()
+        ndexloadgenehancer._map_type_of_gene.cache_clear()
+        metrics = RunMetrics(ndexloadgenehancer.get_cache_stats)
+        loader = NDExGeneHancerLoader(self._args)
+        for _ in range(3):
+            self.assertEqual(loader._get_rep('GH01J000100'),
+                             'en-genecards:GH01J000100')
+            self.assertEqual(loader._get_rep('GHRLOS'), 'p-genecards:GHRLOS')
+            self.assertEqual(loader._map_gene_type('protein-coding'),
+                             'Protein coding gene')
+            self.assertEqual(loader._map_gene_type('snoRNA'), 'ncRNA gene')
+            self.assertIsNone(loader._map_gene_type('novel'))
+
+        caches = metrics.get_report()['caches']
+        self.assertEqual((caches['rep']['hits'], caches['rep']['misses']), (4, 2))
+        self.assertEqual((caches['type_of_gene']['hits'],
+                          caches['type_of_gene']['misses']), (6, 3))
+        self.assertEqual(caches['type_of_gene']['hit_rate'], 6 / 9)
+        self.assertEqual(caches['rep']['maxsize'],
+                         ndexloadgenehancer.REP_CACHE_SIZE)
+
+    def test_run_cx_file(self):
+        cx_file_path = self._write_stream_cx_file()
+        conf_file = os.path.join(self._args['datadir'], 'conf')
+        with open(conf_file, 'w') as cf:
+            cf.write('[profile]\n')
+            cf.write('user = test_user\n')
+            cf.write('password = test_password\n')
+            cf.write('server = test_server')
+        args = dotdict({
+            'datadir': os.path.join(self._args['datadir'], 'does_not_exist'),
+            'conf': conf_file,
+            'profile': 'profile',
+            'cxfile': cx_file_path,
+            'metricsout': os.path.join(self._args['datadir'], 'metrics.json')
+        })
+        loader = NDExGeneHancerLoader(args)
+        loader._ndex = FakeNdex(node_count=4, edge_count=2)
+        with captured_output() as (out, err):
+            self.assertEqual(loader.run(), 0)
+        self.assertEqual(len(loader._ndex.uploads), 1)
+        self.assertTrue(os.path.exists(cx_file_path))
+
+        with open(args['metricsout'], 'r') as f:
+            report = json.load(f)
+        upload = report['files'][0]['stages']['upload']
+        self.assertEqual(report['files'][0]['file'], os.path.basename(cx_file_path))
+        self.assertEqual(upload['bytes_written'], os.path.getsize(cx_file_path))
+
+    def test_run_scratch_directory(self):
+        data_dir = os.path.join(self._args['datadir'], 'data')
+        scratch_dir = os.path.join(self._args['datadir'], 'scratch')
+        os.mkdir(data_dir)
+        os.mkdir(scratch_dir)
+        with open(os.path.join(data_dir, 'input.tsv'), 'w') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['#chrom', 'source', 'feature name', 'start', 'end',
+                             'score', 'strand', 'frame', 'attributes'])
+            writer.writerow(['chr1', 'GeneHancer', 'Enhancer', '100', '200', '0.5',
+                             '.', '.', 'genehancer_id=GH01J000100;'
+                             'connected_gene=LINC00001;score=5.0'])
+        conf_file = os.path.join(self._args['datadir'], 'conf')
+        with open(conf_file, 'w') as cf:
+            cf.write('[profile]\nuser = test_user\npassword = test_password\n'
+                     'server = test_server')
+        gene_types_file = os.path.join(self._args['datadir'], 'genetypes.json')
+        with open(gene_types_file, 'w') as f:
+            json.dump({'LINC00001': 'ncRNA gene'}, f)
+        args = dotdict({
+            'datadir': data_dir,
+            'conf': conf_file,
+            'profile': 'profile',
+            'scratchdir': scratch_dir,
+            'loadplan': ndexloadgenehancer._get_default_load_plan_name(),
+            'genetypes': gene_types_file,
+            'gzipcx': True
+        })
+        loader = NDExGeneHancerLoader(args)
+        loader._ndex = FakeNdex(node_count=2, edge_count=1)
+        tsv_file_paths = []
+        cx_file_paths = []
+        generate_nice_cx_from_tsv = loader._generate_nice_cx_from_tsv
+
+        def generate(tsv_file_path, original_name):
+            tsv_file_paths.append(tsv_file_path)
+            cx_file_paths.append(
+                generate_nice_cx_from_tsv(tsv_file_path, original_name))
+            return cx_file_paths[-1]
+
+        loader._generate_nice_cx_from_tsv = generate
+        with captured_logs():
+            self.assertEqual(loader.run(), 0)
+        self.assertEqual(len(loader._ndex.uploads), 1)
+        # Intermediate files are written to a directory of the run in the
+        # scratch directory, which is removed once the run ends
+        self.assertEqual(os.path.dirname(os.path.dirname(tsv_file_paths[0])),
+                         scratch_dir)
+        self.assertEqual(os.path.dirname(os.path.dirname(cx_file_paths[0])),
+                         scratch_dir)
+        self.assertEqual(os.listdir(scratch_dir), [])
+        self.assertEqual(os.listdir(data_dir), ['input.tsv'])
+
+        # With --nocleanup the CX is kept in the data directory
+        loader = NDExGeneHancerLoader(dotdict(dict(args, nocleanup=True)))
+        loader._ndex = FakeNdex(node_count=2, edge_count=1)
+        with captured_logs():
+            self.assertEqual(loader.run(), 0)
+        self.assertEqual(os.listdir(scratch_dir), [])
+        cx_file_path = os.path.join(data_dir, '_result_input.cx.gz')
+        with gzip.open(cx_file_path, 'rt') as f:
+            self.assertTrue(json.load(f))
+        for file_name in os.listdir(data_dir):
+            if file_name != 'input.tsv':
+                os.remove(os.path.join(data_dir, file_name))
+
+        # Runs without enough free space stop before writing anything
+        factor = ndexloadgenehancer.SCRATCH_SPACE_FACTOR
+        ndexloadgenehancer.SCRATCH_SPACE_FACTOR = 2 ** 60
+        try:
+            loader = NDExGeneHancerLoader(args)
+            loader._ndex = FakeNdex(node_count=2, edge_count=1)
+            with captured_logs() as out:
+                self.assertEqual(loader.run(), 2)
+        finally:
+            ndexloadgenehancer.SCRATCH_SPACE_FACTOR = factor
+        self.assertIn('Not enough free space in ' + scratch_dir, out.getvalue())
+        self.assertEqual(loader._ndex.uploads, [])
+        self.assertEqual(os.listdir(scratch_dir), [])
+
+    def test_temp_files(self):
+        file_paths = [os.path.join(self._args['datadir'], name)
+                      for name in ['a', 'b', 'c']]
+        for file_path in file_paths[:2]:
+            open(file_path, 'w').close()
+        with self.assertRaises(ValueError):
+            with ndexloadgenehancer._TempFiles() as temp_files:
+                for file_path in file_paths:
+                    temp_files.add(file_path)
+                raise ValueError('stage failed')
+        self.assertFalse(any(os.path.exists(p) for p in file_paths))
+
+        open(file_paths[0], 'w').close()
+        with ndexloadgenehancer._TempFiles(keep=True) as temp_files:
+            temp_files.add(file_paths[0])
+        self.assertTrue(os.path.exists(file_paths[0]))
+
+    def test_stage_profiler(self):
+        cpu_file = os.path.join(self._args['datadir'], 'cpu.prof')
+        mem_file = os.path.join(self._args['datadir'], 'mem.prof')
+        args = dotdict({
+            'datadir': self._args['datadir'],
+            'profilecpu': cpu_file,
+            'profilemem': mem_file
+        })
+        loader = NDExGeneHancerLoader(args)
+        try:
+            with loader._stage('reformat'):
+                rows = [str(i) * 10 for i in range(1000)]
+            with loader._stage('upload'):
+                # Nested stages are profiled as part of the outer stage
+                with loader._stage('validation'):
+                    sorted(rows)
+            with loader._stage('reformat'):
+                rows = [str(i) * 10 for i in range(1000)]
+            loader._profiler.write()
+        finally:
+            tracemalloc.stop()
+
+        for file_path in [cpu_file, mem_file]:
+            self.assertTrue(os.path.exists(file_path))
+            self.assertTrue(os.path.exists(file_path + '.reformat'))
+            self.assertTrue(os.path.exists(file_path + '.upload'))
+        functions = [name for _, _, name in pstats.Stats(cpu_file + '.upload').stats]
+        self.assertIn('<built-in method builtins.sorted>', functions)
+        with open(cpu_file + '.txt', 'r') as f:
+            cpu_summary = f.read()
+        self.assertIn('=== reformat ===', cpu_summary)
+        self.assertIn('=== upload ===', cpu_summary)
+        with open(mem_file + '.txt', 'r') as f:
+            mem_summary = f.read()
+        self.assertIn('=== reformat ===', mem_summary)
+        self.assertIn('2 runs, highest peak', mem_summary)
+        self.assertIn('test_ndexloadgenehancer.py', mem_summary)
+        for file_path in [cpu_file, mem_file]:
+            self.assertFalse(os.path.exists(file_path + '.validation'))
+        snapshot = tracemalloc.Snapshot.load(mem_file + '.reformat')
+        self.assertGreater(len(snapshot.traces), 0)
+        self.assertIn('reformat', loader._metrics.get_report()['files'][0]['stages'])
+
     def test_parse_gene_types(self):
         # Setup
         genetypes = {
@@ -1396,7 +3111,7 @@ class TestNdexgenehancerloader(unittest.TestCase):
         }
         args = dotdict(args)
         loader = NDExGeneHancerLoader(args)
-        with captured_output() as (out, err):
+        with captured_logs() as out:
             loader._get_gene_types()
         self.assertEqual(
             out.getvalue().strip(),
@@ -1448,23 +3163,18 @@ class TestNdexgenehancerloader(unittest.TestCase):
         # Run function
         loader = NDExGeneHancerLoader(args)
         try:
-            with captured_output() as (out, err):
+            with captured_logs() as out:
                 loader.run()
 
             # Test results
+            expected_lines = [
+                'started processing "input"...',
+                'generating network...',
+                'started uploading "input" on dev.ndexbio.org for user sophieTest...',
+                'finished uploading "input" on dev.ndexbio.org for user sophieTest']
             lines = out.getvalue().strip().split('\n')
-            self.assertEqual(
-                lines[0].strip().split(' - ')[1], 
-                'started processing "input"...')
-            self.assertEqual(
-                lines[1].strip().split(' - ')[1], 
-                'generating network...')
-            self.assertEqual(
-                lines[2].strip().split(' - ')[1], 
-                'started uploading "input" on dev.ndexbio.org for user sophieTest...')
-            self.assertEqual(
-                lines[3].strip().split(' - ')[1], 
-                'finished uploading "input" on dev.ndexbio.org for user sophieTest')
+            self.assertEqual([line for line in lines if line in expected_lines],
+                             expected_lines)
             
             uuids = self._ndex_client.get_network_ids_for_user(self._user)
             self.assertEqual(len(uuids), 4)
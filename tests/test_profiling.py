@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `ndexgenehancerloader.profiling` module."""
+
+import os
+import tempfile
+import shutil
+import json
+import unittest
+
+import ndexgenehancerloader
+from ndexgenehancerloader.profiling import RunMetrics
+
+
+class TestProfiling(unittest.TestCase):
+    """Tests for 'ndexgenehancerloader.profiling' module"""
+
+    def setUp(self):
+        """Set up test fixtures, if any"""
+        self._args = {'datadir': tempfile.mkdtemp()}
+
+    def tearDown(self):
+        """Tear down test fixtures, if any"""
+        if os.path.exists(self._args['datadir']):
+            shutil.rmtree(self._args['datadir'])
+
+    def test_run_metrics(self):
+        metrics = RunMetrics()
+        metrics.start_file('a')
+        with metrics.stage('reformat'):
+            metrics.add('reformat', rows_in=10, edges_out=20)
+        metrics.add('reformat', rows_in=5)
+        metrics.start_file('b')
+        metrics.add('upload', bytes_written=100)
+
+        metrics_file = os.path.join(self._args['datadir'], 'metrics.json')
+        metrics.write(metrics_file)
+        with open(metrics_file, 'r') as f:
+            report = json.load(f)
+        self.assertEqual(report['version'], ndexgenehancerloader.__version__)
+        self.assertEqual([f['file'] for f in report['files']], ['a', 'b'])
+        reformat = report['files'][0]['stages']['reformat']
+        self.assertEqual(reformat['rows_in'], 15)
+        self.assertEqual(reformat['edges_out'], 20)
+        self.assertGreater(reformat['wall_time'], 0)
+        self.assertEqual(reformat['rows_per_second'], 15 / reformat['wall_time'])
+        self.assertEqual(report['files'][1]['stages']['upload']['bytes_written'], 100)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `ndexgenehancerloader.store` module."""
+
+import os
+import tempfile
+import shutil
+import struct
+import unittest
+
+from ndexgenehancerloader.store import (EdgeColumns, EdgeStore, EnhancerIndex,
+                                        format_float32)
+
+
+class TestStore(unittest.TestCase):
+    """Tests for 'ndexgenehancerloader.store' module"""
+
+    def setUp(self):
+        """Set up test fixtures, if any"""
+        self._args = {'datadir': tempfile.mkdtemp()}
+
+    def tearDown(self):
+        """Tear down test fixtures, if any"""
+        if os.path.exists(self._args['datadir']):
+            shutil.rmtree(self._args['datadir'])
+
+    def test_enhancer_index(self):
+        index = EnhancerIndex()
+        index.add('chr1', 500, 600, 10, 5)
+        index.add('chr1', 100, 400, 20, 5)
+        index.add('chr1', 450, 460, 30, 5)
+        index.add('chr2', 100, 200, 40, 5)
+        self.assertEqual(index.query('chr1', 300, 450), [(20, 5), (30, 5)])
+        self.assertEqual(index.query('chr1', 401, 449), [])
+        self.assertEqual(index.query('chr1', 600, 1000), [(10, 5)])
+        self.assertEqual(index.query('2', 1, 100), [(40, 5)])
+        self.assertEqual(index.query('chr3', 1, 1000), [])
+
+        index_file_path = os.path.join(self._args['datadir'], 'index.json')
+        index.source = {'file': 'f'}
+        index.tsv_size = 100
+        index.write(index_file_path)
+        loaded = EnhancerIndex.load(index_file_path)
+        self.assertEqual(loaded.source, {'file': 'f'})
+        self.assertEqual(loaded.tsv_size, 100)
+        self.assertEqual(loaded.query('chr1', 300, 450), [(20, 5), (30, 5)])
+
+    def test_edge_columns(self):
+        edges = EdgeColumns()
+        edges.append('GH1', 'chr1', 100, 200, 0.5, 'Enhancer', 'A', 5.25, 'ncRNA gene')
+        edges.append('GH1', 'chr1', 100, 200, 0.5, 'Enhancer', 'B', 1.5, 'ncRNA gene')
+        edges.append('GH2', 'chr2', 300, 400, 0.25, 'Enhancer', 'A', 2.0, 'ncRNA gene')
+        self.assertEqual(len(edges), 3)
+        self.assertEqual(edges.dictionaries['Gene'], ['A', 'B'])
+        self.assertEqual(edges.dictionaries['GeneGeneType'], ['ncRNA gene'])
+        self.assertEqual(list(edges.arrays['Chromosome']), [0, 0, 1])
+        self.assertEqual(edges[2],
+                         ('GH2', 'chr2', 300, 400, 0.25, 'Enhancer', 'A', 2.0, 'ncRNA gene'))
+        self.assertEqual([edge[6] for edge in edges], ['A', 'B', 'A'])
+
+    def test_edge_store(self):
+        self.assertEqual(format_float32(
+            struct.unpack('f', struct.pack('f', 0.35))[0]), '0.35')
+        self.assertEqual(format_float32(5.0), '5')
+
+        store_path = os.path.join(self._args['datadir'], 'edges.store')
+        store = EdgeStore(store_path, source={'file': 'f'})
+        store.append('GH1', 'chr1', 100, 200, 0.5, 'Enhancer', 'A', 5.0, 'ncRNA gene')
+        store.append('GH1', 'chr1', 100, 200, 0.5, 'Enhancer', 'B', 1.25, 'other gene')
+        store.append('GH2', 'chrX', 2 ** 40, 2 ** 40 + 1, 0.1, 'Promoter', 'A', 9.0, 'ncRNA gene')
+        store.save()
+        self.assertFalse(os.path.exists(store_path + '.tmp'))
+
+        store = EdgeStore.open(store_path)
+        try:
+            self.assertEqual(store.source, {'file': 'f'})
+            self.assertEqual(store.num_edges, 3)
+            columns = store.get_columns(['Gene', 'StartLocation', 'GeneEnhancerScore'])
+            self.assertEqual(list(columns['Gene']), [0, 1, 0])
+            self.assertEqual(list(columns['StartLocation']), [100, 100, 2 ** 40])
+            self.assertEqual(list(columns['GeneEnhancerScore']), [5.0, 1.25, 9.0])
+            self.assertEqual(store.get_dictionary('Gene'), ['A', 'B'])
+            self.assertEqual(store.get_dictionary('Chromosome'), ['chr1', 'chrX'])
+        finally:
+            store.close()